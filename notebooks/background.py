@@ -0,0 +1,141 @@
+"""
+Running analyses off the notebook's main thread, one at a time, so widgets
+stay responsive and a new request can cancel the one in flight.
+
+Each analysis gets a ``Job``. While it is active the job is a dask callback,
+so it counts the tasks of whatever the analysis computes to report progress,
+and stops the computation at the next task once it has been cancelled.
+Callbacks are global to dask, so the job only takes notice of computations
+started on the analysis' own thread, and only until the analysis ends.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from dask.callbacks import Callback
+
+
+class Cancelled(Exception):
+    """Raised inside an analysis whose job has been cancelled."""
+
+
+class Job(Callback):
+    """
+    One analysis running in the background.
+
+    :param report: Called with a line of status for the user, from the
+        analysis' thread.
+    :param interval: Least number of seconds between progress reports.
+    """
+
+    def __init__(self, report, interval=0.5):
+        super(Job, self).__init__()
+        self.report = report
+        self.interval = interval
+        self.stage = ''
+        self._cancelled = threading.Event()
+        self._total = 0
+        self._done = 0
+        self._reported = 0.0
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        return super(Job, self).__enter__()
+
+    def __exit__(self, *exc_info):
+        # A computation on another thread can put the job back in dask's
+        # callbacks after this, so it has to ignore them from now on
+        self._thread = None
+        super(Job, self).__exit__(*exc_info)
+
+    def _ours(self):
+        """Whether dask is computing on the thread the job is active on."""
+        return threading.get_ident() == self._thread
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        """Raise ``Cancelled`` if the job has been cancelled."""
+        if self.cancelled:
+            raise Cancelled()
+
+    def status(self, stage):
+        """Start reporting progress for ``stage``, e.g. "computing the 5 m result"."""
+        self.check()
+        if self._thread is not None:
+            # Computations on other threads take dask's callbacks away while
+            # they run, and can leave the job out when they put them back
+            self.register()
+        self.stage = stage
+        self._reported = monotonic()
+        self.report("Plot status: {}".format(stage))
+
+    def _start_state(self, dsk, state):
+        if not self._ours():
+            return
+        self._total = sum(len(state[name]) for name in ('ready', 'waiting', 'running'))
+        self._done = 0
+
+    def _pretask(self, key, dsk, state):
+        if self._ours():
+            self.check()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        if not self._ours():
+            return
+        self._done += 1
+        now = monotonic()
+        if self._total and now - self._reported >= self.interval:
+            self._reported = now
+            self.report("Plot status: {}, {:.0%} of {} tasks".format(
+                self.stage, self._done / self._total, self._total))
+
+
+class BackgroundRunner(object):
+    """
+    Runs one analysis at a time on a background thread. Submitting another
+    cancels the one running, which stops at its next dask task or the next
+    time it calls ``job.check()``, and the new one starts straight after.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._job = None
+
+    def submit(self, analysis, report):
+        """
+        Run ``analysis(job)`` in the background, reporting its status with
+        ``report(line)``. Returns the Future of its result.
+        """
+        job = Job(report)
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+            self._job = job
+        return self._executor.submit(self._run, analysis, job)
+
+    def cancel(self):
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+
+    @staticmethod
+    def _run(analysis, job):
+        try:
+            job.check()
+            # Only computations started on this thread are the analysis'
+            with job:
+                return analysis(job)
+        except Cancelled:
+            logging.info("Analysis cancelled")
+        except Exception as e:
+            logging.exception("Analysis failed")
+            job.report("Plot status: failed, {}".format(e))
@@ -0,0 +1,223 @@
+"""
+Check the fast paths in widget_func against the code they replaced, and time
+both, on synthetic rasters the size of a drawn polygon at 5 m.
+
+    python3 benchmark_widget.py --size 2000 --chunks 500
+"""
+import logging
+import tracemalloc
+from collections import OrderedDict
+from time import perf_counter
+
+import click
+import numpy as np
+import xarray as xr
+
+from crosstab import crosstab
+from widget_func import SLOPE_KERNELS, SLOPE_NODATA, classify_slope, get_slope, slope_category
+from zonal_stats import nested_crosstab
+
+RESOLUTION = (-5, 5)
+
+
+def best_of(repeat, func):
+    """Fastest of ``repeat`` runs of ``func``, in seconds, and its result."""
+    best, result = None, None
+    for i in range(repeat):
+        started = perf_counter()
+        result = func()
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def peak_memory(func):
+    """Result of ``func`` and the most memory numpy had allocated while running it, in MB."""
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def synthetic_dem(size, seed=0):
+    """Rolling hills with some roughness, in metres, as float32."""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size] * 5.0
+    dem = 300 + 80 * np.sin(x / 700) * np.cos(y / 900) + 25 * np.sin((x + y) / 150) + rng.normal(0, 0.5, (size, size))
+    return xr.DataArray(dem.astype(np.float32), dims=('y', 'x'), name='band1')
+
+
+def synthetic_slope(size, seed=0):
+    """
+    Slope in degrees over a ``size`` square, mostly gentle with some steep
+    ground, and NaN outside a disc the way pixels outside a polygon are.
+    """
+    rng = np.random.RandomState(seed)
+    slope = rng.gamma(2.0, 6.0, (size, size)).astype(np.float32)
+    y, x = np.ogrid[:size, :size]
+    outside = (x - size / 2) ** 2 + (y - size / 2) ** 2 > (size / 2) ** 2
+    slope[outside] = np.nan
+    return xr.DataArray(slope, dims=('y', 'x'), name='slope')
+
+
+def benchmark_classify(size, chunks, repeat):
+    slope = synthetic_slope(size)
+    lazy = slope.chunk({'y': chunks, 'x': chunks})
+
+    def original():
+        return xr.apply_ufunc(slope_category, lazy, vectorize=True, dask='parallelized',
+                              output_dtypes=[np.float32]).compute()
+
+    original_time, expected = best_of(1, original)
+    numpy_time, in_memory = best_of(repeat, lambda: classify_slope(slope))
+    dask_time, chunked = best_of(repeat, lambda: classify_slope(lazy).compute())
+
+    expected = np.where(np.isnan(expected.values), SLOPE_NODATA, expected.values)
+    for name, result in [('numpy', in_memory), ('dask', chunked)]:
+        if result.dtype != np.uint8 or not np.array_equal(result.values, expected):
+            raise click.ClickException("classify_slope ({}) disagrees with slope_category".format(name))
+
+    logging.info("classify %d x %d: original %.3fs, numpy %.3fs (%.0fx), dask %.3fs (%.0fx)",
+                 size, size, original_time, numpy_time, original_time / numpy_time,
+                 dask_time, original_time / dask_time)
+
+
+def original_get_slope(dem, *resolution):
+    """get_slope as it was, on the whole DEM in memory."""
+    x, y = np.gradient(dem, *resolution)
+
+    slope = np.arctan(np.sqrt(x*x + y*y)) * 180 / np.pi
+    # What xr.full_like(dem, slope) gave on the xarray of the time
+    return dem.copy(data=slope.astype(dem.dtype))
+
+
+def benchmark_slope(size, chunks, repeat):
+    dem = synthetic_dem(size)
+    lazy = dem.chunk({'y': chunks, 'x': chunks})
+
+    original_time, (expected, original_peak) = best_of(
+        repeat, lambda: peak_memory(lambda: original_get_slope(dem, *RESOLUTION)))
+    logging.info("slope %d x %d: original %.3fs, peak %.0f MB", size, size, original_time, original_peak)
+
+    for kernel in SLOPE_KERNELS:
+        in_memory = get_slope(dem, *RESOLUTION, kernel=kernel)
+        elapsed, (chunked, peak) = best_of(
+            repeat, lambda: peak_memory(lambda: get_slope(lazy, *RESOLUTION, kernel=kernel).compute()))
+        if chunked.dtype != np.float32 or not np.array_equal(chunked.values, in_memory.values):
+            raise click.ClickException("Chunked {} slope differs from the in-memory one".format(kernel))
+        if kernel == 'gradient' and not np.array_equal(chunked.values, expected.values):
+            raise click.ClickException("Chunked slope differs from the original get_slope")
+        logging.info("slope %d x %d, %s: chunked %.3fs, peak %.0f MB", size, size, kernel, elapsed, peak)
+
+
+def original_unique_counts(dataset):
+    """unique_counts as it was, sorting every pixel's values with np.unique."""
+    stacked_array = dataset.to_array().values
+    flat_array = np.reshape(stacked_array, (stacked_array.shape[0], -1))
+
+    unique_keys, counts = np.unique(flat_array, axis=1, return_counts=True)
+    valid_keys = np.isfinite(unique_keys).all(axis=0)
+    unique_keys, counts = unique_keys[:, valid_keys].astype(np.int16), counts[valid_keys]
+
+    coords = {name: ('value', vals) for name, vals in zip(dataset, unique_keys)}
+    return xr.Dataset(data_vars={'count': ('value', counts)}, coords=coords)['count']
+
+
+def synthetic_categories(size, seed=0):
+    """
+    DLCD classes in blocks of 20 pixels, as 100 m cells look at 5 m, and slope
+    categories, both NaN outside a disc.
+    """
+    rng = np.random.RandomState(seed)
+    cells = -(-size // 20)
+    dlcd = np.kron(rng.choice([1, 3, 4, 9, 10, 14, 24, 31, 34], (cells, cells)), np.ones((20, 20)))[:size, :size]
+    slope = classify_slope(synthetic_slope(size, seed)).values.astype(np.float64)
+    slope[slope == SLOPE_NODATA] = np.nan
+    dlcd[np.isnan(slope)] = np.nan
+    return xr.Dataset({'dlcd': (('y', 'x'), dlcd), 'slope_category': (('y', 'x'), slope)})
+
+
+def benchmark_crosstab(size, chunks, repeat):
+    dataset = synthetic_categories(size)
+    lazy = dataset.chunk({'y': chunks, 'x': chunks})
+
+    original_time, (expected, original_peak) = best_of(
+        repeat, lambda: peak_memory(lambda: original_unique_counts(dataset)))
+    in_memory_time, (in_memory, in_memory_peak) = best_of(repeat, lambda: peak_memory(lambda: crosstab(dataset)))
+    dask_time, (chunked, dask_peak) = best_of(repeat, lambda: peak_memory(lambda: crosstab(lazy)))
+
+    for name, result in [('numpy', in_memory), ('dask', chunked)]:
+        same = (np.array_equal(result.values, expected.values)
+                and all(np.array_equal(result[var].values, expected[var].values) for var in dataset.data_vars))
+        if not same:
+            raise click.ClickException("crosstab ({}) disagrees with unique_counts".format(name))
+
+    logging.info("crosstab %d x %d: original %.3fs (peak %.0f MB), numpy %.3fs (peak %.0f MB), "
+                 "dask %.3fs (peak %.0f MB)", size, size, original_time, original_peak,
+                 in_memory_time, in_memory_peak, dask_time, dask_peak)
+
+
+def synthetic_nested(size, ratio=20, seed=0):
+    """
+    DLCD classes at 100 m and slope categories at 5 m over the same extent,
+    the slope masked to a disc, with the coordinates dc.load would give them.
+    """
+    rng = np.random.RandomState(seed)
+    cells = -(-size // ratio)
+    size = cells * ratio
+    fine_x = np.arange(size) * 5.0 + 2.5
+    coarse_x = np.arange(cells) * 5.0 * ratio + 2.5 * ratio
+    dlcd = xr.DataArray(rng.choice([1, 3, 4, 9, 10, 14, 24, 31, 34], (cells, cells)).astype(np.uint8),
+                        dims=('y', 'x'), coords={'y': -coarse_x, 'x': coarse_x}, name='dlcd')
+    slope = classify_slope(synthetic_slope(size, seed))
+    slope = slope.assign_coords(y=-fine_x, x=fine_x).rename('slope_category')
+    return dlcd, slope
+
+
+def benchmark_native(size, chunks, repeat):
+    dlcd, slope = synthetic_nested(size)
+    ratio = slope.shape[0] // dlcd.shape[0]
+
+    def resampled():
+        upsampled = dlcd.reindex(x=slope.x, y=slope.y, method='nearest').chunk({'y': chunks, 'x': chunks})
+        return crosstab(xr.merge([upsampled, slope.chunk({'y': chunks, 'x': chunks})]))
+
+    resampled_time, (expected, resampled_peak) = best_of(repeat, lambda: peak_memory(resampled))
+    native_time, (native, native_peak) = best_of(repeat, lambda: peak_memory(
+        lambda: nested_crosstab(dlcd.chunk({'y': chunks // ratio, 'x': chunks // ratio}),
+                                slope.chunk({'y': chunks, 'x': chunks}))))
+
+    same = np.array_equal(native.values, expected.values) and all(
+        np.array_equal(native[name].values, expected[name].values) for name in ('dlcd', 'slope_category'))
+    if not same:
+        raise click.ClickException("nested_crosstab disagrees with crosstab at the fine resolution")
+
+    logging.info("native %d x %d: resampled to 5 m %.3fs (peak %.0f MB, %d DLCD pixels), "
+                 "native %.3fs (peak %.0f MB, %d DLCD pixels)", size, size,
+                 resampled_time, resampled_peak, slope.size, native_time, native_peak, dlcd.size)
+
+
+BENCHMARKS = OrderedDict([
+    ('classify', benchmark_classify),
+    ('slope', benchmark_slope),
+    ('crosstab', benchmark_crosstab),
+    ('native', benchmark_native),
+])
+
+
+@click.command(help="Compare the fast paths in widget_func with the code they replaced, and time both")
+@click.option('--size', default=2000, type=click.IntRange(min=1), help="Width and height of the raster in pixels")
+@click.option('--chunks', default=500, type=click.IntRange(min=1), help="Width and height of the dask chunks")
+@click.option('--repeat', '-n', default=3, type=click.IntRange(min=1), help="Number of times each fast path is run")
+@click.option('--only', multiple=True, type=click.Choice(sorted(BENCHMARKS)), help="Only run these benchmarks")
+def main(size, chunks, repeat, only):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    for name, benchmark in BENCHMARKS.items():
+        if not only or name in only:
+            benchmark(size, chunks, repeat)
+
+
+if __name__ == "__main__":
+    main()
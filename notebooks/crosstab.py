@@ -0,0 +1,115 @@
+"""
+Cross-tabulation of categorical rasters: how many pixels have each
+combination of categories across the variables of a Dataset.
+
+The categories of a pixel are packed into one integer key and counted with
+``np.bincount``, a chunk at a time for dask-backed data. Each chunk only
+returns the combinations it saw and their counts, which are merged a few at
+a time, so the work is one pass over the pixels and memory doesn't grow with them.
+"""
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+# Most keys a chunk counts with np.bincount. Beyond that the categories are
+# too spread out, and the keys are counted with np.unique instead.
+MAX_BINS = 1 << 22
+
+# Pixels counted at a time from data that is already in memory
+BLOCK_PIXELS = 1 << 20
+
+
+def _tally(codes, weights=None):
+    """
+    Count the distinct columns of ``codes``, an (n_vars, n) integer array.
+    Returns them, sorted as ``np.unique(codes, axis=1)`` would be, with their
+    counts, or the sum of their ``weights``.
+    """
+    n_vars = codes.shape[0]
+    if codes.shape[1] == 0:
+        return np.empty((n_vars, 0), dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    lows = codes.min(axis=1)
+    sizes = codes.max(axis=1) - lows + 1
+    # Row major strides, so keys sort the way the columns do
+    strides = np.ones(n_vars, dtype=np.int64)
+    for i in range(n_vars - 2, -1, -1):
+        strides[i] = strides[i + 1] * sizes[i + 1]
+    bins = int(strides[0] * sizes[0])
+    keys = ((codes - lows[:, None]) * strides[:, None]).sum(axis=0)
+
+    if bins <= MAX_BINS:
+        counts = np.bincount(keys, weights=weights, minlength=bins)
+        found = np.flatnonzero(counts)
+        counts = counts[found]
+    else:
+        found, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights)
+
+    unique_codes = (found[None, :] // strides[:, None]) % sizes[:, None] + lows[:, None]
+    return unique_codes, counts.astype(np.int64)
+
+
+def _count_block(block, nodata):
+    """
+    Combinations of categories in one (n_vars, ...) block of pixels, leaving
+    out pixels where any variable is NaN or equal to its ``nodata``.
+    """
+    flat = block.reshape(block.shape[0], -1)
+    valid = np.ones(flat.shape[1], dtype=bool)
+    for i, value in enumerate(nodata):
+        if np.issubdtype(flat.dtype, np.floating):
+            valid &= np.isfinite(flat[i])
+        if value is not None:
+            valid &= flat[i] != value
+    return _tally(flat[:, valid].astype(np.int64))
+
+
+def _merge(*partials):
+    """Add up the counts of ``_count_block`` results."""
+    codes = np.concatenate([codes for codes, counts in partials], axis=1)
+    counts = np.concatenate([counts for codes, counts in partials])
+    return _tally(codes, weights=counts)
+
+
+def _merge_tree(partials, fan_in=8):
+    """Merge delayed partial counts a few at a time, until one is left."""
+    while len(partials) > 1:
+        partials = [
+            dask.delayed(_merge)(*partials[i:i + fan_in])
+            for i in range(0, len(partials), fan_in)
+        ]
+    return partials[0]
+
+
+def crosstab(dataset):
+    """
+    Count the pixels with each combination of values in the variables of
+    ``dataset``, which should hold category codes. Pixels that are NaN, or
+    equal to a variable's ``nodata`` attribute, aren't counted.
+
+    Returns a ``count`` DataArray along a ``value`` dimension, with the codes
+    of each combination as int64 coordinates named after the variables,
+    sorted by the first variable, then the second, and so on.
+    """
+    names = list(dataset.data_vars)
+    nodata = tuple(dataset[name].attrs.get('nodata') for name in names)
+    stacked = dataset.to_array().data
+
+    if isinstance(stacked, da.Array):
+        stacked = stacked.rechunk({0: -1})
+        partials = [
+            dask.delayed(_count_block)(block, nodata)
+            for block in stacked.to_delayed().ravel()
+        ]
+        codes, counts = dask.compute(_merge_tree(partials))[0]
+    else:
+        flat = np.asarray(stacked).reshape(len(names), -1)
+        codes, counts = _merge(*[
+            _count_block(flat[:, start:start + BLOCK_PIXELS], nodata)
+            for start in range(0, max(flat.shape[1], 1), BLOCK_PIXELS)
+        ])
+
+    coords = {name: ('value', values) for name, values in zip(names, codes)}
+    return xr.Dataset(data_vars={'count': ('value', counts)}, coords=coords)['count']
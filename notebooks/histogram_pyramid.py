@@ -0,0 +1,422 @@
+"""
+A pyramid of joint histograms of categorical products, for area statistics
+of big polygons without reading every pixel in them.
+
+The state is cut into square cells on the grid the widget loads onto, and for
+each cell the pixels with every combination of land cover class and slope
+category are counted ahead of time. Each level of the pyramid adds up 2 x 2
+cells of the level below. The counts of a level are one array of
+``(rows, cols, classes..., )`` in a ``.npy`` file, memory mapped so a query
+only reads the cells it uses, and a JSON file describes the grid and the
+products.
+
+A polygon is answered from the biggest cells that fit wholly inside it, and
+the pixels of the cells its boundary crosses are read and counted as usual.
+The result is exactly what ``crosstab`` gives for the whole polygon, as long
+as the products haven't changed since the pyramid was built.
+
+    python3 histogram_pyramid.py --output /notebooks/pyramid -w 8
+"""
+import json
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+import datacube
+import numpy as np
+import xarray as xr
+from affine import Affine
+from datacube.utils import geometry
+from rasterio import features
+
+from crosstab import crosstab
+from polygon_load import dilate, load_polygon, polygon_mask
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+# Variable name, product and number of classes, codes 0 to classes - 1, of
+# each product counted, as in dlcd.csv and slope_cat.csv
+PRODUCTS = (
+    ('dlcd', 'dlcdnsw', 36),
+    ('slope_category', 'slope_category', 6),
+)
+
+# The grid the widget loads onto
+CRS = 'EPSG:3577'
+RESOLUTION = (-5, 5)
+
+# Pixels along each side of a cell at the bottom of the pyramid, levels above
+# it, and cells along each side of the blocks it is built and read in
+CELL_SIZE = 512
+LEVELS = 6
+BLOCK_CELLS = 8
+
+SIDECAR = 'pyramid.json'
+
+# One connection to the index in each worker process
+_dc = None
+
+
+def _datacube():
+    global _dc
+    if _dc is None:
+        _dc = datacube.Datacube(app='histogram-pyramid')
+    return _dc
+
+
+def _level_dtype(pixels):
+    return np.uint32 if pixels < 2 ** 32 else np.uint64
+
+
+def _level_path(directory, level):
+    return os.path.join(directory, 'level{}.npy'.format(level))
+
+
+def _bins(codes, classes, nodata):
+    """Bin of each code: itself if it is a class, ``classes`` otherwise."""
+    codes = np.asarray(codes)
+    valid = np.isfinite(codes) if np.issubdtype(codes.dtype, np.floating) else np.ones(codes.shape, dtype=bool)
+    valid &= (codes >= 0) & (codes < classes)
+    if nodata is not None:
+        valid &= codes != nodata
+    return np.where(valid, codes, classes).astype(np.int64)
+
+
+def _cell_histograms(arrays, classes, nodata, cell_size):
+    """
+    Joint histograms of the cells of ``cell_size`` pixels of ``arrays``, 2D
+    arrays of codes the same shape. Returns ``(rows, cols, bins...)`` counts,
+    with one bin more than there are classes, for everything else.
+    """
+    shape = tuple(n + 1 for n in classes)
+    bins = int(np.prod(shape))
+    height, width = arrays[0].shape
+    rows, cols = height // cell_size, width // cell_size
+    counts = np.empty((rows, cols, bins), dtype=np.int64)
+    cell = np.repeat(np.arange(cols), cell_size) * bins
+    # A row of cells at a time, to keep the keys small
+    for row in range(rows):
+        strip = slice(row * cell_size, (row + 1) * cell_size)
+        keys = np.ravel_multi_index(
+            [_bins(array[strip], n, value) for array, n, value in zip(arrays, classes, nodata)], shape)
+        keys += cell
+        counts[row] = np.bincount(keys.ravel(), minlength=cols * bins).reshape(cols, bins)
+    return counts.reshape((rows, cols) + shape)
+
+
+class HistogramPyramid(object):
+    """
+    A pyramid built by ``create_pyramid`` and ``fill_pyramid``, opened read
+    only.
+
+    :param directory: Directory it was built in.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SIDECAR)) as f:
+            self.meta = json.load(f)
+        if not self.meta.get('complete'):
+            raise ValueError("The pyramid in {} was never finished".format(directory))
+        self.names = [product['name'] for product in self.meta['products']]
+        self.classes = [product['classes'] for product in self.meta['products']]
+        self.cell_size = self.meta['cell_size']
+        self.resolution = tuple(self.meta['resolution'])
+        self.crs = geometry.CRS(self.meta['crs'])
+        self.affine = Affine(*self.meta['affine'])
+        self.levels = [
+            np.load(_level_path(directory, level), mmap_mode='r')
+            for level in range(len(self.meta['levels']))
+        ]
+
+    def covers(self, crs, resolution):
+        """Whether the pyramid is on the grid of ``crs`` and ``resolution``."""
+        return geometry.CRS(crs) == self.crs and tuple(resolution) == self.resolution
+
+    def _cell_grid(self, geom):
+        """
+        Row and column of the top left cell of the window of cells around
+        ``geom``, aligned to cells of the top level, and the window's shape.
+        """
+        top = 2 ** (len(self.levels) - 1)
+        ring = np.concatenate([np.asarray(r, dtype=float)[:, :2] for r in _rings(geom)])
+        inverse = ~self.affine
+        cols, rows = inverse * (ring[:, 0], ring[:, 1])
+        row0, col0 = (int(math.floor(v.min() / top)) * top for v in (rows, cols))
+        row1, col1 = (int(math.ceil((v.max() + 1e-9) / top)) * top for v in (rows, cols))
+        return row0, col0, (max(row1 - row0, top), max(col1 - col0, top))
+
+    def interior(self, geom):
+        """
+        Cells wholly inside ``geom``, and those it touches, in the window
+        from ``_cell_grid``.
+        """
+        row0, col0, shape = self._cell_grid(geom)
+        transform = self.affine * Affine.translation(col0, row0)
+        inside = features.geometry_mask([geom], out_shape=shape, transform=transform, invert=True)
+        touched = features.geometry_mask([geom], out_shape=shape, transform=transform,
+                                         all_touched=True, invert=True)
+        edge = features.rasterize([{'type': 'MultiLineString', 'coordinates': _rings(geom)}],
+                                  out_shape=shape, transform=transform, all_touched=True).astype(bool)
+        # Cells whose centres are inside and that no edge crosses are inside
+        # altogether, and so are all their pixels' centres. Those next to an
+        # edge are checked against the polygon itself, in case rasterizing
+        # the edge missed a corner it clips.
+        interior = inside & ~edge
+        polygon = geometry.Geometry(geom, crs=self.crs)
+        for row, col in zip(*np.nonzero(interior & dilate(edge, 1))):
+            left, top = transform * (col, row)
+            right, bottom = transform * (col + 1, row + 1)
+            if not polygon.contains(geometry.box(left, bottom, right, top, crs=self.crs)):
+                interior[row, col] = False
+        rows, cols = self.levels[0].shape[:2]
+        in_grid = np.zeros(shape, dtype=bool)
+        in_grid[max(-row0, 0):max(rows - row0, 0), max(-col0, 0):max(cols - col0, 0)] = True
+        return row0, col0, interior & in_grid, touched
+
+    def interior_counts(self, geom):
+        """
+        Joint histogram of the cells wholly inside ``geom``, from the biggest
+        cells of the pyramid that fit, and the window of cells from
+        ``interior``.
+        """
+        row0, col0, interior, touched = self.interior(geom)
+        full = [interior]
+        for level in range(1, len(self.levels)):
+            below = full[-1]
+            rows, cols = below.shape[0] // 2, below.shape[1] // 2
+            full.append(below.reshape(rows, 2, cols, 2).all(axis=(1, 3)))
+
+        counts = np.zeros(self.levels[0].shape[2:], dtype=np.int64)
+        for level in range(len(self.levels) - 1, -1, -1):
+            take = full[level]
+            if level + 1 < len(self.levels):
+                # Not already counted in a bigger cell
+                take = take & ~np.repeat(np.repeat(full[level + 1], 2, axis=0), 2, axis=1)
+            rows, cols = np.nonzero(take)
+            if len(rows):
+                scale = 2 ** level
+                cells = self.levels[level][rows + row0 // scale, cols + col0 // scale]
+                counts += cells.sum(axis=0, dtype=np.int64)
+        return counts, (row0, col0, interior, touched)
+
+    def crosstab(self, dc, geom, chunks=None):
+        """
+        Count the pixels inside ``geom``, a GeoJSON geometry in the pyramid's
+        CRS, with each combination of classes, as ``crosstab`` would for the
+        products loaded over it.
+
+        :param dc: Datacube to read the pixels along the boundary from.
+        :param chunks: Chunks to read them in, a cell by default.
+        """
+        counts, (row0, col0, interior, touched) = self.interior_counts(geom)
+        chunks = chunks or {'time': 1, 'x': self.cell_size, 'y': self.cell_size}
+
+        # Pixels in the cells along the boundary, a block of cells at a time
+        boundary = touched & ~interior
+        for block_row in range(0, boundary.shape[0], BLOCK_CELLS):
+            for block_col in range(0, boundary.shape[1], BLOCK_CELLS):
+                cells = boundary[block_row:block_row + BLOCK_CELLS, block_col:block_col + BLOCK_CELLS]
+                if not cells.any():
+                    continue
+                geobox = self._geobox(row0 + block_row, col0 + block_col, cells.shape)
+                skip = np.repeat(np.repeat(
+                    interior[block_row:block_row + BLOCK_CELLS, block_col:block_col + BLOCK_CELLS],
+                    self.cell_size, axis=0), self.cell_size, axis=1)
+                mask = polygon_mask(geom, geobox) & ~skip
+                if mask.any():
+                    self._add_pixels(counts, dc, geom, geobox, mask, chunks)
+
+        # Everything but the bins of codes that aren't classes
+        counts = counts[tuple(slice(0, n) for n in self.classes)]
+        found = np.nonzero(counts)
+        coords = {name: ('value', codes.astype(np.int64)) for name, codes in zip(self.names, found)}
+        return xr.Dataset(data_vars={'count': ('value', counts[found])}, coords=coords)['count']
+
+    def _geobox(self, row, col, shape):
+        affine = self.affine * Affine.translation(col, row) * Affine.scale(1 / self.cell_size)
+        return geometry.GeoBox(shape[1] * self.cell_size, shape[0] * self.cell_size, affine, self.crs)
+
+    def _add_pixels(self, counts, dc, geom, geobox, mask, chunks):
+        arrays = []
+        for meta in self.meta['products']:
+            data = load_polygon(dc, meta['product'], geom, geobox, dask_chunks=chunks, mask=mask, keep_dtype=True)
+            if not data.data_vars:
+                return
+            array = data[meta['measurement']].squeeze('time', drop=True)
+            array.name = meta['name']
+            arrays.append(array)
+        found = crosstab(xr.merge(arrays))
+        codes = [_bins(found[name].values, n, None) for name, n in zip(self.names, self.classes)]
+        np.add.at(counts, tuple(codes), found.values)
+
+
+def _rings(geom):
+    """Every ring of a GeoJSON Polygon or MultiPolygon."""
+    if geom['type'] == 'Polygon':
+        return list(geom['coordinates'])
+    if geom['type'] == 'MultiPolygon':
+        return [ring for polygon in geom['coordinates'] for ring in polygon]
+    raise ValueError("Expected a Polygon or MultiPolygon, got {}".format(geom['type']))
+
+
+def pyramid_grid(dc, products, levels=LEVELS, cell_size=CELL_SIZE, crs=CRS, resolution=RESOLUTION):
+    """
+    Affine of the cells of the bottom level, and their rows and columns,
+    covering every dataset of ``products``, aligned to the cells of the top
+    level.
+    """
+    res_y, res_x = resolution
+    span = cell_size * 2 ** (levels - 1)
+    lefts, bottoms, rights, tops = [], [], [], []
+    for product in products:
+        for dataset in dc.find_datasets(product=product):
+            if dataset.extent is None:
+                continue
+            left, bottom, right, top = dataset.extent.to_crs(crs).boundingbox
+            lefts.append(left)
+            bottoms.append(bottom)
+            rights.append(right)
+            tops.append(top)
+    if not lefts:
+        raise ValueError("No datasets of {} to build a pyramid from".format(', '.join(products)))
+
+    col0 = int(math.floor(min(lefts) / (res_x * span))) * span // cell_size
+    row0 = int(math.floor(max(tops) / (res_y * span))) * span // cell_size
+    col1 = int(math.ceil(max(rights) / (res_x * span))) * span // cell_size
+    row1 = int(math.ceil(min(bottoms) / (res_y * span))) * span // cell_size
+    affine = Affine(res_x * cell_size, 0, col0 * cell_size * res_x, 0, res_y * cell_size, row0 * cell_size * res_y)
+    return affine, (row1 - row0, col1 - col0)
+
+
+def build_block(directory, block_row, block_col):
+    """Count the cells of one block of the bottom level into its file."""
+    with open(os.path.join(directory, SIDECAR)) as f:
+        meta = json.load(f)
+    pyramid_affine = Affine(*meta['affine'])
+    cell_size = meta['cell_size']
+    level = np.load(_level_path(directory, 0), mmap_mode='r+')
+    rows = slice(block_row, min(block_row + BLOCK_CELLS, level.shape[0]))
+    cols = slice(block_col, min(block_col + BLOCK_CELLS, level.shape[1]))
+
+    affine = pyramid_affine * Affine.translation(block_col, block_row) * Affine.scale(1 / cell_size)
+    geobox = geometry.GeoBox((cols.stop - cols.start) * cell_size, (rows.stop - rows.start) * cell_size,
+                             affine, geometry.CRS(meta['crs']))
+    arrays = []
+    for product in meta['products']:
+        data = _datacube().load(product=product['product'], like=geobox, measurements=[product['measurement']])
+        if not data.data_vars:
+            return False
+        arrays.append(data[product['measurement']].isel(time=0).values)
+
+    level[rows, cols] = _cell_histograms(
+        arrays, [p['classes'] for p in meta['products']], [p['nodata'] for p in meta['products']], cell_size)
+    level.flush()
+    return True
+
+
+def create_pyramid(dc, directory, products=PRODUCTS, levels=LEVELS, cell_size=CELL_SIZE):
+    """
+    Lay out an empty pyramid of the joint histograms of ``products`` in
+    ``directory``, over every dataset of them, for ``fill_pyramid``.
+    """
+    os.makedirs(directory, exist_ok=True)
+    affine, shape = pyramid_grid(dc, [product for name, product, classes in products], levels, cell_size)
+    meta = {
+        'crs': CRS,
+        'resolution': list(RESOLUTION),
+        'cell_size': cell_size,
+        'affine': list(affine)[:6],
+        'products': [
+            {
+                'name': name,
+                'product': product,
+                'measurement': 'band1',
+                'classes': classes,
+                'nodata': dc.index.products.get_by_name(product).measurements['band1'].nodata,
+            }
+            for name, product, classes in products
+        ],
+        'levels': [],
+        'complete': False,
+    }
+    bins = tuple(classes + 1 for name, product, classes in products)
+    for level in range(levels):
+        scale = 2 ** level
+        level_shape = (shape[0] // scale, shape[1] // scale)
+        dtype = _level_dtype((cell_size * scale) ** 2)
+        np.lib.format.open_memmap(_level_path(directory, level), mode='w+', dtype=dtype,
+                                  shape=level_shape + bins).flush()
+        meta['levels'].append({'shape': list(level_shape), 'dtype': np.dtype(dtype).name})
+    with open(os.path.join(directory, SIDECAR), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def fill_pyramid(directory, workers=1):
+    """
+    Count the cells of the pyramid laid out in ``directory`` a block at a
+    time in ``workers`` processes, then add up the levels above.
+    """
+    with open(os.path.join(directory, SIDECAR)) as f:
+        meta = json.load(f)
+    shape = meta['levels'][0]['shape']
+    blocks = [(row, col) for row in range(0, shape[0], BLOCK_CELLS) for col in range(0, shape[1], BLOCK_CELLS)]
+    logging.info("Counting %d x %d cells in %d blocks", shape[0], shape[1], len(blocks))
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_block, directory, row, col): (row, col) for row, col in blocks}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                logging.error("Block %s failed: %s", futures[future], e)
+            if done % 100 == 0:
+                logging.info("%d of %d blocks counted", done, len(blocks))
+    if failed:
+        raise RuntimeError("{} blocks failed".format(failed))
+
+    # Each level adds up 2 x 2 cells of the one below
+    for level in range(1, len(meta['levels'])):
+        below = np.load(_level_path(directory, level - 1), mmap_mode='r')
+        above = np.load(_level_path(directory, level), mmap_mode='r+')
+        for row in range(above.shape[0]):
+            pairs = below[2 * row:2 * row + 2, :2 * above.shape[1]].astype(above.dtype)
+            above[row] = pairs.reshape((2, above.shape[1], 2) + pairs.shape[2:]).sum(axis=(0, 2))
+        above.flush()
+
+    meta['complete'] = True
+    with open(os.path.join(directory, SIDECAR), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return HistogramPyramid(directory)
+
+
+@click.command(help="Build a pyramid of joint land cover and slope category histograms")
+@click.option(
+    '--output', '-o', required=True, type=click.Path(file_okay=False),
+    help="Directory to write the pyramid to")
+@click.option(
+    '--workers', '-w', default=os.cpu_count(), type=click.IntRange(min=1),
+    help="Number of processes counting blocks of cells")
+@click.option(
+    '--cell_size', default=CELL_SIZE, type=click.IntRange(min=16),
+    help="Pixels along each side of a cell at the bottom of the pyramid")
+@click.option(
+    '--levels', default=LEVELS, type=click.IntRange(min=1),
+    help="Number of levels in the pyramid")
+def main(output, workers, cell_size, levels):
+    # Closed again before the workers start, which open their own
+    with datacube.Datacube(app='histogram-pyramid') as dc:
+        create_pyramid(dc, output, levels=levels, cell_size=cell_size)
+    try:
+        fill_pyramid(output, workers=workers)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    logging.info("Pyramid written to %s", output)
+
+
+if __name__ == "__main__":
+    main()
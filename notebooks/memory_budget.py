@@ -0,0 +1,69 @@
+"""
+Keeping loads within a memory budget.
+
+Before anything is read, a load can be checked against a budget, so that
+one too big for the kernel fails straight away with a ``MemoryError``
+rather than once it has filled memory. Or the budget can choose the dask
+chunks to load in, so the load streams through the area a few chunks at a
+time, however big it is.
+"""
+import math
+import os
+
+import numpy as np
+from dask.utils import format_bytes, parse_bytes
+
+# Chunks are whole multiples of this many pixels along each side, the block
+# size of the COGs
+CHUNK_BLOCK = 256
+
+# Copies of each chunk held while it is read, masked and counted
+CHUNK_COPIES = 3
+
+
+def budget_bytes(budget):
+    """``budget`` in bytes, from a number or a string such as ``'4GB'``."""
+    if isinstance(budget, str):
+        return parse_bytes(budget)
+    return int(budget)
+
+
+def load_bytes(shape, dtypes, times=1):
+    """Bytes taken by ``times`` arrays of ``shape`` in each of ``dtypes``."""
+    pixels = int(np.prod(shape, dtype=np.int64))
+    return times * pixels * sum(np.dtype(dtype).itemsize for dtype in dtypes)
+
+
+def check_budget(shape, dtypes, budget, times=1):
+    """
+    Raise a ``MemoryError`` if loading ``times`` arrays of ``shape`` in each
+    of ``dtypes`` would take more than ``budget``.
+    """
+    needed = load_bytes(shape, dtypes, times)
+    if needed > budget_bytes(budget):
+        raise MemoryError(
+            "Loading {} x {} pixels needs {}, more than the budget of {}. Load with dask_chunks='auto' to "
+            "stream it instead".format(shape[0], shape[1], format_bytes(needed), format_bytes(budget_bytes(budget))))
+
+
+def budget_chunks(shape, dtypes, budget, workers=None, block=CHUNK_BLOCK):
+    """
+    Dask chunks to load arrays of ``shape`` in each of ``dtypes`` in, as big
+    as they can be while ``workers`` of them at once, each held a few times
+    over, fit in ``budget``.
+
+    :param workers: Chunks worked on at once, as many as dask's threads by
+        default.
+    :param block: Chunks are square, a whole number of these along each side.
+    :return: ``{'time': 1, 'y': side, 'x': side}``, as for ``dc.load``.
+    """
+    workers = workers or os.cpu_count() or 1
+    pixel_bytes = sum(np.dtype(dtype).itemsize for dtype in dtypes) * workers * CHUNK_COPIES
+    side = int(math.sqrt(budget_bytes(budget) // pixel_bytes)) // block * block
+    if side < block:
+        raise MemoryError(
+            "The budget of {} doesn't fit a chunk of {} x {} pixels for each of {} workers".format(
+                format_bytes(budget_bytes(budget)), block, block, workers))
+    # No bigger than the whole area
+    side = min(side, int(math.ceil(max(shape) / block)) * block)
+    return {'time': 1, 'y': side, 'x': side}
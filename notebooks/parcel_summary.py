@@ -0,0 +1,287 @@
+"""
+Land cover, and land cover by slope category, of every polygon in a parcel
+layer, the same as the valuation widget shows for a drawn one.
+
+Parcels are grouped by the tile of the slope category product their centres
+fall in, so that neighbouring parcels are summarised one after another in the
+same process, where GDAL's cache of the blocks it has fetched lets them share
+tile reads. Groups are spread over a pool of processes, and each group's
+results are saved in a checkpoint directory as soon as it is done. Running
+again with the same arguments skips the groups already saved, so a statewide
+run that stops part way carries on from where it was.
+
+    python3 parcel_summary.py parcels.gpkg results.parquet -w 8
+"""
+import json
+import logging
+import os
+import pickle
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import click
+import datacube
+import ogr
+import osr
+import pandas as pd
+
+from histogram_pyramid import HistogramPyramid
+from widget_func import ANALYSIS_CRS, DEM_RES, polygon_ranges, summarise_polygon
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Parcels whose centres are in the same square of this many metres, the
+# size of a slope category tile, are grouped, up to MAX_GROUP of them
+GROUP_SIZE = 20480
+MAX_GROUP = 200
+
+# Bytes of blocks fetched from S3 that GDAL keeps in each process, for the
+# next parcel in the group
+CURL_CACHE_SIZE = 256 * 2 ** 20
+
+# Groups waiting for a process, for each process
+QUEUED_PER_WORKER = 4
+
+# What each worker process keeps between groups
+_state = {}
+
+
+def _spatial_reference(epsg=None, srs=None):
+    srs = srs.Clone() if srs is not None else osr.SpatialReference()
+    if epsg is not None:
+        srs.ImportFromEPSG(epsg)
+    # x, y order whatever the CRS says, as GDAL 2 did
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def read_parcels(path, layer=None, id_field=None):
+    """
+    ``(id, geometry)`` of every Polygon and MultiPolygon in a layer of a
+    GeoPackage, GeoJSON or anything else OGR reads, as GeoJSON in
+    ``ANALYSIS_CRS``. Layers without a CRS are taken to be in it already.
+    """
+    source = ogr.Open(path)
+    if source is None:
+        raise ValueError("Can't open {}".format(path))
+    parcels = source.GetLayerByName(layer) if layer else source.GetLayer(0)
+    if parcels is None:
+        raise ValueError("No layer {} in {}".format(layer, path))
+
+    target = _spatial_reference(epsg=int(ANALYSIS_CRS.split(':')[1]))
+    srs = parcels.GetSpatialRef()
+    transform = None
+    if srs is not None and not srs.IsSame(target):
+        transform = osr.CoordinateTransformation(_spatial_reference(srs=srs), target)
+
+    for feature in parcels:
+        parcel_id = feature.GetField(id_field) if id_field else feature.GetFID()
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            logging.warning("Parcel %s has no geometry", parcel_id)
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        geom = json.loads(geometry.ExportToJson())
+        if geom['type'] not in ('Polygon', 'MultiPolygon'):
+            logging.warning("Parcel %s is a %s, not a polygon", parcel_id, geom['type'])
+            continue
+        yield parcel_id, geom
+
+
+def group_parcels(parcels, group_size=GROUP_SIZE, max_group=MAX_GROUP):
+    """
+    Split ``parcels`` into groups of neighbours: by the square of
+    ``group_size`` metres their centres are in, then into runs of at most
+    ``max_group`` along rows. Returns ``(group_id, parcels)`` pairs, in
+    the same order for the same parcels.
+    """
+    squares = defaultdict(list)
+    for parcel_id, geom in parcels:
+        x_range, y_range = polygon_ranges(geom)
+        x, y = sum(x_range) / 2, sum(y_range) / 2
+        squares[(int(x // group_size), int(-y // group_size))].append((-y, x, parcel_id, geom))
+
+    groups = []
+    for (col, row), members in sorted(squares.items(), key=lambda item: (item[0][1], item[0][0])):
+        members.sort(key=lambda member: member[:2])
+        for start in range(0, len(members), max_group):
+            group_id = '{}_{}_{}'.format(col, row, start // max_group)
+            groups.append((group_id, [(parcel_id, geom) for _, _, parcel_id, geom in members[start:start + max_group]]))
+    return groups
+
+
+def _part_path(checkpoint, group_id):
+    return os.path.join(checkpoint, 'group_{}.pkl'.format(group_id))
+
+
+def summarise_group(group_id, parcels, checkpoint, pyramid_dir=None, native_resolution=False):
+    """
+    Summarise the parcels of one group, one after another, and save them in
+    ``checkpoint``. Returns how many were summarised and how many failed.
+    """
+    if not _state:
+        _state['dc'] = datacube.Datacube(app='parcel-summary')
+        _state['slope_cat_table'] = pd.read_csv(os.path.join(HERE, 'slope_cat.csv'))
+        _state['dlcd_lookup'] = pd.read_csv(os.path.join(HERE, 'dlcd.csv'))
+        _state['pyramid'] = HistogramPyramid(pyramid_dir) if pyramid_dir else None
+
+    landcover, cross_counts, failed = [], [], []
+    for parcel_id, geom in parcels:
+        try:
+            pd_dlcd_output, pd_cross_counts_output = summarise_polygon(
+                _state['dc'], geom, _state['slope_cat_table'], _state['dlcd_lookup'],
+                native_resolution=native_resolution, pyramid=_state['pyramid'])
+        except Exception as e:
+            logging.warning("Parcel %s failed: %s", parcel_id, e)
+            failed.append({'parcel': parcel_id, 'group': group_id, 'error': str(e)})
+            continue
+        landcover.append(pd_dlcd_output.assign(parcel=parcel_id))
+        cross_counts.append(pd_cross_counts_output.assign(parcel=parcel_id))
+
+    part = {
+        'landcover': pd.concat(landcover, ignore_index=True) if landcover else None,
+        'cross_counts': pd.concat(cross_counts, ignore_index=True) if cross_counts else None,
+        'failed': failed,
+    }
+    path = _part_path(checkpoint, group_id)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    return len(parcels) - len(failed), len(failed)
+
+
+def _check_checkpoint(checkpoint, run):
+    """Make sure ``checkpoint`` is from a run like ``run``, or a new one."""
+    os.makedirs(checkpoint, exist_ok=True)
+    path = os.path.join(checkpoint, 'run.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        if previous != run:
+            raise click.ClickException(
+                "{} is the checkpoint of a different run, use another directory".format(checkpoint))
+    else:
+        with open(path, 'w') as f:
+            json.dump(run, f, indent=2)
+
+
+def write_table(table, path):
+    """Write ``table`` as Parquet or CSV, by the extension of ``path``."""
+    if path.endswith('.parquet'):
+        table.to_parquet(path, index=False)
+    else:
+        table.to_csv(path, index=False)
+
+
+def _suffixed(path, suffix):
+    root, extension = os.path.splitext(path)
+    return '{}_{}{}'.format(root, suffix, extension)
+
+
+@click.command(help="Summarise land cover and slope for every parcel in a GeoPackage or GeoJSON file")
+@click.argument('parcels', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option(
+    '--layer', '-l', help="Layer of PARCELS to read, the first one by default")
+@click.option(
+    '--id_field', help="Field identifying each parcel in the output, its feature ID by default")
+@click.option(
+    '--workers', '-w', default=os.cpu_count(), type=click.IntRange(min=1),
+    help="Number of processes summarising groups of parcels")
+@click.option(
+    '--group_size', default=GROUP_SIZE, type=click.FloatRange(min=1),
+    help="Metres along each side of the squares parcels are grouped by")
+@click.option(
+    '--max_group', default=MAX_GROUP, type=click.IntRange(min=1),
+    help="Most parcels in a group")
+@click.option(
+    '--checkpoint', type=click.Path(file_okay=False),
+    help="Directory to save each group's results in, OUTPUT.parts by default")
+@click.option(
+    '--pyramid', type=click.Path(exists=True, file_okay=False),
+    help="Pyramid of histograms from histogram_pyramid.py, for big parcels")
+@click.option(
+    '--native_resolution', is_flag=True,
+    help="Count land cover at its own 100 m resolution, weighted by slope at 5 m")
+def main(parcels, output, layer, id_field, workers, group_size, max_group, checkpoint, pyramid,
+         native_resolution):
+    checkpoint = checkpoint or output + '.parts'
+    stat = os.stat(parcels)
+    _check_checkpoint(checkpoint, {
+        'parcels': os.path.abspath(parcels), 'size': stat.st_size, 'mtime': stat.st_mtime,
+        'layer': layer, 'id_field': id_field, 'group_size': group_size, 'max_group': max_group,
+        'pyramid': pyramid, 'native_resolution': native_resolution, 'dem_res': list(DEM_RES),
+    })
+
+    try:
+        groups = group_parcels(read_parcels(parcels, layer, id_field), group_size, max_group)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    todo = [(group_id, members) for group_id, members in groups
+            if not os.path.exists(_part_path(checkpoint, group_id))]
+    logging.info("%d parcels in %d groups, %d groups to do",
+                 sum(len(members) for _, members in groups), len(groups), len(todo))
+
+    # Inherited by the workers, before GDAL first reads from S3
+    os.environ.setdefault('CPL_VSIL_CURL_CACHE_SIZE', str(CURL_CACHE_SIZE))
+    os.environ.setdefault('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR')
+
+    summarised = failed = broken = 0
+    pending = {}
+    queue = iter(todo)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # A few groups queued for each process, rather than every one
+            for group_id, members in queue:
+                future = executor.submit(summarise_group, group_id, members, checkpoint, pyramid, native_resolution)
+                pending[future] = group_id
+                if len(pending) >= workers * QUEUED_PER_WORKER:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                group_id = pending.pop(future)
+                try:
+                    ok, bad = future.result()
+                except Exception as e:
+                    broken += 1
+                    logging.error("Group %s failed: %s", group_id, e)
+                    continue
+                summarised += ok
+                failed += bad
+            logging.info("%d parcels summarised, %d failed", summarised, failed)
+
+    if broken:
+        raise click.ClickException("{} groups failed, run again to retry them".format(broken))
+
+    tables = defaultdict(list)
+    for group_id, _ in groups:
+        with open(_part_path(checkpoint, group_id), 'rb') as f:
+            part = pickle.load(f)
+        for name in ('landcover', 'cross_counts'):
+            if part[name] is not None:
+                tables[name].append(part[name])
+        tables['failed'].extend(part['failed'])
+
+    def ordered(frames):
+        table = pd.concat(frames, ignore_index=True)
+        return table[['parcel'] + [column for column in table.columns if column != 'parcel']]
+
+    if tables['cross_counts']:
+        write_table(ordered(tables['cross_counts']), output)
+        write_table(ordered(tables['landcover']), _suffixed(output, 'landcover'))
+    if tables['failed']:
+        pd.DataFrame(tables['failed']).to_csv(os.path.splitext(output)[0] + '_failed.csv', index=False)
+        logging.warning("%d parcels failed, delete their groups from %s to retry them",
+                        len(tables['failed']), checkpoint)
+    logging.info("Wrote %s", output)
+
+
+if __name__ == "__main__":
+    main()
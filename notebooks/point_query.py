@@ -0,0 +1,128 @@
+"""
+Values of products at a point, read straight from the files, for pixel drills.
+
+Rather than loading a whole area up front and picking pixels out of it, each
+query finds the datasets of each product that contain the point through the
+index, and reads just the pixel under it from every one of them, at its own
+resolution. Only the block holding that pixel is fetched. The reads for all
+the products and times go on at once in a pool of threads.
+"""
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import rasterio
+from datacube.storage import BandInfo
+from datacube.utils import geometry
+from rasterio.warp import transform
+from rasterio.windows import Window
+
+# Threads reading pixels at once
+READ_WORKERS = 16
+
+# GDAL options for reading a pixel or two from COGs on S3
+GDAL_OPTIONS = dict(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff')
+
+COLUMNS = ['product', 'measurement', 'time', 'value', 'nodata', 'x', 'y', 'crs', 'dataset', 'uri']
+
+_executor = None
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=READ_WORKERS)
+    return _executor
+
+
+def point_datasets(dc, product, point, **query):
+    """Datasets of ``product`` whose footprints contain ``point``."""
+    found = []
+    for dataset in dc.find_datasets(product=product, geopolygon=point, **query):
+        if dataset.extent is None or dataset.extent.contains(point.to_crs(dataset.crs)):
+            found.append(dataset)
+    return found
+
+
+def _is_nodata(value, nodata):
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    if nodata is None:
+        return False
+    if isinstance(nodata, float) and math.isnan(nodata):
+        return False
+    return value == nodata
+
+
+def read_pixel(band, lon, lat):
+    """
+    The pixel of ``band``, a ``BandInfo``, under ``lon``, ``lat``: its
+    value, whether it is nodata, and the point in the file's CRS. The value
+    is None if the point is outside the file.
+    """
+    with rasterio.Env(**GDAL_OPTIONS):
+        with rasterio.open(band.uri) as src:
+            (x,), (y,) = transform('EPSG:4326', src.crs, [lon], [lat])
+            row, col = src.index(x, y)
+            if not (0 <= row < src.height and 0 <= col < src.width):
+                return None, True, x, y
+            value = src.read(band.band or 1, window=Window(col, row, 1, 1))[0, 0].item()
+            nodata = src.nodata if src.nodata is not None else band.nodata
+    return value, _is_nodata(value, nodata), x, y
+
+
+def query_point(dc, products, lon, lat, measurements=None, **query):
+    """
+    Values of ``products`` at ``lon``, ``lat``, from every dataset that has
+    the point, at every time.
+
+    :param products: Names of the products to read.
+    :param measurements: Measurements to read of each product, all of them
+        by default.
+    :param query: More search terms for the datasets, such as ``time``.
+    :return: A DataFrame with a row for each product, measurement and time,
+        with the value of the pixel and whether it is nodata, the point in
+        the CRS of the dataset and the dataset and file it was read from. When
+        datasets overlap at the point, the first with data is used, as
+        ``dc.load`` does.
+    """
+    point = geometry.point(lon, lat, geometry.CRS('EPSG:4326'))
+
+    reads = []
+    for product in products:
+        for dataset in point_datasets(dc, product, point, **query):
+            for measurement in measurements or list(dataset.type.measurements):
+                reads.append((product, measurement, dataset, BandInfo(dataset, measurement)))
+
+    futures = [_pool().submit(read_pixel, band, lon, lat) for product, measurement, dataset, band in reads]
+    records = []
+    for (product, measurement, dataset, band), future in zip(reads, futures):
+        try:
+            value, nodata, x, y = future.result()
+        except Exception as e:
+            logging.warning("Couldn't read %s: %s", band.uri, e)
+            continue
+        if value is None:
+            continue
+        records.append({
+            'product': product,
+            'measurement': measurement,
+            'time': pd.Timestamp(dataset.center_time),
+            'value': value,
+            'nodata': nodata,
+            'x': x,
+            'y': y,
+            'crs': str(dataset.crs),
+            'dataset': str(dataset.id),
+            'uri': band.uri,
+        })
+
+    table = pd.DataFrame.from_records(records, columns=COLUMNS)
+    if table.empty:
+        return table
+    # Data before nodata, then one row for each product, measurement and time
+    table['order'] = table['product'].map({product: i for i, product in enumerate(products)})
+    table = table.sort_values(['order', 'measurement', 'time', 'nodata'], kind='mergesort')
+    table = table.drop_duplicates(['product', 'measurement', 'time']).drop(columns='order')
+    return table.reset_index(drop=True)
@@ -0,0 +1,248 @@
+"""
+Loading products for a polygon rather than for its bounding box.
+
+All the products of one query are loaded onto one GeoBox. The polygon is
+rasterized once for each GeoBox and the mask kept for the next product.
+Datasets that don't touch the polygon aren't loaded at all, and chunks that
+don't touch it are never read: they are replaced by chunks of NaN before
+anything is computed. The chunks that are left are masked as they load.
+
+Pixels outside the polygon are NaN, which makes floats of categorical
+products. With ``keep_dtype`` they are set to the product's integer nodata
+instead, and the product stays in its own dtype, a half to an eighth of the
+memory. A ``memory_budget`` either chooses the chunks to load in or stops a
+load that won't fit before anything is read.
+"""
+import json
+from collections import OrderedDict
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+from datacube.utils import geometry
+from rasterio import features
+
+from memory_budget import budget_chunks, check_budget
+
+# GeoBoxes whose masks are kept, most recently used last
+MASK_CACHE_SIZE = 8
+_mask_cache = OrderedDict()
+
+# Fraction of a polygon that can be left uncovered, for the slivers that
+# reprojecting extents leaves along their edges
+SLIVER_FRACTION = 1e-6
+
+
+def query_geobox(x_range, y_range, crs, resolution):
+    """
+    The GeoBox ``dc.load`` would load ``x_range`` and ``y_range`` onto, for
+    products at ``resolution`` in ``crs``, so that several of them can share
+    it.
+    """
+    bounds = geometry.box(min(x_range), min(y_range), max(x_range), max(y_range), crs=crs)
+    return geometry.GeoBox.from_geopolygon(bounds, resolution, crs=crs)
+
+
+def polygon_mask(geom, geobox, all_touched=False):
+    """
+    Pixels of ``geobox`` inside ``geom``, a GeoJSON geometry in the GeoBox's
+    CRS, as a read only boolean array. Masks are cached by polygon and
+    GeoBox, so each one is only rasterized once.
+    """
+    key = (json.dumps(geom, sort_keys=True), tuple(geobox.affine), geobox.shape, str(geobox.crs), all_touched)
+    if key in _mask_cache:
+        _mask_cache.move_to_end(key)
+        return _mask_cache[key]
+
+    mask = features.geometry_mask(
+        [geom],
+        out_shape=geobox.shape,
+        transform=geobox.affine,
+        all_touched=all_touched,
+        invert=True
+    )
+    mask.flags.writeable = False
+    _mask_cache[key] = mask
+    while len(_mask_cache) > MASK_CACHE_SIZE:
+        _mask_cache.popitem(last=False)
+    return mask
+
+
+def dilate(mask, pixels):
+    """Grow ``mask`` by ``pixels`` in every direction, diagonals included."""
+    grown = mask.copy()
+    for i in range(pixels):
+        rows = grown.copy()
+        rows[1:] |= grown[:-1]
+        rows[:-1] |= grown[1:]
+        grown = rows.copy()
+        grown[:, 1:] |= rows[:, :-1]
+        grown[:, :-1] |= rows[:, 1:]
+    return grown
+
+
+def _offsets(chunks):
+    return np.cumsum((0,) + chunks[:-1])
+
+
+def integer_nodata(dtype, nodata):
+    """
+    A nodata value for an integer ``dtype``: ``nodata`` if it is a whole
+    number the dtype holds, otherwise the dtype's largest value if unsigned
+    and its smallest if signed, for products that declare NaN.
+    """
+    info = np.iinfo(dtype)
+    if nodata is not None and np.isfinite(nodata) and float(nodata).is_integer() and info.min <= nodata <= info.max:
+        return int(nodata)
+    return int(info.max if info.min == 0 else info.min)
+
+
+def valid_mask(array):
+    """
+    Pixels of ``array`` with data, as a boolean DataArray: not NaN, and not
+    its ``nodata`` attribute.
+    """
+    valid = array == array if np.issubdtype(array.dtype, np.floating) else xr.ones_like(array, dtype=bool)
+    nodata = array.attrs.get('nodata')
+    if nodata is not None and not (isinstance(nodata, float) and np.isnan(nodata)):
+        valid &= array != nodata
+    return valid
+
+
+def clip_to_mask(array, mask, nodata=None):
+    """
+    Set the pixels of ``array`` outside ``mask`` to NaN, like
+    ``array.where(mask)``. Dask chunks wholly outside the mask are replaced,
+    so they are never loaded, and the rest are masked as they are computed.
+    The last two dimensions of ``array`` are the ones ``mask`` covers.
+
+    :param nodata: Set them to this instead, keeping the dtype of ``array``.
+    """
+    if nodata is None:
+        dtype = np.promote_types(array.dtype, np.float32)
+        fill = np.nan
+    else:
+        dtype = array.dtype
+        fill = dtype.type(nodata)
+    data = array.data
+    if not isinstance(data, da.Array):
+        return array.copy(data=np.where(mask, data, fill).astype(dtype, copy=False))
+
+    y_chunks, x_chunks = data.chunks[-2:]
+    leading = (slice(None),) * (data.ndim - 2)
+    rows = []
+    for i, (y, height) in enumerate(zip(_offsets(y_chunks), y_chunks)):
+        row = []
+        for j, (x, width) in enumerate(zip(_offsets(x_chunks), x_chunks)):
+            block_mask = mask[y:y + height, x:x + width]
+            block = data.blocks[leading + (i, j)]
+            if not block_mask.any():
+                row.append(da.full(block.shape, fill, dtype=dtype, chunks=block.chunks))
+            elif block_mask.all():
+                row.append(block.astype(dtype))
+            else:
+                row.append(da.where(block_mask, block, fill).astype(dtype))
+        rows.append(row)
+    return array.copy(data=da.block(rows))
+
+
+def polygon_datasets(dc, product, geom, crs):
+    """
+    Datasets of ``product`` that touch ``geom``, a GeoJSON geometry in
+    ``crs``, rather than only its bounding box.
+    """
+    polygon = geometry.Geometry(geom, crs=crs)
+    return [
+        dataset for dataset in dc.find_datasets(product=product, geopolygon=polygon)
+        if dataset.extent is None or dataset.extent.to_crs(crs).intersects(polygon)
+    ]
+
+
+def uncovered(datasets, geom, crs):
+    """
+    The part of ``geom``, a GeoJSON geometry in ``crs``, outside the extents
+    of ``datasets``, as a GeoJSON geometry, or None if they cover all of it.
+    Datasets whose extent isn't known are taken to cover none of it.
+    """
+    polygon = geometry.Geometry(geom, crs=crs)
+    extents = [dataset.extent.to_crs(crs) for dataset in datasets if dataset.extent is not None]
+    remaining = polygon.difference(geometry.unary_union(extents)) if extents else polygon
+    if remaining.is_empty or remaining.area <= polygon.area * SLIVER_FRACTION:
+        return None
+    return remaining.json
+
+
+def overlaps(datasets, geom, crs):
+    """
+    Whether the extents of ``datasets`` overlap ``geom``, a GeoJSON geometry
+    in ``crs``, by more than a sliver, unlike extents that only touch it along
+    an edge. Datasets whose extent isn't known are taken to overlap it.
+    """
+    if any(dataset.extent is None for dataset in datasets):
+        return True
+    if not datasets:
+        return False
+    polygon = geometry.Geometry(geom, crs=crs)
+    extents = geometry.unary_union(dataset.extent.to_crs(crs) for dataset in datasets)
+    return polygon.intersection(extents).area > polygon.area * SLIVER_FRACTION
+
+
+def load_polygon(dc, product, geom, geobox, dask_chunks, halo=0, all_touched=False, mask=None, keep_dtype=False,
+                 memory_budget=None, datasets=None, **kwargs):
+    """
+    Load ``product`` onto ``geobox``, for ``geom`` only.
+
+    :param geom: GeoJSON geometry of the polygon, in the GeoBox's CRS.
+    :param geobox: GeoBox to load onto, shared by every product in the query,
+        e.g. from ``query_geobox``.
+    :param dask_chunks: Chunks to load in, as for ``dc.load``, or ``'auto'``
+        to choose them from ``memory_budget``.
+    :param halo: Keep this many pixels around the polygon, for anything that
+        needs neighbouring pixels, such as slope.
+    :param all_touched: Keep every pixel the polygon touches, rather than
+        only those whose centres are inside it.
+    :param mask: Boolean array of the pixels of ``geobox`` to keep, instead
+        of those of the polygon. Chunks with none of them aren't read.
+    :param keep_dtype: Keep integer measurements in their own dtype, with
+        their nodata outside the polygon rather than NaN.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, the loaded
+        data may take. Without ``dask_chunks`` a load that needs more raises
+        a ``MemoryError`` before anything is read.
+    :param datasets: The datasets to load, if they have already been found
+        with ``polygon_datasets``.
+    :param kwargs: Passed on to ``dc.load``, such as ``measurements``.
+    :return: The Dataset from ``dc.load``, with NaN, or nodata with
+        ``keep_dtype``, for pixels outside the polygon and ``halo``.
+    """
+    if dask_chunks == 'auto' and memory_budget is None:
+        raise ValueError("dask_chunks='auto' needs a memory_budget to choose them from")
+    if datasets is None:
+        datasets = polygon_datasets(dc, product, geom, geobox.crs)
+
+    if memory_budget is not None and datasets:
+        measurements = datasets[0].type.lookup_measurements(kwargs.get('measurements')).values()
+        dtypes = [
+            m.dtype if keep_dtype and np.issubdtype(m.dtype, np.integer) else np.promote_types(m.dtype, np.float32)
+            for m in measurements
+        ]
+        if dask_chunks == 'auto':
+            dask_chunks = budget_chunks(geobox.shape, dtypes, memory_budget)
+        elif dask_chunks is None:
+            check_budget(geobox.shape, dtypes, memory_budget,
+                         times=len({dataset.center_time for dataset in datasets}))
+    data = dc.load(product=product, datasets=datasets, like=geobox, dask_chunks=dask_chunks, **kwargs)
+
+    if mask is None:
+        mask = polygon_mask(geom, geobox, all_touched=all_touched)
+    if halo:
+        mask = dilate(mask, halo)
+
+    def clip(variable):
+        if keep_dtype and np.issubdtype(variable.dtype, np.integer):
+            nodata = integer_nodata(variable.dtype, variable.attrs.get('nodata'))
+            clipped = clip_to_mask(variable, mask, nodata=nodata)
+            clipped.attrs['nodata'] = nodata
+            return clipped
+        return clip_to_mask(variable, mask)
+
+    return data.assign({name: clip(variable) for name, variable in data.data_vars.items()})
@@ -0,0 +1,190 @@
+"""
+Cache of polygon summaries, so drawing the same parcel again, or running the
+same query in a new session, doesn't load and count the rasters again.
+
+Results are kept in memory, least recently used first out, and optionally
+pickled to a directory as well. Keys come from ``cache_key``: the polygon,
+normalized so the same shape drawn from a different starting vertex or in
+the other direction hashes the same, the products and resolution, any other
+parameters, and the versions of the datasets the polygon touches, so
+re-indexing or archiving one of them misses the old entries.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from datacube.utils import geometry
+
+# Decimal places polygon coordinates are rounded to, a centimetre in metres
+COORDINATE_DECIMALS = 2
+
+
+def _normalize_ring(ring, decimals):
+    points = [tuple(round(float(value), decimals) for value in point[:2]) for point in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    if not points:
+        return []
+    # Counter-clockwise, by the sign of the shoelace area
+    area = sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]))
+    if area < 0:
+        points.reverse()
+    start = points.index(min(points))
+    return points[start:] + points[:start]
+
+
+def normalize_geometry(geom, decimals=COORDINATE_DECIMALS):
+    """
+    A canonical form of a GeoJSON Polygon or MultiPolygon: coordinates
+    rounded, every ring counter-clockwise and starting from its lowest
+    vertex, and the polygons of a MultiPolygon sorted.
+    """
+    if geom['type'] == 'Polygon':
+        polygons = [geom['coordinates']]
+    elif geom['type'] == 'MultiPolygon':
+        polygons = geom['coordinates']
+    else:
+        raise ValueError("Expected a Polygon or MultiPolygon, got {}".format(geom['type']))
+
+    normalized = sorted(
+        [_normalize_ring(ring, decimals) for ring in polygon[:1]]
+        + sorted(_normalize_ring(ring, decimals) for ring in polygon[1:])
+        for polygon in polygons
+    )
+    return {'type': 'MultiPolygon', 'coordinates': normalized}
+
+
+def dataset_versions(dc, products, geom, crs):
+    """
+    A token for the state of the datasets of ``products`` that ``geom``
+    touches. It changes when any of them is added, re-indexed with a new
+    document or location, or archived.
+    """
+    polygon = geometry.Geometry(geom, crs=crs)
+    versions = []
+    for product in products:
+        for dataset in dc.find_datasets(product=product, geopolygon=polygon):
+            document = json.dumps(dataset.metadata_doc, sort_keys=True, default=str)
+            versions.append((
+                str(dataset.id),
+                str(getattr(dataset, 'indexed_time', None)),
+                str(getattr(dataset, 'archived_time', None)),
+                sorted(dataset.uris or []),
+                hashlib.sha1(document.encode('utf8')).hexdigest(),
+            ))
+    return hashlib.sha1(json.dumps(sorted(versions)).encode('utf8')).hexdigest()
+
+
+def cache_key(geom, products, resolution, versions, **params):
+    """
+    Key for the result of a query over ``geom``. ``params`` are anything
+    else the result depends on, and must be JSON serializable.
+    """
+    key = {
+        'geometry': normalize_geometry(geom),
+        'products': sorted(products),
+        'resolution': list(resolution),
+        'versions': versions,
+        'params': params,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Bounded least recently used cache, in memory and optionally on disk.
+
+    :param maxsize: Most results kept in memory.
+    :param directory: Directory to also pickle results to, so they outlive
+        the session. Off by default.
+    :param disk_maxsize: Most results kept in ``directory``.
+    """
+
+    def __init__(self, maxsize=32, directory=None, disk_maxsize=1024):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.disk_maxsize = disk_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = self._read(key) if self.directory else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        if self.directory:
+            self._write(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Dropping unreadable cache entry %s: %s", path, e)
+            os.remove(path)
+            return None
+        # Most recently used on disk too
+        os.utime(path)
+        return value
+
+    def _write(self, key, value):
+        path = self._path(key)
+        staging = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(staging, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging, path)
+
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if name.endswith('.pkl')]
+        if len(entries) > self.disk_maxsize:
+            entries.sort(key=os.path.getmtime)
+            for stale in entries[:len(entries) - self.disk_maxsize]:
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
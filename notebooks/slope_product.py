@@ -0,0 +1,231 @@
+"""
+Slope categories for the whole extent of the ``dem`` product, worked out once
+and written out as Cloud Optimized GeoTIFFs to index as the ``slope_category``
+product, so the widget only has to read and count them.
+
+The extent is cut into square tiles on the grid the widget loads onto, and
+each tile is worked out in its own process. A tile reads the DEM with a one
+pixel halo from its neighbours, so slope along its edges is what it would be
+for the whole DEM in memory, and the halo is dropped again before writing.
+Tiles with no DEM at all aren't written, and tiles already written are
+skipped, so an interrupted run carries on where it stopped. With
+``--bucket``, a tile is only done once it is in the bucket, and tiles that
+were written but not uploaded are uploaded without working them out again.
+
+    python3 slope_product.py --output /notebooks/slope_category -w 8
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import boto3
+import click
+import datacube
+import numpy as np
+import rasterio
+from affine import Affine
+from datacube.utils import geometry
+from datacube.utils.masking import mask_invalid_data
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copy_raster
+
+from widget_func import SLOPE_BREAKS, SLOPE_NODATA, SLOPE_PRODUCT, classify_slope, get_slope
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+# The grid the widget loads the DEM onto
+CRS = 'EPSG:3577'
+RESOLUTION = (-5, 5)
+
+# Pixels along each side of a tile, and of the blocks inside it
+TILE_SIZE = 4096
+BLOCK_SIZE = 512
+
+# The slope the product is classified from, as in get_slope_raster
+KERNEL = 'gradient'
+
+# One connection to the index in each worker process
+_dc = None
+
+
+def _datacube():
+    global _dc
+    if _dc is None:
+        _dc = datacube.Datacube(app='slope-category')
+    return _dc
+
+
+def tile_geobox(col, row, crs=CRS, resolution=RESOLUTION, tile_size=TILE_SIZE, halo=0):
+    """
+    GeoBox of the tile at ``col`` and ``row``, counted east and south from
+    the origin of ``crs``, grown by ``halo`` pixels on every side.
+    """
+    res_y, res_x = resolution
+    affine = Affine(res_x, 0, (col * tile_size - halo) * res_x,
+                    0, res_y, (row * tile_size - halo) * res_y)
+    return geometry.GeoBox(tile_size + 2 * halo, tile_size + 2 * halo, affine, geometry.CRS(crs))
+
+
+def dem_tiles(dc, product='dem', crs=CRS, resolution=RESOLUTION, tile_size=TILE_SIZE):
+    """Columns and rows of the tiles that overlap a dataset of ``product``."""
+    res_y, res_x = resolution
+    tiles = set()
+    for dataset in dc.find_datasets(product=product):
+        if dataset.extent is None:
+            continue
+        left, bottom, right, top = dataset.extent.to_crs(crs).boundingbox
+        cols = range(int(left // (res_x * tile_size)), int(np.ceil(right / (res_x * tile_size))))
+        rows = range(int(top // (res_y * tile_size)), int(np.ceil(bottom / (res_y * tile_size))))
+        tiles.update((col, row) for col in cols for row in rows)
+    return sorted(tiles, key=lambda tile: (tile[1], tile[0]))
+
+
+def tile_name(col, row):
+    # No four digit runs, which index-cogs-live.py would take for a year
+    return '{}_x{:03d}_y{:03d}.tif'.format(SLOPE_PRODUCT, col, row)
+
+
+def slope_categories(dc, geobox, product='dem'):
+    """
+    Slope categories of ``geobox``, as uint8 with ``SLOPE_NODATA`` where
+    there is no DEM, or None if there is no DEM there at all.
+    """
+    # The halo comes from the neighbouring tiles' DEM
+    halo_box = geometry.GeoBox(geobox.width + 2, geobox.height + 2,
+                               geobox.affine * Affine.translation(-1, -1), geobox.crs)
+    data = dc.load(product=product, like=halo_box, measurements=['band1'])
+    if not data.data_vars:
+        return None
+
+    dem = mask_invalid_data(data).band1.isel(time=0).values
+    if np.isnan(dem).all():
+        return None
+    res_x, res_y = geobox.affine.a, geobox.affine.e
+    slope = get_slope(dem, res_y, res_x, kernel=KERNEL)[1:-1, 1:-1]
+    category = classify_slope(slope, breaks=SLOPE_BREAKS, nodata=SLOPE_NODATA)
+    if (category == SLOPE_NODATA).all():
+        return None
+    return category
+
+
+def write_cog(path, data, geobox, nodata):
+    """
+    Write ``data`` over ``geobox`` as a tiled, compressed GeoTIFF with mode
+    overviews, laid out as a COG, through a staging file so that a
+    half-written tile is never left at ``path``.
+    """
+    options = dict(tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                   compress='deflate', predictor=2, zlevel=6)
+    profile = dict(driver='GTiff', width=geobox.width, height=geobox.height, count=1,
+                   dtype=data.dtype.name, nodata=nodata, crs=str(geobox.crs), transform=geobox.affine,
+                   **options)
+    factors = []
+    while min(geobox.shape) // (2 ** (len(factors) + 1)) >= BLOCK_SIZE // 2:
+        factors.append(2 ** (len(factors) + 1))
+
+    staging = path + '.staging.tif'
+    with rasterio.open(staging, 'w', **profile) as dst:
+        dst.write(data, 1)
+        dst.update_tags(kernel=KERNEL, breaks=','.join(str(b) for b in SLOPE_BREAKS))
+        if factors:
+            dst.build_overviews(factors, Resampling.mode)
+    # Copying with the overviews puts the header and IFDs at the front
+    copy_raster(staging, path + '.tmp', driver='GTiff', copy_src_overviews=True, **options)
+    os.remove(staging)
+    os.replace(path + '.tmp', path)
+
+
+def process_tile(col, row, output, product='dem'):
+    """
+    Work out and write one tile. Returns its path, or None if there is no
+    DEM there.
+    """
+    path = os.path.join(output, tile_name(col, row))
+    geobox = tile_geobox(col, row)
+    category = slope_categories(_datacube(), geobox, product=product)
+    if category is None:
+        return None
+    write_cog(path, category, geobox, SLOPE_NODATA)
+    return path
+
+
+def uploaded_tiles(s3, bucket, prefix):
+    """Names of the tiles already under ``prefix`` in ``bucket``."""
+    names = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        names.update(obj['Key'][len(prefix):] for obj in page.get('Contents', []))
+    return names
+
+
+@click.command(help="Work out slope categories for the whole DEM, as COGs for the slope_category product")
+@click.option(
+    '--output', '-o', required=True, type=click.Path(file_okay=False),
+    help="Directory to write the tiles to")
+@click.option(
+    '--workers', '-w', default=os.cpu_count(), type=click.IntRange(min=1),
+    help="Number of processes working out tiles")
+@click.option(
+    '--product', default='dem', help="The DEM product to work from")
+@click.option(
+    '--bucket', help="Also upload each tile to this bucket, for index-cogs-live.py to index")
+@click.option(
+    '--prefix', '-p', default='slim-odc-datasets/slope_category/',
+    help="Prefix to upload the tiles under")
+@click.option(
+    '--overwrite', is_flag=True, help="Work out tiles that have already been written again")
+def main(output, workers, product, bucket, prefix, overwrite):
+    os.makedirs(output, exist_ok=True)
+    # Closed again before the workers start, which open their own
+    with datacube.Datacube(app='slope-category') as dc:
+        tiles = dem_tiles(dc, product=product)
+
+    s3 = boto3.client('s3') if bucket else None
+    written = empty = failed = 0
+
+    def upload(path):
+        nonlocal failed
+        try:
+            s3.upload_file(path, bucket, prefix + os.path.basename(path))
+        except Exception as e:
+            failed += 1
+            logging.error("Uploading %s failed: %s", path, e)
+
+    unsent = set()
+    if not overwrite:
+        # Tiles only count once they are where they will be indexed from
+        done = uploaded_tiles(s3, bucket, prefix) if s3 is not None else set(os.listdir(output))
+        tiles = [tile for tile in tiles if tile_name(*tile) not in done]
+        if s3 is not None:
+            unsent = {tile for tile in tiles if os.path.exists(os.path.join(output, tile_name(*tile)))}
+            tiles = [tile for tile in tiles if tile not in unsent]
+    if unsent:
+        logging.info("Uploading %d tiles written by an earlier run", len(unsent))
+        for tile in sorted(unsent):
+            upload(os.path.join(output, tile_name(*tile)))
+    logging.info("Working out %d tiles in %d processes", len(tiles), workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_tile, col, row, output, product): (col, row) for col, row in tiles}
+        for future in as_completed(futures):
+            try:
+                path = future.result()
+            except Exception as e:
+                failed += 1
+                logging.error("Tile %s failed: %s", futures[future], e)
+                continue
+            if path is None:
+                empty += 1
+                continue
+            written += 1
+            if s3 is not None:
+                upload(path)
+            if written % 100 == 0:
+                logging.info("%d of %d tiles written", written, len(tiles))
+
+    logging.info("%d tiles written, %d with no DEM, %d failed", written, empty, failed)
+    if failed:
+        raise click.ClickException("{} tiles or uploads failed, run again to retry them".format(failed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Products that share a grid, such as the nine Land Soil Capability layers,
+loaded in one pass into one Dataset with a variable for each product.
+
+Loading them one ``dc.load`` at a time, renaming the band and merging the
+results searches the index, works out the output grid and allocates a
+Dataset for every product, and the merge copies them all again. Here the
+datasets of every product are found up front, the GeoBox is worked out once
+for all of them, and one Dataset is allocated for every product and time.
+Each file is then read once, straight into its product's slice of that
+Dataset, with the reads for all the products going on at once in a pool of
+threads.
+
+Every product keeps its own dtype. Integer products that declare a NaN
+nodata, which an integer can't hold, get an integer one instead, from
+``polygon_load.integer_nodata``. Loads too big for memory can be checked
+against a budget before anything is read, or loaded lazily in dask chunks,
+which the budget can choose.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+from datacube import Datacube
+from datacube.api.core import output_geobox
+from datacube.api.query import query_group_by
+from datacube.drivers import new_datasource
+from datacube.storage import BandInfo, reproject_and_fuse
+
+from memory_budget import budget_chunks, check_budget
+from polygon_load import integer_nodata
+
+# The Land Soil Capability layers, all int16 on the same 20 m grid
+LSC_PRODUCTS = ('acid', 'lsc_overmod', 'mass', 'salinity', 'shallow_rock',
+                'structure', 'water', 'waterlog', 'wind_erosion')
+
+# The Environmentally Sensitive Land layers, int16 flags on the same grid
+EPI_PRODUCTS = ('esl', 'flood', 'frga', 'her')
+
+# Threads reading files at once
+READ_WORKERS = 8
+
+
+def stacked_measurements(dc, products, measurement='band1'):
+    """
+    ``measurement`` of each of ``products``, and the same renamed after its
+    product, as the variables of the stacked Dataset, with an integer nodata
+    for integer products.
+    """
+    measurements = OrderedDict()
+    for name in products:
+        product = dc.index.products.get_by_name(name)
+        if product is None:
+            raise ValueError("No product {}".format(name))
+        source = product.lookup_measurements([measurement])[measurement]
+        variable = source.copy()
+        variable['name'] = name
+        if np.issubdtype(variable.dtype, np.integer):
+            variable['nodata'] = integer_nodata(variable.dtype, variable.nodata)
+        measurements[name] = (product, source, variable)
+    return measurements
+
+
+def _fuse(dest, datasets, geobox, source, variable):
+    sources = [new_datasource(BandInfo(dataset, source.name)) for dataset in datasets]
+    reproject_and_fuse(sources, dest, geobox, dest.dtype.type(variable.nodata),
+                       resampling=source.get('resampling_method', 'nearest'),
+                       fuse_func=source.get('fuser'))
+
+
+def _fuse_chunk(datasets, geobox, source, variable):
+    dest = np.full(geobox.shape, variable.nodata, dtype=variable.dtype)
+    _fuse(dest, datasets, geobox, source, variable)
+    return dest
+
+
+def _lazy_variable(sources, dimension, times, geobox, chunks, source, variable, extents):
+    """A dask array of one product, a chunk of one time at a time."""
+    height, width = chunks
+    ys, xs = range(0, geobox.shape[0], height), range(0, geobox.shape[1], width)
+    at_time = dict(zip(sources[dimension].values, sources.values)) if sources is not None else {}
+    layers = []
+    for time in times:
+        datasets = at_time.get(time, ())
+        rows = []
+        for y in ys:
+            row = []
+            for x in xs:
+                box = geobox[y:y + height, x:x + width]
+                # Only the datasets this chunk overlaps
+                overlapping = [dataset for dataset in datasets
+                               if extents[dataset.id] is None or extents[dataset.id].intersects(box.extent)]
+                if overlapping:
+                    chunk = dask.delayed(_fuse_chunk)(overlapping, box, source, variable)
+                    row.append(da.from_delayed(chunk, box.shape, dtype=variable.dtype))
+                else:
+                    row.append(da.full(box.shape, variable.nodata, dtype=variable.dtype))
+            rows.append(row)
+        layers.append(da.block(rows))
+    return da.stack(layers)
+
+
+def load_stacked(dc, products=LSC_PRODUCTS, measurement='band1', like=None, output_crs=None, resolution=None,
+                 align=None, workers=READ_WORKERS, dask_chunks=None, memory_budget=None, **query):
+    """
+    Load ``measurement`` of each of ``products`` onto one grid, as a Dataset
+    with a variable named after each product.
+
+    :param products: Names of the products, which should share a grid.
+    :param measurement: The measurement to load from each product.
+    :param like: Load onto the grid of this Dataset or GeoBox, as for
+        ``dc.load``.
+    :param output_crs: CRS to load onto, by default that of the first
+        product.
+    :param resolution: Pixel size along y and x, by default that of the first
+        product.
+    :param align: As for ``dc.load``.
+    :param workers: Threads reading files at once, unless loading lazily.
+    :param dask_chunks: Load lazily in chunks of this many ``y`` and ``x``
+        pixels and one time, as for ``dc.load``, or ``'auto'`` to choose them
+        from ``memory_budget``.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, the loaded
+        data may take. Without ``dask_chunks`` a load that needs more raises
+        a ``MemoryError`` before anything is read.
+    :param query: Search terms for the datasets, such as ``x``, ``y`` and
+        ``time``, and ``group_by``.
+    :return: A Dataset with a variable of each product's own dtype and
+        nodata, over the times of all of them. Times a product has no dataset
+        for are left as nodata. An empty Dataset if none of the products has
+        any data there.
+    """
+    if dask_chunks == 'auto' and memory_budget is None:
+        raise ValueError("dask_chunks='auto' needs a memory_budget to choose them from")
+    measurements = stacked_measurements(dc, products, measurement)
+    found = OrderedDict(
+        (name, dc.find_datasets(product=name, like=like, ensure_location=True, **query))
+        for name in measurements)
+    if not any(found.values()):
+        return xr.Dataset()
+
+    first_product = next(iter(measurements.values()))[0]
+    geobox = output_geobox(like=like, output_crs=output_crs, resolution=resolution, align=align,
+                           grid_spec=first_product.grid_spec,
+                           datasets=[dataset for datasets in found.values() for dataset in datasets], **query)
+
+    group_by = query_group_by(**query)
+    grouped = OrderedDict((name, dc.group_datasets(datasets, group_by))
+                          for name, datasets in found.items() if datasets)
+    # Every time any of the products has
+    dimension = group_by.dimension
+    times = np.unique(np.concatenate([sources[dimension].values for sources in grouped.values()]))
+    coords = OrderedDict([(dimension, xr.DataArray(times, dims=[dimension], coords=[times]))])
+    variables = [variable for _, _, variable in measurements.values()]
+    dtypes = [variable.dtype for variable in variables]
+
+    if dask_chunks is not None:
+        if dask_chunks == 'auto':
+            dask_chunks = budget_chunks(geobox.shape, dtypes, memory_budget)
+        chunks = tuple(dask_chunks.get(dim, size) for dim, size in zip(geobox.dimensions, geobox.shape))
+        extents = {dataset.id: dataset.extent.to_crs(geobox.crs) if dataset.extent is not None else None
+                   for datasets in found.values() for dataset in datasets}
+        lazy = {name: _lazy_variable(grouped.get(name), dimension, times, geobox, chunks, source, variable, extents)
+                for name, (_, source, variable) in measurements.items()}
+        return Datacube.create_storage(coords, geobox, variables, data_func=lambda m: lazy[m.name])
+
+    if memory_budget is not None:
+        check_budget(geobox.shape, dtypes, memory_budget, times=len(times))
+    stacked = Datacube.create_storage(coords, geobox, variables)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for name, sources in grouped.items():
+            _, source, variable = measurements[name]
+            data = stacked[name].values
+            for time, datasets in zip(sources[dimension].values, sources.values):
+                index = int(np.searchsorted(times, time))
+                futures.append(executor.submit(_fuse, data[index], datasets, geobox, source, variable))
+        for future in futures:
+            future.result()
+
+    return stacked
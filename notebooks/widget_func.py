@@ -7,12 +7,12 @@ from ipyleaflet import (
 )
 import datetime as dt
 import datacube
+from datacube.utils.masking import mask_invalid_data
 import ogr
 import osr
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import rasterio
-from rasterio import features
 import xarray as xr
 from IPython.display import display
 import warnings
@@ -20,6 +20,15 @@ import ipywidgets as widgets
 import numpy as np
 import pandas as pd
 
+from background import BackgroundRunner
+from crosstab import crosstab
+from histogram_pyramid import HistogramPyramid
+from polygon_load import (
+    clip_to_mask, load_polygon, overlaps, polygon_datasets, polygon_mask, query_geobox, uncovered
+)
+from result_cache import ResultCache, cache_key, dataset_versions
+from zonal_stats import nested_crosstab, snap_to_grid
+
 def transform_from_wgs_poly(geo_json,EPSGa):
 
     polygon = ogr.CreateGeometryFromJson(str(geo_json))
@@ -36,15 +45,88 @@ def transform_from_wgs_poly(geo_json,EPSGa):
     return polygon, eval(polygon.ExportToJson())
 
 
-def get_slope(dem, *resolution):
-    x, y = np.gradient(dem, *resolution)
+# Chunks the DEM is loaded in, so slope streams through it a block at a time
+DEM_CHUNKS = {'time': 1, 'x': 2048, 'y': 2048}
+
+SLOPE_KERNELS = ('gradient', 'horn', 'zevenbergen-thorne')
+
+
+def _slope_block(dem, dy, dx, kernel):
+    """
+    Slope in degrees of a 2D block of elevations, as float32, worked out in
+    the precision of the elevations as ``np.gradient`` does. Each pixel only
+    depends on its 3 x 3 neighbourhood. ``gradient`` uses one-sided
+    differences along the edges of the block, the others repeat the edge.
+    """
+    z = np.asarray(dem)
+    if not np.issubdtype(z.dtype, np.floating):
+        z = z.astype(np.float64)
+    if kernel == 'gradient':
+        y, x = np.gradient(z, dy, dx)
+    else:
+        p = np.pad(z, 1, mode='edge')
+        if kernel == 'horn':
+            x = ((p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2])) / (8 * dx)
+            y = ((p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:]) - (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:])) / (8 * dy)
+        else:
+            x = (p[1:-1, 2:] - p[1:-1, :-2]) / (2 * dx)
+            y = (p[2:, 1:-1] - p[:-2, 1:-1]) / (2 * dy)
 
     slope = np.arctan(np.sqrt(x*x + y*y)) * 180 / np.pi
-    xr_slope = xr.full_like(dem, slope)
+    return slope.astype(np.float32)
+
+
+def get_slope(dem, *resolution, kernel='gradient'):
+    """
+    Slope in degrees of a 2D DEM, as float32.
+
+    A dask-backed DEM stays lazy: each chunk is worked out with a one pixel
+    halo from its neighbours, so the result is exactly what it would be for
+    the whole DEM in memory, and only a few chunks are ever loaded at once.
+
+    :param dem: 2D DataArray or array of elevations, in (y, x) order.
+    :param resolution: Pixel size along y and x, as given to ``dc.load``.
+    :param kernel: ``gradient`` for central differences with ``np.gradient``,
+        one-sided along the edges of the DEM, or ``horn`` or
+        ``zevenbergen-thorne`` for those 3 x 3 kernels, as in ``gdaldem``,
+        with the edge of the DEM repeated.
+    """
+    if kernel not in SLOPE_KERNELS:
+        raise ValueError("Unknown slope kernel {!r}, expected one of {}".format(kernel, SLOPE_KERNELS))
+    dy, dx = resolution
+    data = dem.data if isinstance(dem, xr.DataArray) else dem
+
+    if hasattr(data, 'map_overlap'):
+        # No halo around the outside, where the kernels see the edge as a
+        # whole DEM in memory would
+        slope = data.map_overlap(_slope_block, depth=1, boundary='none', dtype=np.float32,
+                                 dy=dy, dx=dx, kernel=kernel)
+    else:
+        slope = _slope_block(data, dy, dx, kernel)
+
+    if not isinstance(dem, xr.DataArray):
+        return slope
+    xr_slope = dem.copy(data=slope)
+    xr_slope.attrs.pop('nodata', None)
+    xr_slope.attrs['units'] = 'degree'
     return xr_slope
 
 
+# Lower bound in degrees of every slope category after the first, as in
+# slope_cat.csv, and the category given to pixels with no slope
+SLOPE_BREAKS = (5, 11, 18, 26, 35)
+SLOPE_NODATA = 255
+
+# Product of slope categories worked out ahead of time by slope_product.py,
+# with SLOPE_BREAKS and the gradient kernel
+SLOPE_PRODUCT = 'slope_category'
+
+
 def slope_category(slope_degrees):
+    """
+    Slope category of one pixel. Kept as the reference for ``classify_slope``,
+    which does whole arrays at once.
+    """
     if np.isnan(slope_degrees):
         return np.nan
     if slope_degrees < 5:
@@ -60,47 +142,125 @@ def slope_category(slope_degrees):
     return 5
 
 
+def slope_breaks(slope_cat_table):
+    """
+    Category breaks from the slope category table in slope_cat.csv: the lower
+    bound of the ``range`` of every category after the first, e.g. 5 from
+    ``(5 - 10)`` and 35 from ``(> 35)``. Categories are numbered from 0.
+    """
+    table = slope_cat_table.sort_values('id')
+    if list(table['id']) != list(range(len(table))):
+        raise ValueError("Slope categories must be numbered 0 to {}".format(len(table) - 1))
+    lower = table['range'].str.extract(r'(\d+(?:\.\d+)?)', expand=False).astype(float)
+    return tuple(lower.iloc[1:])
+
+
+def _classify_block(slope, breaks, nodata):
+    category = np.digitize(slope, breaks).astype(np.uint8)
+    category[np.isnan(slope)] = nodata
+    return category
+
+
+def classify_slope(slope, breaks=SLOPE_BREAKS, nodata=SLOPE_NODATA):
+    """
+    Slope category of every pixel, the same as ``slope_category`` but as
+    uint8 with ``nodata`` where the slope is NaN. Works on numpy arrays, and
+    on dask arrays and DataArrays a chunk at a time without loading them.
+
+    :param slope: Slope in degrees.
+    :param breaks: Increasing lower bounds of categories 1, 2, ...
+    :param nodata: Category for NaN slopes, which must not be a real one.
+    """
+    breaks = np.asarray(breaks, dtype=np.float64)
+    if not 0 <= len(breaks) < nodata <= 255:
+        raise ValueError("{} breaks don't leave room for nodata {} in uint8".format(len(breaks), nodata))
+    if np.any(np.diff(breaks) <= 0):
+        raise ValueError("Slope breaks must increase: {}".format(breaks))
+
+    if isinstance(slope, xr.DataArray):
+        category = xr.apply_ufunc(
+            _classify_block, slope,
+            kwargs={'breaks': breaks, 'nodata': nodata},
+            dask='parallelized',
+            output_dtypes=[np.uint8]
+        )
+        category.attrs['nodata'] = nodata
+        return category
+    if hasattr(slope, 'map_blocks'):
+        return slope.map_blocks(_classify_block, breaks=breaks, nodata=nodata, dtype=np.uint8)
+    return _classify_block(np.asarray(slope), breaks, nodata)
+
+
 def unique_counts(dataset):
-    stacked_array = dataset.to_array().values
-    flat_array = np.reshape(stacked_array, (stacked_array.shape[0], -1))
-
-    unique_keys, counts = np.unique(flat_array, axis=1, return_counts=True)
-    valid_keys = np.isfinite(unique_keys).all(axis=0)
-    unique_keys, counts = unique_keys[:, valid_keys].astype(np.int16), counts[valid_keys]
-
-    coords = {name: ('value', vals) for name, vals in zip(dataset, unique_keys)}
-    return xr.Dataset(data_vars={'count': ('value', counts)}, coords=coords)['count']
-
-
-def get_slope_raster(dc, x_range, y_range, inputcrs, resolution, geom_selectedarea):
-    ds_dem = dc.load(
-        product='dem',
-        x=x_range,
-        y=y_range,
-        crs=inputcrs,
-        output_crs=inputcrs,
-        resolution=resolution,
-        dask_chunks={'time': 1}
-    )
+    """
+    Count the pixels with each combination of values in the variables of
+    ``dataset``. Pixels that are NaN, or equal to a variable's ``nodata``
+    attribute, aren't counted. See ``crosstab.crosstab``, which streams
+    through dask-backed data a chunk at a time.
+    """
+    return crosstab(dataset)
 
-    # Construct a mask to only select pixels within the drawn polygon
-    mask_dem = features.geometry_mask(
-        [geom_selectedarea for geoms in [geom_selectedarea]],
-        out_shape=ds_dem.geobox.shape,
-        transform=ds_dem.geobox.affine,
-        all_touched=False,
-        invert=True
-    )
 
-    # Calculate Slope category
-    slope = get_slope(ds_dem.band1.squeeze('time', drop=True), *resolution).where(mask_dem)
-    slope_cat = xr.apply_ufunc(slope_category, slope, vectorize=True, dask='parallelized', output_dtypes=[np.float32])
+def has_slope_product(dc):
+    """Whether ``SLOPE_PRODUCT`` has been added to the index."""
+    return dc.index.products.get_by_name(SLOPE_PRODUCT) is not None
+
+
+def get_slope_raster(dc, x_range, y_range, inputcrs, resolution, geom_selectedarea,
+                     breaks=SLOPE_BREAKS, kernel='gradient', chunks=DEM_CHUNKS, geobox=None,
+                     precomputed=True, memory_budget=None):
+    """
+    Slope categories of the pixels inside ``geom_selectedarea``, with
+    ``SLOPE_NODATA`` outside it.
+
+    They are read from ``SLOPE_PRODUCT`` when it holds the categories asked
+    for and has been indexed for every part of the polygon the DEM has.
+    Otherwise they are worked out from the DEM, reading only the parts of it
+    within a pixel of the polygon, with its nodata left out as
+    ``slope_product`` leaves it out.
+
+    :param geobox: GeoBox to load onto, shared with the other products of the
+        query. By default the one ``dc.load`` would use for the ranges.
+    :param precomputed: Read ``SLOPE_PRODUCT`` if it can be used. Turn it off
+        to always work slope out from the DEM.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, to choose the
+        chunks from instead of ``chunks``, as for ``load_polygon``.
+    """
+    if geobox is None:
+        geobox = query_geobox(x_range, y_range, inputcrs, resolution)
+    if memory_budget is not None:
+        chunks = 'auto'
+
+    if (precomputed and tuple(breaks) == SLOPE_BREAKS and kernel == 'gradient'
+            and has_slope_product(dc)):
+        slope_datasets = polygon_datasets(dc, SLOPE_PRODUCT, geom_selectedarea, geobox.crs)
+        missing = uncovered(slope_datasets, geom_selectedarea, geobox.crs)
+        # slope_product skips tiles without any DEM, so a gap only matters where there is DEM
+        if missing is not None and overlaps(polygon_datasets(dc, 'dem', missing, geobox.crs), missing, geobox.crs):
+            slope_datasets = []
+        if slope_datasets:
+            ds_slope = load_polygon(dc, SLOPE_PRODUCT, geom_selectedarea, geobox, dask_chunks=chunks,
+                                    keep_dtype=True, memory_budget=memory_budget, datasets=slope_datasets)
+            # Still uint8, with SLOPE_NODATA outside the polygon
+            slope_cat = ds_slope.band1.squeeze('time', drop=True)
+            slope_cat.name = 'slope_category'
+            return slope_cat
+
+    # Slope needs the pixels just outside the polygon too
+    ds_dem = mask_invalid_data(load_polygon(dc, 'dem', geom_selectedarea, geobox, dask_chunks=chunks, halo=1,
+                                            memory_budget=memory_budget))
+
+    # Calculate Slope category, only for pixels within the drawn polygon
+    slope = get_slope(ds_dem.band1.squeeze('time', drop=True), *resolution, kernel=kernel)
+    slope = clip_to_mask(slope, polygon_mask(geom_selectedarea, geobox))
+    slope_cat = classify_slope(slope, breaks=breaks)
     slope_cat.name = 'slope_category'
 
     return slope_cat
 
 
-def get_dlcd_raster(dc, x_range, y_range, inputcrs, resolution, geom_selectedarea):
+def get_dlcd_raster(dc, x_range, y_range, inputcrs, resolution, geom_selectedarea, mask=True,
+                    chunks=DEM_CHUNKS, geobox=None, memory_budget=None):
     """
 
     :param x_range: tuple() of x values
@@ -108,34 +268,196 @@ def get_dlcd_raster(dc, x_range, y_range, inputcrs, resolution, geom_selectedare
     :param inputcrs: crs of x and y values
     :param resolution:
     :param geom_selectedarea:
-    :return:
+    :param mask: Set pixels outside ``geom_selectedarea`` to nodata. Leave it
+        off to keep every cell the polygon touches whole, for counting
+        against a finer masked product with ``zonal_stats.nested_crosstab``.
+    :param chunks: Chunks to load in, as for ``dc.load``.
+    :param geobox: GeoBox to load onto, shared with the other products of the
+        query. By default the one ``dc.load`` would use for the ranges.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, to choose the
+        chunks from instead of ``chunks``, as for ``load_polygon``.
+    :return: The land cover classes, as uint8 with the product's nodata
+        outside the polygon.
     """
-    ds_dlcd = dc.load(
-        product='dlcdnsw',
-        x=x_range,
-        y=y_range,
-        crs=inputcrs,
-        output_crs=inputcrs,
-        resolution=resolution,
-        dask_chunks={'time': 1}
-    )
+    if geobox is None:
+        geobox = query_geobox(x_range, y_range, inputcrs, resolution)
+    if memory_budget is not None:
+        chunks = 'auto'
 
-    mask_dlcd = features.geometry_mask(
-        [geom_selectedarea for geoms in [geom_selectedarea]],
-        out_shape=ds_dlcd.geobox.shape,
-        transform=ds_dlcd.geobox.affine,
-        all_touched=False,
-        invert=True
-    )
+    ds_dlcd = load_polygon(dc, 'dlcdnsw', geom_selectedarea, geobox, dask_chunks=chunks,
+                           all_touched=not mask, keep_dtype=True, memory_budget=memory_budget)
 
-    masked_dlcd = ds_dlcd.band1.where(mask_dlcd)
+    masked_dlcd = ds_dlcd.band1.squeeze('time', drop=True)
     masked_dlcd.name = 'dlcd'
     return masked_dlcd
 
 
-def run_valuation_app():
+def _cross_counts(dc, geom_selectedarea, x_range, y_range, inputcrs, dem_res, dlcd_res,
+                  slope_cat_breaks, native_resolution, job, memory_budget=None):
+    """Cross counts of land cover and slope category, from the pixels of the polygon."""
+    # One grid for every product loaded at the DEM's resolution
+    geobox = query_geobox(x_range, y_range, inputcrs, dem_res)
+    slope_cat = get_slope_raster(dc, x_range, y_range, inputcrs, dem_res, geom_selectedarea,
+                                 breaks=slope_cat_breaks, geobox=geobox, memory_budget=memory_budget)
+
+    if job is not None:
+        job.check()
+    if native_resolution:
+        dlcd = get_dlcd_raster(dc, x_range, y_range, inputcrs, dlcd_res, geom_selectedarea, mask=False,
+                               memory_budget=memory_budget)
+        return nested_crosstab(dlcd, slope_cat)
+    dlcd = get_dlcd_raster(dc, x_range, y_range, inputcrs, dem_res, geom_selectedarea, geobox=geobox,
+                           memory_budget=memory_budget)
+    return unique_counts(xr.merge([dlcd, slope_cat]))
+
+
+def _dlcd_counts(dc, geom_selectedarea, x_range, y_range, inputcrs, dem_res, memory_budget=None):
+    """
+    DEM pixels of each land cover class in the polygon, whether they have a
+    slope category or not, as the land cover chart has always counted them.
+    """
+    dlcd = get_dlcd_raster(dc, x_range, y_range, inputcrs, dem_res, geom_selectedarea, memory_budget=memory_budget)
+    return crosstab(dlcd.to_dataset())
+
+
+def summarise_selection(dc, geom_selectedarea, x_range, y_range, inputcrs, dem_res, dlcd_res,
+                        slope_cat_table, dlcd_lookup, native_resolution=False, job=None, pyramid=None,
+                        memory_budget=None):
+    """
+    Land cover, and land cover by slope category, of the drawn polygon.
+
+    :param dem_res: Resolution to load the DEM at, which the areas are
+        counted in.
+    :param dlcd_res: Resolution of the land cover, only used with
+        ``native_resolution``.
+    :param job: ``background.Job`` to report progress to, if any.
+    :param pyramid: ``HistogramPyramid`` to count the cells wholly inside
+        the polygon from, when it is on the grid of ``dem_res``. Only the
+        cells along the boundary are then read.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, that the
+        rasters loaded at once may take. The chunks are chosen to fit it.
+    :return: ``(pd_dlcd_output, pd_cross_counts_output)``, the area and
+        percentage of the polygon for each class and for each combination.
+    """
+    slope_cat_breaks = slope_breaks(slope_cat_table)
+
+    if native_resolution:
+        # Whole DLCD cells, with the DEM pixels nested in them
+        x_range, y_range = snap_to_grid(x_range, y_range, dlcd_res)
+
+    if (pyramid is not None and not native_resolution and pyramid.covers(inputcrs, dem_res)
+            and tuple(slope_cat_breaks) == SLOPE_BREAKS):
+        cross_counts = pyramid.crosstab(dc, geom_selectedarea)
+    else:
+        cross_counts = _cross_counts(dc, geom_selectedarea, x_range, y_range, inputcrs, dem_res, dlcd_res,
+                                     slope_cat_breaks, native_resolution, job, memory_budget=memory_budget)
+
+    if job is not None:
+        job.check()
+    dlcd_counts = _dlcd_counts(dc, geom_selectedarea, x_range, y_range, inputcrs, dem_res,
+                               memory_budget=memory_budget)
+    pd_dlcd_classcount = (
+        dlcd_counts.to_dataframe().set_index('dlcd')['count']
+        .sort_values(ascending=False).rename_axis('index').reset_index(name='counts'))
+
+    # Join dlcd counts against landcover look up table
+    pd_dlcd_coverage = pd.merge(pd_dlcd_classcount, dlcd_lookup, how="left", left_on=['index'], right_on=['id'])
+
+    # Format the counts table to keep necessary items
+    pd_dlcd_coverage['area(km^2)'] = pd_dlcd_coverage['counts'] * (dem_res[1]/1000.)**2
+    pd_dlcd_coverage['percentage_area'] = pd_dlcd_coverage['counts']/pd_dlcd_coverage['counts'].sum()*100
+
+    pd_dlcd_output = pd_dlcd_coverage[['Name', 'area(km^2)', 'percentage_area']]
+
+    # manipulate cross counts into format suitable for presentation as
+    # a table
+    pd_cross_counts = cross_counts.to_dataframe()
+    pd_cross_counts.sort_values(
+        by='count', ascending=False, inplace=True)
+    # join DLCD lookup table for DLCD class names
+    pd_cross_counts = pd.merge(
+        pd_cross_counts, dlcd_lookup, how='left', left_on=['dlcd'],
+        right_on=['id'])
+    pd_cross_counts = pd_cross_counts.rename(
+        columns={'dlcd': 'dlcd_id', 'Name': 'DLCD'})
+    # join slope category definition table for slope class names
+    pd_cross_counts = pd.merge(
+        pd_cross_counts, slope_cat_table, how='left',
+        left_on=['slope_category'], right_on=['id'])
+    pd_cross_counts['slope'] = (
+        pd_cross_counts[['label', 'range']].apply(
+            lambda x: '{} {}'.format(x[0], x[1]), axis=1))
+
+    # Format the counts table to keep necessary items
+    pd_cross_counts['area(km^2)'] = (
+        pd_cross_counts['count'] * (dem_res[1]/1000.)**2)
+    pd_cross_counts['percentage_area'] = (
+        pd_cross_counts['count']/pd_cross_counts['count'].sum()*100)
+
+    pd_cross_counts_output = (
+        pd_cross_counts[
+            ['DLCD', 'slope', 'area(km^2)', 'percentage_area']])
+
+    return pd_dlcd_output, pd_cross_counts_output
+
+
+# The grid polygons are analysed on, hard-coded to be the same as the
+# case-study data. Unless native_resolution is set, DLCD_RES is unused, as
+# the same resolution must be used when loading multiple products (to support
+# the cross count process). The smallest cell size is used as this will
+# provide the greatest accuracy.
+ANALYSIS_CRS = 'EPSG:3577'
+DEM_RES = (-5, 5)
+DLCD_RES = (-100, 100)
+
+# Goes up whenever the same query would give different results, so results
+# cached before aren't used
+RESULTS_VERSION = 2
+
+
+def polygon_ranges(geom):
+    """x and y ranges of the envelope of a GeoJSON Polygon or MultiPolygon."""
+    polygons = [geom['coordinates']] if geom['type'] == 'Polygon' else geom['coordinates']
+    points = np.array([point[:2] for polygon in polygons for ring in polygon for point in ring], dtype=float)
+    return (points[:, 0].min(), points[:, 0].max()), (points[:, 1].min(), points[:, 1].max())
+
+
+def summarise_polygon(dc, geom, slope_cat_table, dlcd_lookup, dem_res=DEM_RES, dlcd_res=DLCD_RES,
+                      native_resolution=False, job=None, pyramid=None, memory_budget=None):
+    """
+    Land cover, and land cover by slope category, of one polygon, as the
+    widget shows them for a drawn one.
+
+    :param geom: GeoJSON Polygon or MultiPolygon, in ``ANALYSIS_CRS``.
+    :return: ``(pd_dlcd_output, pd_cross_counts_output)``, as from
+        ``summarise_selection``.
+    """
+    x_range, y_range = polygon_ranges(geom)
+    return summarise_selection(
+        dc, geom, x_range, y_range, ANALYSIS_CRS, dem_res, dlcd_res, slope_cat_table, dlcd_lookup,
+        native_resolution=native_resolution, job=job, pyramid=pyramid, memory_budget=memory_budget)
+
+
+def run_valuation_app(native_resolution=False, preview_res=(-25, 25), cache=None, cache_dir=None,
+                      pyramid_dir=None, memory_budget=None):
     """
     Description of function to come
+
+    :param native_resolution: Load the land cover at its own 100 m
+        resolution, rather than at the 5 m of the DEM, and weight each cell by
+        the area of each slope category in it inside the polygon.
+    :param preview_res: Resolution of a quick first result, shown while the
+        full resolution one is computed, or None to go straight to that.
+    :param cache: ``ResultCache`` of earlier results to use, e.g. one shared
+        between several apps. By default each app has its own.
+    :param cache_dir: Directory for the default cache to keep results in
+        between sessions as well as in memory.
+    :param pyramid_dir: Directory of a pyramid of histograms built by
+        histogram_pyramid.py, to count most of a big polygon from rather
+        than its pixels. No preview is needed then.
+    :param memory_budget: Bytes, or a string such as ``'4GB'``, that the
+        rasters of a polygon may take at once, to choose the chunks they are
+        loaded in from.
     """
     # Suppress warnings
     warnings.filterwarnings('ignore')
@@ -195,6 +517,40 @@ def run_valuation_app():
 
     colour_list = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
+    # Slope categories and land cover classes
+    slope_cat_table = pd.read_csv('slope_cat.csv')
+    dlcd_lookup = pd.read_csv("dlcd.csv")
+
+    # Polygons are analysed one at a time in the background, and drawing
+    # another cancels the one in progress
+    runner = BackgroundRunner()
+
+    # Results of polygons already drawn, for as long as their datasets stay
+    # the same
+    if cache is None:
+        cache = ResultCache(directory=cache_dir)
+
+    pyramid = HistogramPyramid(pyramid_dir) if pyramid_dir else None
+
+    def show_status(line):
+        info.clear_output(wait=True)
+        info.append_stdout(line + "\n")
+
+    def show_results(pd_dlcd_output, pd_cross_counts_output, colour, note):
+        # Make the DLDC Summary plot
+        ax.clear()
+        pd_dlcd_output.plot.bar(x='Name', y='percentage_area', rot=45, ax=ax, legend=False, color=colour)
+        ax.set_xlabel("Land Cover Class")
+        ax.set_ylabel("Percentage Coverage Of Polygon")
+
+        # refresh display
+        fig_display.clear_output(wait=True)  # wait=True reduces flicker effect
+        fig_display.append_display_data(fig)
+
+        info.clear_output(wait=True)  # wait=True reduces flicker effect
+        # use to_string function to avoid truncation of results
+        info.append_stdout("{}\n{}\n".format(note, pd_cross_counts_output.to_string()))
+
     # Function to execute each time something is drawn on the map
     def handle_draw(self, action, geo_json):
         nonlocal polygon_number
@@ -203,88 +559,12 @@ def run_valuation_app():
         if geo_json['geometry']['type'] == 'Polygon':
 
             # Convert the drawn geometry to pixel coordinates
-            geom_selectedarea_flat, geom_selectedarea = transform_from_wgs_poly(
+            _, geom_selectedarea = transform_from_wgs_poly(
                 geo_json['geometry'],
-                EPSGa=3577  # hard-coded to be same as case-study data
+                EPSGa=int(ANALYSIS_CRS.split(':')[1])
             )
-
-            geom_envelope = geom_selectedarea_flat.GetEnvelope()
-            minX, maxX, minY, maxY = geom_envelope
-
-            # Insert dc.load for dem and dlcdnsw
-            x_range = (minX, maxX)
-            y_range = (minY, maxY)
-            inputcrs = "EPSG:3577"
-            dem_res = (-5, 5)
-            # dlcd_res is unused as the same res must be used when loading
-            # multiple products (to support the cross count process). The
-            # smallest cell size is used as this will provide the greatest
-            # accuracy.
-            dlcd_res = (-100, 100)  # unused
-
-            slope_cat = get_slope_raster(dc, x_range, y_range, inputcrs, dem_res, geom_selectedarea)
-            dlcd = get_dlcd_raster(dc, x_range, y_range, inputcrs, dem_res, geom_selectedarea)
-
-            stacked = xr.merge([dlcd, slope_cat])
-            cross_counts = unique_counts(stacked)
-
-            slope_cat_count = slope_cat.to_dataframe().slope_category.value_counts().rename('counts').to_frame()
-            slope_cat_count.index.name = 'index'
-            slope_cat_table = pd.read_csv('slope_cat.csv')
-            slope_coverage = pd.merge(slope_cat_count, slope_cat_table, how="left", left_on=['index'], right_on=['id'])
-
-            # Compute the total number of pixels in the masked data set
-            pix_dlcd = dlcd.count().compute().item()
-
-            # Convert dlcd to pandas and get value counts for each class
-            pd_dlcd = dlcd.to_dataframe()
-            pd_dlcd_classcount = pd_dlcd.dlcd.value_counts().reset_index(name='counts')
-
-            # Convert slope_cat to pandas and get value counts for each category
-            # pd_slope_cat_count = slope_cat.to_dataframe().band1.value_counts()
-
-            # Load DLCD land cover look-up table
-            dlcd_lookup = pd.read_csv("dlcd.csv")
-
-            # Join dlcd counts against landcover look up table
-            pd_dlcd_coverage = pd.merge(pd_dlcd_classcount, dlcd_lookup, how="left", left_on=['index'], right_on=['id'])
-
-            # Format the counts table to keep necessary items
-            pd_dlcd_coverage['area(km^2)'] = pd_dlcd_coverage['counts'] * (dem_res[1]/1000.)**2
-            pd_dlcd_coverage['percentage_area'] = pd_dlcd_coverage['counts']/pd_dlcd_coverage['counts'].sum()*100
-
-            pd_dlcd_output = pd_dlcd_coverage[['Name', 'area(km^2)', 'percentage_area']]
-
-            # manipulate cross counts into format suitable for presentation as
-            # a table
-            pd_cross_counts = cross_counts.to_dataframe()
-            pd_cross_counts.sort_values(
-                by='count', ascending=False, inplace=True)
-            # join DLCD lookup table for DLCD class names
-            pd_cross_counts = pd.merge(
-                pd_cross_counts, dlcd_lookup, how='left', left_on=['dlcd'],
-                right_on=['id'])
-            pd_cross_counts = pd_cross_counts.rename(
-                columns={'dlcd': 'dlcd_id', 'Name': 'DLCD'})
-            # join slope category definition table for slope class names
-            pd_cross_counts = pd.merge(
-                pd_cross_counts, slope_cat_table, how='left',
-                left_on=['slope_category'], right_on=['id'])
-            pd_cross_counts['slope'] = (
-                pd_cross_counts[['label', 'range']].apply(
-                    lambda x: '{} {}'.format(x[0], x[1]), axis=1))
-
-            # Format the counts table to keep necessary items
-            pd_cross_counts['area(km^2)'] = (
-                pd_cross_counts['count'] * (dem_res[1]/1000.)**2)
-            pd_cross_counts['percentage_area'] = (
-                pd_cross_counts['count']/pd_cross_counts['count'].sum()*100)
-
-            pd_cross_counts_output = (
-                pd_cross_counts[
-                    ['DLCD', 'slope', 'area(km^2)', 'percentage_area']])
-
-            # display(pd_cross_counts)
+            inputcrs = ANALYSIS_CRS
+            dem_res = DEM_RES
 
             colour = colour_list[polygon_number % len(colour_list)]
 
@@ -302,21 +582,38 @@ def run_valuation_app():
                 )
             )
 
-            # Make the DLDC Summary plot
-            ax.clear()
-            pd_dlcd_output.plot.bar(x='Name', y='percentage_area', rot=45, ax=ax, legend=False, color=colour)
-            ax.set_xlabel("Land Cover Class")
-            ax.set_ylabel("Percentage Coverage Of Polygon")
-
-            # refresh display
-            fig_display.clear_output(wait=True)  # wait=True reduces flicker effect
-            with fig_display:
-                display(fig)
-
-            info.clear_output(wait=True)  # wait=True reduces flicker effect
-            with info:
-                # use to_string function to avoid truncation of results
-                print(pd_cross_counts_output.to_string())
+            def analyse(job):
+                job.status("checking for earlier results")
+                products = ['dem', 'dlcdnsw'] + ([SLOPE_PRODUCT] if has_slope_product(dc) else [])
+                versions = dataset_versions(dc, products, geom_selectedarea, inputcrs)
+
+                def key(res):
+                    return cache_key(geom_selectedarea, products, res, versions,
+                                     dlcd_res=DLCD_RES, native_resolution=native_resolution,
+                                     results_version=RESULTS_VERSION)
+
+                # A quick look from the overviews first, then the real thing,
+                # unless that is known already
+                passes = []
+                quick = pyramid is not None and not native_resolution and pyramid.covers(inputcrs, dem_res)
+                if preview_res and not quick and cache.get(key(dem_res)) is None:
+                    passes.append((preview_res, "preview at {} m".format(preview_res[1])))
+                passes.append((dem_res, "{} m".format(dem_res[1])))
+                for res, name in passes:
+                    outputs = cache.get(key(res))
+                    if outputs is None:
+                        job.status("computing the {} result".format(name))
+                        outputs = summarise_polygon(
+                            dc, geom_selectedarea, slope_cat_table, dlcd_lookup, dem_res=res,
+                            native_resolution=native_resolution, job=job, pyramid=pyramid,
+                            memory_budget=memory_budget)
+                        cache.put(key(res), outputs)
+                    job.check()
+                    note = "Result at {} m".format(res[1]) + (
+                        ", refining..." if res != dem_res else "")
+                    show_results(*outputs, colour=colour, note=note)
+
+            runner.submit(analyse, show_status)
 
             # Iterate the polygon number before drawing another polygon
             polygon_number = polygon_number + 1
@@ -0,0 +1,94 @@
+"""
+Zonal statistics across products loaded at their own resolutions.
+
+A coarse categorical product, such as the 100 m land cover, is counted
+against a fine one, such as slope categories at 5 m, without resampling the
+coarse one to the fine grid first. The two grids have to nest: each coarse
+cell covers exactly ``ratio`` x ``ratio`` fine pixels, which ``snap_to_grid``
+sees to when both are loaded over the same snapped extent. Each coarse cell
+is then weighted by how many of its fine pixels are in each category, which
+is the area of the cell that is, so the counts are the same as they would be
+with the coarse product loaded at the fine resolution.
+"""
+import math
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from crosstab import _count_block, _merge, _merge_tree
+
+
+def snap_to_grid(x_range, y_range, resolution):
+    """
+    Grow ``x_range`` and ``y_range`` out to whole cells of ``resolution``, so
+    that a finer product loaded over them lines up with the coarse cells.
+    """
+    res_y, res_x = (abs(res) for res in resolution)
+    x_range = (math.floor(min(x_range) / res_x) * res_x, math.ceil(max(x_range) / res_x) * res_x)
+    y_range = (math.floor(min(y_range) / res_y) * res_y, math.ceil(max(y_range) / res_y) * res_y)
+    return x_range, y_range
+
+
+def nesting_ratio(coarse, fine):
+    """
+    How many fine pixels there are along each side of a coarse cell. Raises
+    ValueError if the grids don't nest.
+    """
+    ratio = fine.shape[-1] // max(coarse.shape[-1], 1)
+    if ratio < 1 or fine.shape[-2:] != (coarse.shape[-2] * ratio, coarse.shape[-1] * ratio):
+        raise ValueError("A {} grid doesn't nest in a {} grid".format(fine.shape, coarse.shape))
+
+    if isinstance(coarse, xr.DataArray) and isinstance(fine, xr.DataArray):
+        for dim in coarse.dims[-2:]:
+            if dim in coarse.coords and dim in fine.coords and coarse.sizes[dim] > 1:
+                step = float(coarse[dim][1] - coarse[dim][0])
+                # Centre of the first coarse cell, from its fine pixels
+                centre = float(fine[dim][:ratio].mean())
+                if not math.isclose(centre, float(coarse[dim][0]), abs_tol=abs(step) * 1e-6):
+                    raise ValueError("The fine grid is offset from the coarse one along {}".format(dim))
+    return ratio
+
+
+def _count_nested_block(coarse, fine, ratio, nodata):
+    """``_count_block`` for fine pixels and the coarse cells they fall in."""
+    repeated = np.repeat(np.repeat(coarse, ratio, axis=0), ratio, axis=1)
+    return _count_block(np.stack([repeated, fine]), nodata)
+
+
+def nested_crosstab(coarse, fine):
+    """
+    Count the fine pixels with each combination of a coarse category and a
+    fine one, the same as ``crosstab`` would for the coarse product resampled
+    onto the fine grid, but a chunk at a time and without resampling it.
+    Pixels that are NaN, or equal to the ``nodata`` attribute of either
+    product, aren't counted, so a fine product masked to a polygon limits the
+    counts to the part of each coarse cell inside the polygon.
+
+    :param coarse: 2D DataArray of coarse category codes.
+    :param fine: 2D DataArray of fine category codes, on a grid nested in
+        the coarse one.
+    :return: A ``count`` DataArray along ``value``, with coordinates named
+        after the two products, as ``crosstab`` gives.
+    """
+    ratio = nesting_ratio(coarse, fine)
+    nodata = (coarse.attrs.get('nodata'), fine.attrs.get('nodata'))
+
+    fine_data = fine.data
+    if isinstance(fine_data, da.Array) or isinstance(coarse.data, da.Array):
+        # Fine chunks made of whole coarse cells, and the coarse chunks to match
+        fine_data = da.asarray(fine_data)
+        fine_data = fine_data.rechunk(tuple(max(ratio, size // ratio * ratio) for size in fine_data.chunksize))
+        coarse_data = da.asarray(coarse.data).rechunk(
+            tuple(tuple(size // ratio for size in sizes) for sizes in fine_data.chunks))
+        partials = [
+            dask.delayed(_count_nested_block)(coarse_block, fine_block, ratio, nodata)
+            for coarse_block, fine_block in zip(coarse_data.to_delayed().ravel(), fine_data.to_delayed().ravel())
+        ]
+        codes, counts = dask.compute(_merge_tree(partials))[0]
+    else:
+        codes, counts = _merge(_count_nested_block(np.asarray(coarse.data), np.asarray(fine_data), ratio, nodata))
+
+    coords = {name: ('value', values) for name, values in zip([coarse.name, fine.name], codes)}
+    return xr.Dataset(data_vars={'count': ('value', counts)}, coords=coords)['count']
@@ -0,0 +1,369 @@
+"""
+Benchmark the indexers end to end on synthetic data.
+
+Generates COGs, DEM tiles, YAML documents and Landsat MTL files, puts them in
+a bucket on a local S3 stand-in, and runs each indexer against a throwaway
+database on the Postgres server from the usual DB_* environment variables:
+
+    python3 benchmark-indexers.py -n 500
+
+Each run reports files/sec, the median and 99th percentile time each file
+took to index and the peak resident memory of the indexer, and appends them
+to a history file. Runs are compared with the last one that used the same
+settings, so a change that slows things down shows up straight away. Only
+files that were indexed are counted, and the benchmark fails if any file
+wasn't.
+
+The stand-in is moto's server, started in this process, unless
+``--endpoint_url`` points at another S3 compatible store, such as MinIO.
+"""
+import csv
+import datetime
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import uuid
+from time import time
+
+import boto3
+import click
+import numpy as np
+import psycopg2
+import yaml
+
+from benchmark_data import generate
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INDEXERS = {
+    'cogs': ['index-cogs-live.py', '{bucket}', '-p', 'cogs/', '-e', '.tif', '-t', 'dlcd'],
+    'dem': ['index-dem.py', '--bucket', '{bucket}', '-p', 'dem/', '-e', '.tif', '-t', 'dem'],
+    'yaml': ['ls_public_bucket.py', '{bucket}', '-p', 'yaml/', '-s', '.yaml'],
+    'mtl': ['ls_public_bucket.py', '{bucket}', '-p', 'mtl/', '-s', 'MTL.txt'],
+}
+
+LANDSAT_BANDS = ['coastal_aerosol', 'blue', 'green', 'red', 'nir', 'swir1', 'swir2',
+                 'panchromatic', 'cirrus', 'lwir1', 'lwir2', 'quality']
+
+# A product for the documents ls_public_bucket.py makes from MTL files
+LANDSAT_PRODUCT = {
+    'name': 'benchmark_ls8_l1tp',
+    'description': 'Landsat 8 level 1 scenes, for benchmarking only',
+    'metadata_type': 'slim',
+    'metadata': {
+        'product_type': 'L1TP',
+        'platform': {'code': 'LANDSAT_8'},
+        'format': {'name': 'GeoTiff'},
+    },
+    'measurements': [
+        {'name': band, 'dtype': 'uint16', 'nodata': 0, 'units': '1'}
+        for band in LANDSAT_BANDS
+    ],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_stand_in():
+    """Start moto's S3 server on a free port and return its url and the server."""
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise click.ClickException("moto[server] is needed, or pass --endpoint_url")
+    port = free_port()
+    # One log line per request would drown out everything else
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    return 'http://127.0.0.1:{}'.format(port), server
+
+
+def s3_environment(endpoint_url):
+    """Environment that points boto3 and GDAL at the stand-in."""
+    host = endpoint_url.split('://', 1)[-1].rstrip('/')
+    return {
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_S3_ENDPOINT': host,
+        'AWS_HTTPS': 'YES' if endpoint_url.startswith('https') else 'NO',
+        'AWS_VIRTUAL_HOSTING': 'FALSE',
+        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID') or 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY') or 'benchmark',
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1',
+    }
+
+
+def upload(endpoint_url, env, bucket, directory, keys):
+    s3 = boto3.client(
+        's3', endpoint_url=endpoint_url, region_name=env['AWS_DEFAULT_REGION'],
+        aws_access_key_id=env['AWS_ACCESS_KEY_ID'], aws_secret_access_key=env['AWS_SECRET_ACCESS_KEY'])
+    try:
+        s3.create_bucket(Bucket=bucket)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    for key in keys:
+        s3.upload_file(os.path.join(directory, key), bucket, key)
+
+
+class ThrowawayDatabase(object):
+    """
+    A database created on the Postgres server named by the DB_* environment
+    variables, and dropped again afterwards.
+    """
+
+    def __init__(self, keep=False):
+        self.name = 'slim_benchmark_{}'.format(uuid.uuid4().hex[:8])
+        self.keep = keep
+        self.params = dict(
+            host=os.environ.get('DB_HOSTNAME', 'localhost'),
+            port=os.environ.get('DB_PORT', '5432'),
+            user=os.environ.get('DB_USERNAME', 'opendatacube'),
+            password=os.environ.get('DB_PASSWORD', ''),
+        )
+
+    def _execute(self, statement):
+        conn = psycopg2.connect(dbname=os.environ.get('DB_DATABASE', 'postgres'), **self.params)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(statement)
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self._execute('CREATE DATABASE "{}"'.format(self.name))
+        logging.info("Created database %s", self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.keep:
+            logging.info("Kept database %s", self.name)
+        else:
+            self._execute('DROP DATABASE "{}"'.format(self.name))
+            logging.info("Dropped database %s", self.name)
+
+    @property
+    def environment(self):
+        return {
+            'DB_HOSTNAME': self.params['host'],
+            'DB_PORT': str(self.params['port']),
+            'DB_USERNAME': self.params['user'],
+            'DB_PASSWORD': self.params['password'],
+            'DB_DATABASE': self.name,
+        }
+
+
+def prepare_database(env, directory):
+    """Initialise the index and add the slim metadata type and products."""
+    products = os.path.join(directory, 'benchmark-products.yaml')
+    with open(products, 'w') as f:
+        yaml.safe_dump(LANDSAT_PRODUCT, f, default_flow_style=False)
+
+    for command in (['system', 'init'],
+                    ['metadata', 'add', os.path.join(SCRIPTS_DIR, 'slim-metadata.yaml')],
+                    ['product', 'add', os.path.join(SCRIPTS_DIR, 'slim-products.yaml'), products]):
+        subprocess.run(['datacube'] + command, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+
+def run_indexer(name, bucket, extra_args, env, directory):
+    """
+    Run one indexer to completion and return its figures. Peak RSS comes from
+    wait4, so it is that of the indexer itself rather than of this process.
+    """
+    timings = os.path.join(directory, '{}-timings.csv'.format(name))
+    metrics = os.path.join(directory, '{}-metrics.json'.format(name))
+    log_path = os.path.join(directory, '{}.log'.format(name))
+    # Both are appended to or kept from an earlier run in the same directory
+    for path in (timings, metrics):
+        if os.path.exists(path):
+            os.remove(path)
+    command = [sys.executable] + [arg.format(bucket=bucket) for arg in INDEXERS[name]]
+    command += ['--timings', timings, '--metrics', metrics] + extra_args
+    logging.info("Running %s", ' '.join(command))
+
+    started = time()
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(command, cwd=SCRIPTS_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time() - started
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        logging.error("%s exited with %d, see %s", name, proc.returncode, log_path)
+
+    # Failed files have timings too, so the counts come from the metrics
+    indexed, failed = 0, None
+    errors = {}
+    if os.path.exists(metrics):
+        with open(metrics) as f:
+            summary = json.load(f)
+        indexed, failed, errors = summary['indexed'], summary['failed'], summary['errors']
+    else:
+        logging.error("%s wrote no metrics, see %s", name, log_path)
+    if failed:
+        logging.error("%s failed on %d files, see %s", name, failed, log_path)
+
+    latencies = []
+    if os.path.exists(timings):
+        with open(timings, newline='') as f:
+            latencies = [float(seconds) for key, seconds in csv.reader(f) if key not in errors]
+
+    return {
+        'indexer': name,
+        'files': indexed,
+        'failed': failed,
+        'seconds': round(elapsed, 3),
+        'files_per_sec': round(indexed / elapsed, 3) if elapsed else 0.0,
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2) if latencies else None,
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 2) if latencies else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(usage.ru_maxrss / 1024.0, 1),
+        'exit_code': proc.returncode,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def succeeded(result):
+    """Whether the indexer exited cleanly and indexed every file."""
+    return result['exit_code'] == 0 and result.get('failed') == 0
+
+
+def compare(result, history, tolerance):
+    """Log how ``result`` differs from the last comparable run in ``history``."""
+    if not succeeded(result):
+        return False
+    previous = [
+        run for run in history
+        if all(run.get(field) == result[field] for field in ('indexer', 'count', 'size', 'args'))
+        # Runs from before failures were counted have no 'failed'
+        and run.get('failed', 0) == 0 and run.get('exit_code') == 0
+    ]
+    if not previous:
+        return False
+    last = previous[-1]
+
+    regressed = False
+    changes = []
+    # Higher is better for throughput, lower for the rest
+    for field, higher_is_better in (('files_per_sec', True), ('p50_ms', False),
+                                    ('p99_ms', False), ('peak_rss_mb', False)):
+        before, after = last.get(field), result.get(field)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressed = True
+        changes.append('{} {:+.1f}%{}'.format(field, change * 100, ' (worse)' if worse > tolerance else ''))
+
+    logging.log(logging.WARNING if regressed else logging.INFO,
+                "%s against %s (%s): %s", result['indexer'], last.get('commit'), last.get('time'),
+                ', '.join(changes))
+    return regressed
+
+
+@click.command(help="Benchmark the indexers end to end on synthetic data")
+@click.option('--count', '-n', default=100, type=click.IntRange(min=1),
+              help="Number of files of each kind to generate")
+@click.option('--size', default=1024, type=click.IntRange(min=64),
+              help="Width and height of the generated rasters, in pixels")
+@click.option('--indexer', 'indexers', multiple=True, type=click.Choice(sorted(INDEXERS)),
+              help="Indexer to run, as many times as needed. Defaults to all of them")
+@click.option('--args', 'extra', multiple=True,
+              help="Extra arguments for one indexer, such as 'cogs=-w 8 --fast_headers'")
+@click.option('--bucket', default='slim-benchmark', help="Bucket to put the data in")
+@click.option('--endpoint_url', help="S3 compatible store to use instead of starting moto")
+@click.option('--workdir', type=click.Path(file_okay=False),
+              help="Directory for the generated data and logs. Defaults to a temporary one")
+@click.option('--history', default='benchmark-history.jsonl', type=click.Path(dir_okay=False),
+              help="File the results are appended to and compared against")
+@click.option('--tolerance', default=0.1, help="Fractional change that counts as a regression")
+@click.option('--keep_database', is_flag=True, help="Don't drop the database afterwards")
+def main(count, size, indexers, extra, bucket, endpoint_url, workdir, history, tolerance, keep_database):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    indexers = indexers or sorted(INDEXERS)
+    extra_args = {}
+    for item in extra:
+        name, _, args = item.partition('=')
+        if name not in INDEXERS:
+            raise click.BadParameter("Unknown indexer {}".format(name), param_hint='--args')
+        extra_args[name] = args
+
+    directory = workdir or tempfile.mkdtemp(prefix='slim-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    logging.info("Generating %d files of each kind in %s", count, directory)
+    keys = generate(directory, bucket, count, size=size)
+
+    server = None
+    if not endpoint_url:
+        endpoint_url, server = start_stand_in()
+    env = dict(os.environ)
+    env.update(s3_environment(endpoint_url))
+
+    past = load_history(history)
+    results = []
+    regressed = False
+    try:
+        upload(endpoint_url, env, bucket, directory, keys)
+        with ThrowawayDatabase(keep=keep_database) as database:
+            env.update(database.environment)
+            prepare_database(env, directory)
+            for name in indexers:
+                result = run_indexer(name, bucket, shlex.split(extra_args.get(name, '')), env, directory)
+                result.update({
+                    'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'commit': git_commit(),
+                    'count': count,
+                    'size': size,
+                    'args': extra_args.get(name, ''),
+                })
+                results.append(result)
+                regressed = compare(result, past, tolerance) or regressed
+    finally:
+        if server is not None:
+            server.stop()
+
+    logging.info("%-6s %7s %7s %9s %10s %10s %10s %12s", 'run', 'files', 'failed', 'seconds', 'files/s',
+                 'p50 ms', 'p99 ms', 'peak RSS MB')
+    for result in results:
+        logging.info("%-6s %7d %7s %9.1f %10.2f %10s %10s %12.1f", result['indexer'], result['files'],
+                     result['failed'], result['seconds'], result['files_per_sec'], result['p50_ms'],
+                     result['p99_ms'], result['peak_rss_mb'])
+
+    if history:
+        with open(history, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    failures = [result['indexer'] for result in results if not succeeded(result)]
+    if failures:
+        raise click.ClickException("Not every file was indexed by {}".format(', '.join(failures)))
+    if regressed:
+        raise click.ClickException("Slower than the last comparable run by more than {:.0%}".format(tolerance))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Check that the fast MTL parser agrees with the original one, and time both.
+
+    python3 benchmark-mtl.py LC08_..._MTL.txt s3://landsat-pds/c1/L8/.../..._MTL.txt
+
+With no files a synthetic Landsat 8 MTL is used.
+"""
+import logging
+import timeit
+from urllib.parse import urlparse
+
+import boto3
+import click
+
+from benchmark_data import sample_mtl
+from mtl_parser import _parse_group, parse_mtl
+
+
+def read_body(path):
+    parsed = urlparse(path)
+    if parsed.scheme == 's3':
+        obj = boto3.client('s3').get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))
+        return obj['Body'].read()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def original_parser(body):
+    return _parse_group(iter(body.decode('utf8').split("\n")))
+
+
+@click.command(help="Compare the fast MTL parser with the original one on MTL files, local or on S3")
+@click.argument('paths', nargs=-1)
+@click.option('--number', '-n', default=1000, help="Number of times each file is parsed")
+def main(paths, number):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    samples = [(path, read_body(path)) for path in paths] or [('synthetic', sample_mtl())]
+
+    mismatched = 0
+    for name, body in samples:
+        if parse_mtl(body) != original_parser(body):
+            logging.error("%s: parsers disagree", name)
+            mismatched += 1
+            continue
+        original = min(timeit.repeat(lambda: original_parser(body), number=number, repeat=3)) / number
+        fast = min(timeit.repeat(lambda: parse_mtl(body), number=number, repeat=3)) / number
+        logging.info("%s: original %.1f us, fast %.1f us (%.1fx)",
+                     name, original * 1e6, fast * 1e6, original / fast)
+
+    if mismatched:
+        raise click.ClickException("{} of {} files parsed differently".format(mismatched, len(samples)))
+
+
+if __name__ == "__main__":
+    main()
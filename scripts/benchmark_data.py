@@ -0,0 +1,235 @@
+"""
+Synthetic data for the benchmarks: Cloud Optimized GeoTIFFs, the YAML dataset
+documents ls_public_bucket.py reads, and Landsat MTL files, all of about the
+size of the real thing.
+"""
+import datetime
+import os
+import uuid
+
+import numpy as np
+import rasterio
+import yaml
+from rasterio.coords import BoundingBox
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copy_raster
+from rasterio.transform import from_origin
+
+from footprint import footprint
+
+# Somewhere in NSW, in NSW Lambert
+ORIGIN = (9400000.0, 4500000.0)
+CRS = 'EPSG:3308'
+
+
+def write_cog(path, index, size=1024, dtype='uint8', resolution=20.0):
+    """
+    Write a tiled, compressed GeoTIFF with overviews, laid out as a COG.
+    Files with consecutive ``index`` sit side by side on a grid.
+    """
+    rng = np.random.default_rng(index)
+    columns = 100
+    left = ORIGIN[0] + (index % columns) * size * resolution
+    top = ORIGIN[1] - (index // columns) * size * resolution
+    transform = from_origin(left, top, resolution, resolution)
+
+    # Patches with a little noise compress about as well as real rasters do
+    coarse = rng.integers(0, 20, (size // 16, size // 16))
+    data = (np.kron(coarse, np.ones((16, 16))) + rng.integers(0, 3, (size, size))).astype(dtype)
+
+    profile = dict(driver='GTiff', width=size, height=size, count=1, dtype=dtype,
+                   crs=CRS, transform=transform, tiled=True, blockxsize=512,
+                   blockysize=512, compress='deflate')
+    staging = path + '.staging.tif'
+    with rasterio.open(staging, 'w', **profile) as dst:
+        dst.write(data, 1)
+        dst.build_overviews([2, 4, 8], Resampling.nearest)
+    # Copying with the overviews puts the header and IFDs at the front
+    copy_raster(staging, path, copy_src_overviews=True, **profile)
+    os.remove(staging)
+    return BoundingBox(left, top - size * resolution, left + size * resolution, top)
+
+
+def slim_yaml_doc(uri, product_type, bounds, year):
+    """A dataset document like the ones index-cogs-live.py builds, as YAML."""
+    geo_ref_points, coordinates = footprint(bounds, CRS)
+    date = '{}-01-01T00:00:00'.format(year)
+    doc = {
+        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, uri)),
+        'product_type': product_type,
+        'creation_dt': date,
+        'platform': {'code': 'slim'},
+        'instrument': {'name': 'slim'},
+        'extent': {
+            'from_dt': date,
+            'to_dt': date,
+            'center_dt': date,
+            'coord': coordinates,
+        },
+        'format': {'name': 'GeoTiff'},
+        'grid_spatial': {
+            'projection': {
+                'geo_ref_points': geo_ref_points,
+                'spatial_reference': CRS,
+            }
+        },
+        'image': {'bands': {'band1': {'path': uri, 'layer': 1}}},
+        'lineage': {'source_datasets': {}},
+    }
+    return yaml.safe_dump(doc, default_flow_style=False).encode('utf8')
+
+
+def sample_mtl(scene=0):
+    """
+    A Landsat 8 MTL document of the usual size. Documents for different
+    ``scene`` numbers have their own scene and product ids.
+    """
+    row = 83 + scene % 100
+    date = datetime.date(2017, 3, 4) + datetime.timedelta(days=16 * (scene // 100))
+    product_id = 'LC08_L1TP_089{:03d}_{:%Y%m%d}_20170316_01_T1'.format(row, date)
+    groups = [
+        ('METADATA_FILE_INFO', [
+            ('ORIGIN', '"Image courtesy of the U.S. Geological Survey"'),
+            ('REQUEST_ID', '"0501703070045_00001"'),
+            ('LANDSAT_SCENE_ID', '"LC8089{:03d}{:%Y%j}LGN00"'.format(row, date)),
+            ('LANDSAT_PRODUCT_ID', '"{}"'.format(product_id)),
+            ('COLLECTION_NUMBER', '01'),
+            ('FILE_DATE', '2017-03-16T08:35:03Z'),
+            ('STATION_ID', '"LGN"'),
+            ('PROCESSING_SOFTWARE_VERSION', '"LPGS_2.7.0"'),
+        ]),
+        ('PRODUCT_METADATA', [
+            ('DATA_TYPE', '"L1TP"'),
+            ('COLLECTION_CATEGORY', '"T1"'),
+            ('ELEVATION_SOURCE', '"GLS2000"'),
+            ('OUTPUT_FORMAT', '"GEOTIFF"'),
+            ('SPACECRAFT_ID', '"LANDSAT_8"'),
+            ('SENSOR_ID', '"OLI_TIRS"'),
+            ('WRS_PATH', '89'),
+            ('WRS_ROW', str(row)),
+            ('DATE_ACQUIRED', date.isoformat()),
+            ('SCENE_CENTER_TIME', '"23:53:30.4370430Z"'),
+        ] + [
+            ('CORNER_{}_{}'.format(corner, axis), value)
+            for corner, lat, lon in [('UL', -32.40427, 150.17155), ('UR', -32.41453, 152.60990),
+                                     ('LL', -34.52236, 150.14498), ('LR', -34.53331, 152.63838)]
+            for axis, value in [('LAT_PRODUCT', '{:.5f}'.format(lat)), ('LON_PRODUCT', '{:.5f}'.format(lon))]
+        ] + [
+            ('CORNER_{}_PROJECTION_{}_PRODUCT'.format(corner, axis), value)
+            for corner, x, y in [('UL', 235200.0, -3589500.0), ('UR', 464100.0, -3589500.0),
+                                 ('LL', 235200.0, -3824700.0), ('LR', 464100.0, -3824700.0)]
+            for axis, value in [('X', '{:.1f}'.format(x)), ('Y', '{:.1f}'.format(y))]
+        ] + [
+            ('PANCHROMATIC_LINES', '15681'),
+            ('PANCHROMATIC_SAMPLES', '15261'),
+            ('REFLECTIVE_LINES', '7841'),
+            ('REFLECTIVE_SAMPLES', '7631'),
+            ('THERMAL_LINES', '7841'),
+            ('THERMAL_SAMPLES', '7631'),
+        ] + [
+            ('FILE_NAME_BAND_{}'.format(band), '"{}_B{}.TIF"'.format(product_id, band))
+            for band in list(range(1, 12)) + ['QUALITY']
+        ] + [
+            ('ANGLE_COEFFICIENT_FILE_NAME', '"{}_ANG.txt"'.format(product_id)),
+            ('METADATA_FILE_NAME', '"{}_MTL.txt"'.format(product_id)),
+            ('CPF_NAME', '"LC08CPF_20170101_20170331_01.02"'),
+            ('BPF_NAME_OLI', '"LO8BPF20170304232524_20170305000405.01"'),
+            ('RLUT_FILE_NAME', '"LC08RLUT_20150303_20431231_01_12.h5"'),
+        ]),
+        ('IMAGE_ATTRIBUTES', [
+            ('CLOUD_COVER', '1.66'),
+            ('CLOUD_COVER_LAND', '1.66'),
+            ('IMAGE_QUALITY_OLI', '9'),
+            ('IMAGE_QUALITY_TIRS', '9'),
+            ('TIRS_SSM_MODEL', '"FINAL"'),
+            ('TIRS_SSM_POSITION_STATUS', '"ESTIMATED"'),
+            ('TIRS_STRAY_LIGHT_CORRECTION_SOURCE', '"TIRS"'),
+            ('ROLL_ANGLE', '-0.001'),
+            ('SUN_AZIMUTH', '57.55693225'),
+            ('SUN_ELEVATION', '46.04498853'),
+            ('EARTH_SUN_DISTANCE', '0.9920778'),
+            ('SATURATION_BAND_1', '"N"'),
+            ('GROUND_CONTROL_POINTS_VERSION', '4'),
+            ('GROUND_CONTROL_POINTS_MODEL', '467'),
+            ('GEOMETRIC_RMSE_MODEL', '6.563'),
+            ('GEOMETRIC_RMSE_MODEL_Y', '4.689'),
+            ('GEOMETRIC_RMSE_MODEL_X', '4.592'),
+            ('GROUND_CONTROL_POINTS_VERIFY', '155'),
+            ('GEOMETRIC_RMSE_VERIFY', '3.502'),
+        ]),
+        ('MIN_MAX_RADIANCE', [
+            ('RADIANCE_{}_BAND_{}'.format(bound, band), '{:.5f}'.format(value * band))
+            for band in range(1, 12)
+            for bound, value in [('MAXIMUM', 761.58557), ('MINIMUM', -62.89137)]
+        ]),
+        ('RADIOMETRIC_RESCALING', [
+            ('RADIANCE_MULT_BAND_{}'.format(band), '{:.4E}'.format(1.2581E-02 / band))
+            for band in range(1, 12)
+        ] + [
+            ('RADIANCE_ADD_BAND_{}'.format(band), '{:.5f}'.format(-62.90343 / band))
+            for band in range(1, 12)
+        ]),
+        ('TIRS_THERMAL_CONSTANTS', [
+            ('K1_CONSTANT_BAND_10', '774.8853'),
+            ('K2_CONSTANT_BAND_10', '1321.0789'),
+            ('K1_CONSTANT_BAND_11', '480.8883'),
+            ('K2_CONSTANT_BAND_11', '1201.1442'),
+        ]),
+        ('PROJECTION_PARAMETERS', [
+            ('MAP_PROJECTION', '"UTM"'),
+            ('DATUM', '"WGS84"'),
+            ('ELLIPSOID', '"WGS84"'),
+            ('UTM_ZONE', '56'),
+            ('GRID_CELL_SIZE_PANCHROMATIC', '15.00'),
+            ('GRID_CELL_SIZE_REFLECTIVE', '30.00'),
+            ('GRID_CELL_SIZE_THERMAL', '30.00'),
+            ('ORIENTATION', '"NORTH_UP"'),
+            ('RESAMPLING_OPTION', '"CUBIC_CONVOLUTION"'),
+        ]),
+    ]
+
+    lines = ['GROUP = L1_METADATA_FILE']
+    for name, pairs in groups:
+        lines.append('  GROUP = {}'.format(name))
+        lines.extend('    {} = {}'.format(key, value) for key, value in pairs)
+        lines.append('  END_GROUP = {}'.format(name))
+    lines.extend(['END_GROUP = L1_METADATA_FILE', 'END', ''])
+    return '\n'.join(lines).encode('utf8')
+
+
+def generate(directory, bucket, count, size=1024):
+    """
+    Write ``count`` files of each kind under ``directory``, laid out as they
+    will be in ``bucket``:
+
+    * ``cogs/``: classified rasters for index-cogs-live.py
+    * ``dem/``: float32 elevation tiles for index-dem.py
+    * ``yaml/``: dataset documents for the rasters in ``cogs/``
+    * ``mtl/``: Landsat 8 MTL files
+
+    Returns the relative paths of everything written.
+    """
+    written = []
+
+    def path_for(key):
+        path = os.path.join(directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written.append(key)
+        return path
+
+    for i in range(count):
+        year = 2010 + i % 10
+        cog_key = 'cogs/slim_{}_{:05d}.tif'.format(year, i)
+        bounds = write_cog(path_for(cog_key), i, size=size)
+        write_cog(path_for('dem/dem_{:05d}.tif'.format(i)), i, size=size, dtype='float32', resolution=5.0)
+
+        uri = 's3://{}/{}'.format(bucket, cog_key)
+        with open(path_for('yaml/{:05d}/dataset.yaml'.format(i)), 'wb') as f:
+            f.write(slim_yaml_doc(uri, 'dlcd', bounds, year))
+
+        mtl = sample_mtl(i)
+        product_id = mtl.split(b'LANDSAT_PRODUCT_ID = "', 1)[1].split(b'"', 1)[0].decode('ascii')
+        with open(path_for('mtl/{0}/{0}_MTL.txt'.format(product_id)), 'wb') as f:
+            f.write(mtl)
+
+    return written
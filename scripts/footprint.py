@@ -0,0 +1,97 @@
+"""
+Footprints for dataset documents: the projected corners that go in
+``grid_spatial.projection.geo_ref_points`` and their longitudes and latitudes
+that go in ``extent.coord``.
+
+Transformers are cached by CRS, since an indexing run only sees a handful of
+them, and all the points of a footprint are transformed in one call. The
+pyproj the image pins doesn't make a Transformer safe to share between
+threads, so each thread keeps its own.
+"""
+import threading
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+CORNERS = ('ul', 'ur', 'lr', 'll')
+WGS84 = 'EPSG:4326'
+
+_local = threading.local()
+
+
+def transformer_to_wgs84(crs):
+    """
+    Return a Transformer from ``crs`` to longitude and latitude, for use on
+    the calling thread only. ``crs`` is anything pyproj understands, such as
+    ``'epsg:3308'`` or WKT.
+    """
+    transformers = getattr(_local, 'transformers', None)
+    if transformers is None:
+        transformers = _local.transformers = {}
+    transformer = transformers.get(crs)
+    if transformer is None:
+        transformer = transformers[crs] = Transformer.from_crs(CRS.from_user_input(crs), WGS84, always_xy=True)
+    return transformer
+
+
+def bounds_to_points(bounds):
+    """The corners of ``bounds``, a rasterio BoundingBox, as geo_ref_points."""
+    left, bottom, right, top = bounds
+    return {
+        'ul': {'x': left, 'y': top},
+        'ur': {'x': right, 'y': top},
+        'lr': {'x': right, 'y': bottom},
+        'll': {'x': left, 'y': bottom},
+    }
+
+
+def _densify(xs, ys, densify):
+    """Add ``densify`` evenly spaced points along each edge of the ring."""
+    steps = np.arange(densify + 1) / (densify + 1)
+    next_xs, next_ys = np.roll(xs, -1), np.roll(ys, -1)
+    xs = xs[:, None] + (next_xs - xs)[:, None] * steps
+    ys = ys[:, None] + (next_ys - ys)[:, None] * steps
+    return xs.ravel(), ys.ravel()
+
+
+def points_to_coords(geo_ref_points, crs, densify=0):
+    """
+    Longitudes and latitudes of the corners in ``geo_ref_points``.
+
+    :param geo_ref_points: Projected ``ul``, ``ur``, ``lr`` and ``ll`` corners.
+    :param crs: CRS of the corners.
+    :param densify: Number of extra points to transform along each edge. Edges
+        that are straight in ``crs`` can bow out in longitude and latitude,
+        so with ``densify`` the corners returned are those of the longitude
+        and latitude box that contains the whole of every edge instead.
+    """
+    xs = np.array([geo_ref_points[corner]['x'] for corner in CORNERS], dtype='float64')
+    ys = np.array([geo_ref_points[corner]['y'] for corner in CORNERS], dtype='float64')
+    if densify:
+        xs, ys = _densify(xs, ys, densify)
+
+    lons, lats = transformer_to_wgs84(crs).transform(xs, ys)
+
+    if not densify:
+        return {
+            corner: {'lon': float(lon), 'lat': float(lat)}
+            for corner, lon, lat in zip(CORNERS, lons, lats)
+        }
+
+    west, east = float(np.min(lons)), float(np.max(lons))
+    south, north = float(np.min(lats)), float(np.max(lats))
+    return {
+        'ul': {'lon': west, 'lat': north},
+        'ur': {'lon': east, 'lat': north},
+        'lr': {'lon': east, 'lat': south},
+        'll': {'lon': west, 'lat': south},
+    }
+
+
+def footprint(bounds, crs, densify=0):
+    """
+    Return ``(geo_ref_points, coord)`` for a raster with ``bounds`` in ``crs``.
+    See ``points_to_coords`` for ``densify``.
+    """
+    geo_ref_points = bounds_to_points(bounds)
+    return geo_ref_points, points_to_coords(geo_ref_points, crs, densify=densify)
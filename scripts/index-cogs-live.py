@@ -3,15 +3,23 @@
 import datetime
 import logging
 import re
+import signal
+import threading
 import uuid
+from queue import Queue
+from threading import Thread
 
-import boto3
 import click
-import datacube
 import rasterio
-from datacube.index.hl import Doc2Dataset
-from datacube.utils import changes
-from pyproj import Proj, transform
+
+from footprint import footprint
+from index_manifest import IndexManifest, archive_missing_datasets, filter_changed
+from index_session import IndexingSession
+from index_stats import IndexStats
+from s3_events import SQS_MAX_WAIT, consume, open_queue
+from s3_inventory import read_inventory
+from s3_listing import get_matching_s3_objects
+from tiff_header import DEFAULT_PREFETCH, open_header
 
 # Set us up some logging
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -26,48 +34,33 @@ logging.getLogger('urllib3').setLevel(logging.CRITICAL)
 # PRODUCT_TYPE = 'dlcd'
 
 OVERWRITE = True
+GUARDIAN = "GUARDIAN_QUEUE_EMPTY"
 
 year_re = re.compile(r'([2][0-9]{3})')
 
 
-def get_matching_s3_keys(bucket, prefix='', suffix=''):
-    """
-    Generate the keys in an S3 bucket.
+def s3_url(bucket, file_path):
+    return "s3://{bucket}/{file}".format(bucket=bucket, file=file_path)
 
-    :param bucket: Name of the S3 bucket.
-    :param prefix: Only fetch keys that start with this prefix (optional).
-    :param suffix: Only fetch keys that end with this suffix (optional).
-    """
-    s3 = boto3.client('s3')
-
-    kwargs = {'Bucket': bucket, 'Prefix': prefix}
-    while True:
-        resp = s3.list_objects_v2(**kwargs)
-        if not resp.get('Contents'):
-            logging.warning("No keys found at {}/{} with the suffix {}".format(
-                bucket, prefix, suffix
-            ))
-            return None
-        for obj in resp['Contents']:
-            key = obj['Key']
-            if key.endswith(suffix):
-                yield key
-        try:
-            kwargs['ContinuationToken'] = resp['NextContinuationToken']
-        except KeyError:
-            break
 
+def dataset_id(s3_path):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, s3_path))
 
-def build_metadata(bucket, file_path, product_type):
-    s3_path_template = "s3://{bucket}/{file}"
 
-    s3_path = s3_path_template.format(
-        bucket=bucket,
-        file=file_path
-    )
-    raster = rasterio.open(s3_path)
-    bounds = raster.bounds
-    crs_code = raster.crs.to_epsg()
+def build_metadata(bucket, file_path, product_type, stats, prefetch=None):
+    """
+    Build the dataset document for one GeoTIFF. If ``prefetch`` is set, bounds
+    and CRS are decoded from a range read of that many bytes, and rasterio is
+    only used when that fails.
+    """
+    s3_path = s3_url(bucket, file_path)
+    with stats.stage('open', s3_path):
+        if prefetch:
+            raster = open_header(s3_path, prefetch=prefetch)
+        else:
+            raster = rasterio.open(s3_path)
+        bounds = raster.bounds
+        crs_code = raster.crs.to_epsg()
 
     # Nasty hack, but RasterIO can't find the EPSG code sometimes...
     if crs_code is None:
@@ -90,44 +83,12 @@ def build_metadata(bucket, file_path, product_type):
 
     centre_date = from_date
 
-    # Handle coordinates
-    top = bounds.top
-    bottom = bounds.bottom
-    right = bounds.right
-    left = bounds.left
-
-    # Get some WGS lat/lon
-    inProj = Proj(init=crs_string)
-    outProj = Proj(init='epsg:4326')
-    left_ll, bottom_ll = transform(inProj, outProj, left, bottom)
-    right_ll, top_ll = transform(inProj, outProj, right, top)
-
-    # unprojected
-    coordinates = {
-        'ul':
-            {'lon': left_ll, 'lat': top_ll},
-        'ur':
-            {'lon': right_ll, 'lat': top_ll},
-        'lr':
-            {'lon': right_ll, 'lat': bottom_ll},
-        'll':
-            {'lon': left_ll, 'lat': bottom_ll}
-    }
-
-    # projected
-    geo_ref_points = {
-        'ul':
-            {'x': left, 'y': top},
-        'ur':
-            {'x': right, 'y': top},
-        'lr':
-            {'x': right, 'y': bottom},
-        'll':
-            {'x': left, 'y': bottom}
-    }
+    # Projected corners and their lon/lat
+    with stats.stage('footprint', s3_path):
+        geo_ref_points, coordinates = footprint(bounds, crs_string)
 
     docdict = {
-        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, s3_path)),
+        'id': dataset_id(s3_path),
         'product_type': product_type,
         'creation_dt': centre_date,
         'platform': {'code': 'slim'},
@@ -160,23 +121,193 @@ def build_metadata(bucket, file_path, product_type):
     return docdict
 
 
-def index_dataset(dataset_dict, s3_path):
-    dc = datacube.Datacube()
-    index = dc.index
-    resolver = Doc2Dataset(index)
-    dataset, err = resolver(dataset_dict, s3_path)
-    if err is not None:
-        logging.error("%s", err)
+def feed_keys(files, keys, worker_count, limit=None, outcome=None):
+    """
+    Put the listed keys on the bounded key queue, followed by one GUARDIAN
+    per worker so they all know when to stop. ``outcome['completed']`` is
+    set once every key has been listed, and ``outcome['error']`` to whatever
+    stopped the listing, for the main thread to raise.
+    """
+    outcome = outcome if outcome is not None else {}
+    try:
+        for count, key in enumerate(files):
+            if limit and count >= limit:
+                logging.warning(
+                    "Finished processing {}, which is the limit".format(count))
+                break
+            keys.put(key)
+        else:
+            outcome['completed'] = True
+    except Exception as e:
+        outcome['error'] = e
+    finally:
+        for i in range(worker_count):
+            keys.put(GUARDIAN)
+
+
+def metadata_worker(bucket, product_type, keys, results, stats, prefetch=None):
+    """
+    Open raster headers and build dataset documents until a GUARDIAN turns up.
+    """
+    while True:
+        key = keys.get()
+        if key == GUARDIAN:
+            results.put(GUARDIAN)
+            break
+        logging.info("Working on {}".format(key))
+        uri = s3_url(bucket, key)
+        stats.begin(uri)
+        try:
+            results.put((uri, build_metadata(
+                bucket, key, product_type, stats, prefetch=prefetch), None))
+        except Exception as e:
+            results.put((uri, None, e))
+
+
+def index_serially(bucket, files, product_type, session, stats, limit=None,
+                   prefetch=None):
+    """Index the files one at a time. Returns True if every one was listed."""
+    for count, s3_path in enumerate(files):
+        if limit and count >= limit:
+            logging.warning(
+                "Finished processing {}, which is the limit".format(count))
+            return False
+        logging.info("Working on {}".format(s3_path))
+        uri = s3_url(bucket, s3_path)
+        stats.begin(uri)
+
+        try:
+            dataset_dict = build_metadata(
+                bucket, s3_path, product_type, stats, prefetch=prefetch)
+        except Exception as e:
+            session.fail(uri, e)
+            continue
+
+        session.add(dataset_dict, uri)
+    return True
+
+
+def index_concurrently(bucket, files, product_type, session, stats, workers,
+                       limit=None, prefetch=None):
+    """
+    Build the dataset documents in a pool of threads, and index them from this
+    thread as they come off a bounded queue, so writes to the index stay
+    serialized and listing never runs too far ahead of indexing. Returns True
+    if every file was listed, and raises whatever stopped the listing.
+    """
+    keys = Queue(maxsize=workers * 2)
+    results = Queue(maxsize=workers * 2)
+    outcome = {}
+
+    threads = [Thread(target=feed_keys, args=(files, keys, workers, limit, outcome))]
+    for i in range(workers):
+        threads.append(Thread(
+            target=metadata_worker,
+            args=(bucket, product_type, keys, results, stats, prefetch)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    while finished < workers:
+        result = results.get()
+        if result == GUARDIAN:
+            finished += 1
+            continue
+
+        uri, dataset_dict, err = result
+        if err is None:
+            session.add(dataset_dict, uri)
+        else:
+            session.fail(uri, err)
+
+    for thread in threads:
+        thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome.get('completed', False)
+
+
+def index_events(events, bucket, path, extension, product_type, session,
+                 stats, manifest, failed, workers=1, prefetch=None):
+    """
+    Index the objects created and archive the datasets of the objects
+    removed, for one batch of S3 events with one event per object. Events for
+    other buckets, prefixes or extensions are ignored. Returns the uris that
+    failed, so their messages can be tried again.
+    """
+    failed.clear()
+    wanted = [
+        event for event in events
+        if event.bucket == bucket
+        and event.key.startswith(path or '')
+        and event.key.endswith(extension or '')
+    ]
+    stats.count('ignored_events', len(events) - len(wanted))
+
+    created = []
+    for event in wanted:
+        if event.removed:
+            continue
+        if manifest is None or manifest.changed(event.uri, event.object):
+            created.append(event.key)
+        else:
+            stats.skip(event.uri)
+    if workers > 1 and len(created) > 1:
+        index_concurrently(bucket, created, product_type, session, stats,
+                           min(workers, len(created)), prefetch=prefetch)
     else:
+        index_serially(bucket, created, product_type, session, stats,
+                       prefetch=prefetch)
+    session.flush()
+
+    removed = [event.uri for event in wanted if event.removed]
+    if removed:
+        for uri in removed:
+            stats.begin(uri)
         try:
-            index.datasets.add(dataset)
-        except changes.DocumentMismatchError as e:
-            index.datasets.update(dataset, {tuple(): changes.allow_any})
+            with stats.stage('archive'):
+                session.index.datasets.archive(
+                    [dataset_id(uri) for uri in removed])
         except Exception as e:
-            err = e
-            logging.error("Unhandled exception {}".format(e))
+            for uri in removed:
+                stats.failure(uri, e)
+            failed.update(removed)
+        else:
+            for uri in removed:
+                stats.success(uri)
+            stats.count('archived', len(removed))
+            if manifest is not None:
+                manifest.forget(removed)
+    return set(failed)
+
+
+def consume_events(queue_url, bucket, path, extension, product_type, session,
+                   stats, manifest, failed, batch_size, batch_window, once,
+                   workers=1, prefetch=None):
+    """
+    Index from S3 notifications on a queue until stopped, or until the queue
+    is empty with ``once``. SIGINT and SIGTERM stop it after the batch in
+    hand.
+    """
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        logging.warning("Stopping after this batch")
+        stop.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    def handle(events):
+        return index_events(events, bucket, path, extension, product_type,
+                            session, stats, manifest, failed,
+                            workers=workers, prefetch=prefetch)
 
-    return dataset, err
+    logging.info("Waiting for events on {}".format(queue_url))
+    consume(open_queue(queue_url), handle, stats, batch_size=batch_size,
+            batch_window=batch_window, wait=0 if once else SQS_MAX_WAIT,
+            once=once, stop=stop)
 
 
 @click.command(help="Enter Bucket name and other parameters")
@@ -186,23 +317,126 @@ def index_dataset(dataset_dict, s3_path):
 @click.option('--extension', '-e', help="Pass extension to filter on")
 @click.option(
     '--product_type', '-t', help="The product type, or name for the product")
-def do_work(bucket, path, extension, product_type):
-    count = 0
+@click.option(
+    '--workers', '-w', default=1, type=click.IntRange(min=1),
+    help="Number of threads reading raster headers concurrently")
+@click.option(
+    '--batch_size', '-b', default=100, type=click.IntRange(min=1),
+    help="Number of datasets to commit to the index in one transaction")
+@click.option(
+    '--manifest', '-m', type=click.Path(dir_okay=False),
+    help="SQLite file recording what has been indexed, so that unchanged "
+         "objects are skipped on later runs")
+@click.option(
+    '--archive_missing', is_flag=True,
+    help="Archive datasets in the manifest whose objects have been removed")
+@click.option(
+    '--fast_headers', is_flag=True,
+    help="Read bounds and CRS from a ranged read of the GeoTIFF header, "
+         "falling back to rasterio when it can't be decoded")
+@click.option(
+    '--prefetch', default=DEFAULT_PREFETCH, type=click.IntRange(min=16),
+    help="Bytes to read for the header with --fast_headers")
+@click.option(
+    '--list_workers', default=1, type=click.IntRange(min=1),
+    help="Number of threads listing sub-prefixes of the bucket concurrently")
+@click.option(
+    '--inventory', '-i',
+    help="Read the keys from an S3 Inventory manifest.json, CSV or Parquet "
+         "file, or a list of keys, instead of listing the bucket")
+@click.option(
+    '--queue', '-q',
+    help="Keep running, and index from the S3 notifications on this SQS "
+         "queue URL, or a directory standing in for one, instead of listing "
+         "the bucket")
+@click.option(
+    '--batch_window', default=5.0, type=click.FloatRange(min=0),
+    help="Seconds to wait for more events once the first of a batch arrives")
+@click.option(
+    '--once', is_flag=True,
+    help="With --queue, stop once the queue is empty")
+@click.option(
+    '--timings', type=click.Path(dir_okay=False),
+    help="Append the seconds each file took to index to this CSV file")
+@click.option(
+    '--metrics', type=click.Path(dir_okay=False),
+    help="Write a JSON summary of where the time went to this file")
+@click.option(
+    '--prometheus', type=click.Path(dir_okay=False),
+    help="Write the metrics to this file in the Prometheus text format")
+@click.option(
+    '--prometheus_port', type=click.IntRange(min=1),
+    help="Serve the metrics for Prometheus on this port while running")
+@click.option(
+    '--trace_slow', type=click.FloatRange(min=0.001),
+    help="Sample the stack of any stage that takes longer than this many "
+         "seconds, and include the slowest files' stacks in the metrics")
+def do_work(bucket, path, extension, product_type, workers, batch_size,
+            manifest, archive_missing, fast_headers, prefetch, list_workers,
+            inventory, queue, batch_window, once, timings, metrics,
+            prometheus, prometheus_port, trace_slow):
     limit = None
-    # List the bucket and get all the files with the extension we want
-    files = get_matching_s3_keys(bucket, prefix=path, suffix=extension)
-
-    for s3_path in files:
-        if limit and count >= limit:
-            logging.warning(
-                "Finished processing {}, which is the limit".format(count))
-            return
-        logging.info("Working on {}".format(s3_path))
-
-        dataset_dict = build_metadata(bucket, s3_path, product_type)
-
-        index_dataset(dataset_dict, s3_path)
-        count += 1
+    prefetch = prefetch if fast_headers else None
+    stats = IndexStats(
+        timings=timings, trace_slow=trace_slow, metrics_json=metrics,
+        prometheus=prometheus, prometheus_port=prometheus_port)
+    manifest = IndexManifest(manifest) if manifest else None
+    failed = set()
+
+    def on_done(uri, dataset, err):
+        stats.record(uri, err)
+        if err is not None:
+            failed.add(uri)
+        elif manifest is not None:
+            manifest.record(uri, dataset.id)
+
+    session = IndexingSession(
+        products=[product_type] if product_type else None,
+        batch_size=batch_size,
+        on_done=on_done,
+        stats=stats
+    )
+    try:
+        with session:
+            if queue:
+                consume_events(queue, bucket, path, extension, product_type,
+                               session, stats, manifest, failed, batch_size,
+                               batch_window, once, workers=workers,
+                               prefetch=prefetch)
+                return
+
+            # List the bucket and get all the files with the extension we want
+            if inventory:
+                objects = read_inventory(
+                    inventory, bucket=bucket, prefix=path, suffix=extension)
+            else:
+                objects = get_matching_s3_objects(
+                    bucket, prefix=path, suffix=extension, workers=list_workers)
+            files = (
+                obj['Key'] for obj in stats.timed('list', filter_changed(
+                    objects, manifest, bucket, on_skip=stats.skip))
+            )
+
+            if workers > 1:
+                completed = index_concurrently(
+                    bucket, files, product_type, session, stats, workers,
+                    limit=limit, prefetch=prefetch)
+            else:
+                completed = index_serially(
+                    bucket, files, product_type, session, stats, limit=limit,
+                    prefetch=prefetch)
+
+            # Objects that were never listed can't be told apart from removed ones
+            if archive_missing and manifest is not None and not completed:
+                logging.warning("Not archiving missing datasets, the listing stopped early")
+            elif archive_missing and manifest is not None:
+                session.flush()
+                with stats.stage('archive'):
+                    archive_missing_datasets(manifest, session.index, bucket, path)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        stats.report()
 
 
 if __name__ == "__main__":
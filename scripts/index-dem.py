@@ -5,13 +5,16 @@ import logging
 import re
 import uuid
 
-import boto3
 import click
-import datacube
 import rasterio
-from datacube.index.hl import Doc2Dataset
-from datacube.utils import changes
-from pyproj import Proj, transform, CRS
+
+from footprint import footprint
+from index_manifest import IndexManifest, archive_missing_datasets, filter_changed
+from index_session import IndexingSession
+from index_stats import IndexStats
+from s3_inventory import read_inventory
+from s3_listing import get_matching_s3_objects
+from tiff_header import DEFAULT_PREFETCH, open_header
 
 # Set us up some logging
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
@@ -30,144 +33,185 @@ OVERWRITE = True
 year_re = re.compile(r'([2][0-9]{3})')
 
 
-def get_matching_s3_keys(bucket, prefix='', suffix=''):
-    """
-    Generate the keys in an S3 bucket.
-
-    :param bucket: Name of the S3 bucket.
-    :param prefix: Only fetch keys that start with this prefix (optional).
-    :param suffix: Only fetch keys that end with this suffix (optional).
-    """
-    s3 = boto3.client('s3')
-
-    kwargs = {'Bucket': bucket, 'Prefix': prefix}
-    while True:
-        resp = s3.list_objects_v2(**kwargs)
-        if not resp.get('Contents'):
-            logging.warning("No keys found at {}/{} with the suffix {}".format(
-                bucket, prefix, suffix
-            ))
-            return None
-        for obj in resp['Contents']:
-            key = obj['Key']
-            if key.endswith(suffix):
-                yield key
-        try:
-            kwargs['ContinuationToken'] = resp['NextContinuationToken']
-        except KeyError:
-            break
-
-
-def do_work(bucket, path, extension, product_type):
+def do_work(bucket, path, extension, product_type, batch_size=100,
+            manifest=None, archive_missing=False, prefetch=None,
+            list_workers=1, inventory=None, stats=None):
     count = 0
     #limit = None
+    stats = stats or IndexStats()
+    manifest = IndexManifest(manifest) if manifest else None
     # List the bucket and get all the files with the extension we want
-    files = get_matching_s3_keys(bucket, prefix=path, suffix=extension)
+    if inventory:
+        objects = read_inventory(
+            inventory, bucket=bucket, prefix=path, suffix=extension)
+    else:
+        objects = get_matching_s3_objects(
+            bucket, prefix=path, suffix=extension, workers=list_workers)
+    files = (
+        obj['Key'] for obj in stats.timed('list', filter_changed(
+            objects, manifest, bucket, on_skip=stats.skip))
+    )
 
     s3_path_template = "s3://{bucket}/{file}"
 
-    for s3_path in files:
-        full_path = f"s3://{bucket}/{s3_path}"
-
-        # Generate raster from file path
-        raster = rasterio.open(full_path)
+    def on_done(uri, dataset, err):
+        stats.record(uri, err)
+        if manifest is not None and err is None:
+            manifest.record(uri, dataset.id)
+
+    session = IndexingSession(
+        products=[product_type],
+        batch_size=batch_size,
+        on_done=on_done,
+        stats=stats
+    )
+    try:
+        with session:
+            for s3_path in files:
+                full_path = s3_path_template.format(bucket=bucket, file=s3_path)
+                stats.begin(full_path)
+                try:
+                    index_file(session, bucket, s3_path, product_type,
+                               prefetch=prefetch)
+                except Exception as e:
+                    stats.failure(full_path, e)
+
+            if archive_missing and manifest is not None:
+                session.flush()
+                with stats.stage('archive'):
+                    archive_missing_datasets(manifest, session.index, bucket, path)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        stats.report()
+
+
+def index_file(session, bucket, s3_path, product_type, prefetch=None):
+    full_path = f"s3://{bucket}/{s3_path}"
+
+    # Generate raster from file path, or just decode its header
+    with session.stats.stage('open', full_path):
+        if prefetch:
+            raster = open_header(full_path, prefetch=prefetch)
+        else:
+            raster = rasterio.open(full_path)
 
         # Extract bounds and crs
         bounds = raster.bounds
         crs_string = raster.crs.to_wkt()
 
-        # hardcode date
-        to_date = datetime.datetime(year=2018, month=1, day=1)
-        from_date = datetime.datetime(year=2018, month=1, day=1)
-        centre_date = datetime.datetime(year=2018, month=1, day=1)
-
-        print (to_date)
-
-        # Handle coordinates
-        top = bounds.top
-        bottom = bounds.bottom
-        right = bounds.right
-        left = bounds.left
-
-        inProj = Proj(CRS.from_string(crs_string))
-        outProj = Proj(init='epsg:4326')
-        left_ll, bottom_ll = transform(inProj, outProj, left, bottom)
-        right_ll, top_ll = transform(inProj, outProj, right, top)
-
-        # unprojected
-        coordinates = {
-            'ul':
-                {'lon': left_ll, 'lat': top_ll},
-            'ur':
-                {'lon': right_ll, 'lat': top_ll},
-            'lr':
-                {'lon': right_ll, 'lat': bottom_ll},
-            'll':
-                {'lon': left_ll, 'lat': bottom_ll}
-        }
-
-        # projected
-        geo_ref_points = {
-            'ul':
-                {'x': left, 'y': top},
-            'ur':
-                {'x': right, 'y': top},
-            'lr':
-                {'x': right, 'y': bottom},
-            'll':
-                {'x': left, 'y': bottom}
-        }
-
-        # Build a dataset dictionary
-        docdict = {
-            'id': str(uuid.uuid5(uuid.NAMESPACE_URL, s3_path)),
-            'product_type': product_type,
-            'creation_dt': centre_date,
-            'platform': {'code': 'slim'},
-            'instrument': {'name': 'slim'},
-            'extent': {
-                'from_dt': from_date,
-                'to_dt': to_date,
-                'center_dt': centre_date,
-                'coord': coordinates,
-            },
-            'format': {'name': 'GeoTiff'},
-            'grid_spatial': {
-                'projection': {
-                    'geo_ref_points': geo_ref_points,
-                    'spatial_reference': crs_string,
+    # hardcode date
+    to_date = datetime.datetime(year=2018, month=1, day=1)
+    from_date = datetime.datetime(year=2018, month=1, day=1)
+    centre_date = datetime.datetime(year=2018, month=1, day=1)
+
+    print (to_date)
+
+    # Projected corners and their lon/lat
+    with session.stats.stage('footprint', full_path):
+        geo_ref_points, coordinates = footprint(bounds, crs_string)
+
+    # Build a dataset dictionary
+    docdict = {
+        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, s3_path)),
+        'product_type': product_type,
+        'creation_dt': centre_date,
+        'platform': {'code': 'slim'},
+        'instrument': {'name': 'slim'},
+        'extent': {
+            'from_dt': from_date,
+            'to_dt': to_date,
+            'center_dt': centre_date,
+            'coord': coordinates,
+        },
+        'format': {'name': 'GeoTiff'},
+        'grid_spatial': {
+            'projection': {
+                'geo_ref_points': geo_ref_points,
+                'spatial_reference': crs_string,
+            }
+        },
+        'image': {
+            'bands': {
+                'band1': {
+                    'path': full_path,
+                    'layer': 1,
                 }
-            },
-            'image': {
-                'bands': {
-                    'band1': {
-                        'path': full_path,
-                        'layer': 1,
-                    }
-                }
-            },
-
-            'lineage': {'source_datasets': {}}
-        }
-        
-        # Now index into the Datacube postgres DB
-        dc = datacube.Datacube()
-        index = dc.index
-        resolver = Doc2Dataset(index)
-        dataset, err = resolver(docdict, full_path)
-        if err is not None:
-            logging.error("%s", err)
-        else:
-            try:
-                index.datasets.add(dataset)
-            except changes.DocumentMismatchError as e:
-                index.datasets.update(dataset, {tuple(): changes.allow_any})
-            except Exception as e:
-                err = e
-                logging.error("Unhandled exception {}".format(e))
+            }
+        },
+
+        'lineage': {'source_datasets': {}}
+    }
+    
+    # Now queue it up to be indexed into the Datacube postgres DB
+    session.add(docdict, full_path)
+
+
+@click.command(help="Index the NSW DEM mapsheets")
+@click.option(
+    '--bucket', default='test.data.frontiersi.io', help="Bucket to index from")
+@click.option(
+    '--path', '-p', default='nsw-dem/elevation/mapsheet',
+    help="Pass the prefix of the object to the bucket")
+@click.option(
+    '--extension', '-e', default='.tif', help="Pass extension to filter on")
+@click.option(
+    '--product_type', '-t', default='dem',
+    help="The product type, or name for the product")
+@click.option(
+    '--batch_size', '-b', default=100, type=click.IntRange(min=1),
+    help="Number of datasets to commit to the index in one transaction")
+@click.option(
+    '--manifest', '-m', type=click.Path(dir_okay=False),
+    help="SQLite file recording what has been indexed, so that unchanged "
+         "objects are skipped on later runs")
+@click.option(
+    '--archive_missing', is_flag=True,
+    help="Archive datasets in the manifest whose objects have been removed")
+@click.option(
+    '--fast_headers', is_flag=True,
+    help="Read bounds and CRS from a ranged read of the GeoTIFF header, "
+         "falling back to rasterio when it can't be decoded")
+@click.option(
+    '--prefetch', default=DEFAULT_PREFETCH, type=click.IntRange(min=16),
+    help="Bytes to read for the header with --fast_headers")
+@click.option(
+    '--list_workers', default=1, type=click.IntRange(min=1),
+    help="Number of threads listing sub-prefixes of the bucket concurrently")
+@click.option(
+    '--inventory', '-i',
+    help="Read the keys from an S3 Inventory manifest.json, CSV or Parquet "
+         "file, or a list of keys, instead of listing the bucket")
+@click.option(
+    '--timings', type=click.Path(dir_okay=False),
+    help="Append the seconds each file took to index to this CSV file")
+@click.option(
+    '--metrics', type=click.Path(dir_okay=False),
+    help="Write a JSON summary of where the time went to this file")
+@click.option(
+    '--prometheus', type=click.Path(dir_okay=False),
+    help="Write the metrics to this file in the Prometheus text format")
+@click.option(
+    '--prometheus_port', type=click.IntRange(min=1),
+    help="Serve the metrics for Prometheus on this port while running")
+@click.option(
+    '--trace_slow', type=click.FloatRange(min=0.001),
+    help="Sample the stack of any stage that takes longer than this many "
+         "seconds, and include the slowest files' stacks in the metrics")
+def main(bucket, path, extension, product_type, batch_size, manifest,
+         archive_missing, fast_headers, prefetch, list_workers, inventory,
+         timings, metrics, prometheus, prometheus_port, trace_slow):
+    stats = IndexStats(
+        timings=timings, trace_slow=trace_slow, metrics_json=metrics,
+        prometheus=prometheus, prometheus_port=prometheus_port)
+    do_work(bucket, path, extension, product_type, batch_size=batch_size,
+            manifest=manifest, archive_missing=archive_missing,
+            prefetch=prefetch if fast_headers else None,
+            list_workers=list_workers, inventory=inventory, stats=stats)
+
 
 if __name__ == "__main__":
     logging.info("Script is starting up")
     # 'test.data.frontiersi.io', 'nsw-dem/elevation/elvis', 'tif', 'dem'
-    do_work('test.data.frontiersi.io', 'nsw-dem/elevation/mapsheet', '.tif', 'dem')
+    main()
     logging.info("Script ends")
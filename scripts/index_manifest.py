@@ -0,0 +1,150 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    uri TEXT PRIMARY KEY,
+    etag TEXT,
+    size INTEGER,
+    last_modified TEXT,
+    dataset_id TEXT,
+    indexed_at TEXT
+)
+"""
+
+
+def _fingerprint(obj):
+    last_modified = obj.get('LastModified')
+    if isinstance(last_modified, datetime):
+        last_modified = last_modified.isoformat()
+    return obj.get('ETag'), obj.get('Size'), last_modified
+
+
+def _unchanged(recorded, fingerprint):
+    """
+    Whether a row's fingerprint matches an object's. S3 event notifications
+    don't give the time an object was last modified, so when either side
+    hasn't got one the ETag and size have to do.
+    """
+    if recorded[2] is None or fingerprint[2] is None:
+        return recorded[:2] == fingerprint[:2]
+    return recorded == fingerprint
+
+
+class IndexManifest(object):
+    """
+    Local SQLite record of every object that has been indexed, so a re-run
+    only has to index objects that are new or have changed since last time.
+
+    Objects are dicts shaped like the entries of ``list_objects_v2``, with
+    ``ETag``, ``Size`` and ``LastModified``, which may be missing. An object
+    only gets a row once its dataset has been committed to the index, so a
+    run that dies part way through picks up where it left off.
+    """
+
+    def __init__(self, path, commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._seen = set()
+        self._uncommitted = 0
+
+    def changed(self, uri, obj):
+        """
+        Return True if ``obj`` is new or differs from what was last indexed
+        at ``uri``. Either way the uri is remembered as seen on this run.
+        """
+        fingerprint = _fingerprint(obj)
+        with self._lock:
+            self._seen.add(uri)
+            if fingerprint == (None, None, None):
+                # Nothing to compare against, so it has to be indexed again
+                self._pending[uri] = fingerprint
+                return True
+            row = self._conn.execute(
+                "SELECT etag, size, last_modified FROM objects WHERE uri = ?",
+                (uri,)
+            ).fetchone()
+            if row is not None and _unchanged(tuple(row), fingerprint):
+                return False
+            self._pending[uri] = fingerprint
+            return True
+
+    def record(self, uri, dataset_id, obj=None):
+        """
+        Record that ``uri`` has been indexed as ``dataset_id``. ``obj`` may be
+        left out if it was passed to ``changed`` by this same manifest.
+        """
+        with self._lock:
+            if obj is None:
+                fingerprint = self._pending.pop(uri, (None, None, None))
+            else:
+                fingerprint = _fingerprint(obj)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                (uri,) + fingerprint + (str(dataset_id), datetime.utcnow().isoformat())
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._commit()
+
+    def missing(self, prefix):
+        """
+        Return ``(uri, dataset_id)`` for everything under ``prefix`` that is in
+        the manifest but was not seen on this run. Only meaningful once the
+        whole prefix has been listed.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT uri, dataset_id FROM objects WHERE substr(uri, 1, ?) = ?",
+                (len(prefix), prefix)
+            ).fetchall()
+        return [(uri, dataset_id) for uri, dataset_id in rows if uri not in self._seen]
+
+    def forget(self, uris):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM objects WHERE uri = ?", [(uri,) for uri in uris])
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+        logging.info("Manifest %s saved", self.path)
+
+
+def filter_changed(objects, manifest, bucket, on_skip=None):
+    """
+    Pass through the listed objects that need indexing. Without a manifest
+    that is all of them.
+    """
+    for obj in objects:
+        uri = "s3://{}/{}".format(bucket, obj['Key'])
+        if manifest is None or manifest.changed(uri, obj):
+            yield obj
+        elif on_skip is not None:
+            on_skip(uri)
+
+
+def archive_missing_datasets(manifest, index, bucket, prefix=''):
+    """
+    Archive the datasets of objects that have gone from under ``prefix``
+    since the last run, and drop them from the manifest.
+    """
+    missing = manifest.missing("s3://{}/{}".format(bucket, prefix or ''))
+    if missing:
+        index.datasets.archive([dataset_id for _, dataset_id in missing])
+        manifest.forget([uri for uri, _ in missing])
+    logging.info("Archived %d datasets that are no longer in the bucket", len(missing))
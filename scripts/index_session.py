@@ -0,0 +1,112 @@
+import logging
+
+import datacube
+from datacube.index.hl import Doc2Dataset
+from datacube.utils import changes
+
+from index_stats import IndexStats
+
+
+def add_dataset(index, dataset):
+    """
+    Add a single dataset, updating it in place if it is already indexed with a
+    different document. Returns the error, if any.
+    """
+    try:
+        index.datasets.add(dataset)
+    except changes.DocumentMismatchError:
+        index.datasets.update(dataset, {tuple(): changes.allow_any})
+    except Exception as e:
+        logging.error("Unhandled exception {}".format(e))
+        return e
+    return None
+
+
+def _add_in_transaction(transaction, dataset):
+    doc = dataset.metadata_doc_without_lineage()
+    product_id = dataset.type.id
+    if not transaction.insert_dataset(doc, dataset.id, product_id):
+        # Already indexed, same as add() followed by update() with allow_any
+        transaction.update_dataset(doc, dataset.id, product_id)
+    for uri in dataset.uris or []:
+        transaction.insert_dataset_location(dataset.id, uri)
+
+
+class IndexingSession(object):
+    """
+    A single connection to the index for a whole indexing run.
+
+    Products are looked up once, when the resolver is built, and datasets are
+    written ``batch_size`` at a time inside one transaction. If a batch fails
+    it is rolled back and retried a dataset at a time, so one bad document
+    only costs itself.
+
+    ``on_done(uri, dataset, err)`` is called for every document once it has
+    been committed, or has failed. Time spent resolving documents and writing
+    them is recorded as the ``resolve`` and ``write`` stages of ``stats``.
+    """
+
+    def __init__(self, config=None, products=None, batch_size=100, on_done=None,
+                 stats=None):
+        self.stats = stats or IndexStats()
+        with self.stats.stage('connect'):
+            self.dc = datacube.Datacube(config=config, app='slim-indexer')
+            self.index = self.dc.index
+            self.resolver = Doc2Dataset(self.index, products=products)
+        self.batch_size = batch_size
+        self.on_done = on_done
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _done(self, uri, dataset, err):
+        if self.on_done is not None:
+            self.on_done(uri, dataset, err)
+
+    def fail(self, uri, err):
+        """Report a document that failed before it could be added."""
+        self._done(uri, None, err)
+
+    def add(self, doc, uri):
+        with self.stats.stage('resolve', uri):
+            dataset, err = self.resolver(doc, uri)
+        if err is not None:
+            logging.error("%s", err)
+            self._done(uri, dataset, err)
+            return
+
+        self._pending.append((uri, dataset))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        try:
+            with self.stats.stage('write'), self.index._db.begin() as transaction:
+                for uri, dataset in batch:
+                    _add_in_transaction(transaction, dataset)
+        except Exception as e:
+            logging.warning(
+                "Batch of %d datasets failed (%s), retrying one at a time",
+                len(batch), e
+            )
+            self.stats.count('batch_retries')
+            for uri, dataset in batch:
+                with self.stats.stage('write', uri):
+                    err = add_dataset(self.index, dataset)
+                self._done(uri, dataset, err)
+        else:
+            logging.info("Committed a batch of %d datasets", len(batch))
+            for uri, dataset in batch:
+                self._done(uri, dataset, None)
+
+    def close(self):
+        self.flush()
+        self.dc.close()
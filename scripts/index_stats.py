@@ -0,0 +1,447 @@
+import csv
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import traceback
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, sleep, time
+
+# Upper bounds of the per-file latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+
+# Limits on what the slow trace sampler keeps
+MAX_SAMPLED_KEYS = 1000
+MAX_STACKS_PER_KEY = 5
+
+
+class TimingLog(object):
+    """
+    Appends a ``key,seconds`` row to a CSV file for every key that finishes.
+    Lines are written whole, so several processes can append to one file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a', buffering=1, newline='')
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        self._lock = threading.Lock()
+
+    def write(self, key, seconds):
+        with self._lock:
+            self._writer.writerow([key, '{:.6f}'.format(seconds)])
+
+    def close(self):
+        self._file.close()
+
+
+class Histogram(object):
+    """Counts of values in fixed buckets, as a Prometheus histogram has them."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, counts, total):
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+    def quantile(self, q):
+        """
+        Estimate the ``q`` quantile by interpolating within its bucket, the
+        same way Prometheus' histogram_quantile does.
+        """
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                if i == len(self.bounds):
+                    # Nothing to interpolate towards past the last bound
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class StageTimer(object):
+    __slots__ = ('calls', 'seconds', 'longest')
+
+    def __init__(self, calls=0, seconds=0.0, longest=0.0):
+        self.calls = calls
+        self.seconds = seconds
+        self.longest = longest
+
+    def add(self, calls, seconds, longest):
+        self.calls += calls
+        self.seconds += seconds
+        self.longest = max(self.longest, longest)
+
+
+class IndexStats(object):
+    """
+    Thread safe tally of an indexing run: how many keys were indexed, how
+    long it took and which keys failed and why.
+
+    It also keeps timers for each stage of the work (listing, opening
+    rasters, resolving and writing datasets and so on), counters, and a
+    histogram of how long each key took from ``begin(key)`` until it was
+    indexed or failed. ``report()`` logs all of that, and writes it out as
+    JSON or Prometheus text if asked to.
+
+    :param timings: CSV file to append each key's latency to.
+    :param trace_slow: Sample the stack of any stage that has been running
+        for longer than this many seconds, to show where slow files spend
+        their time.
+    :param metrics_json: File to write a JSON summary to at the end.
+    :param prometheus: File to write metrics to at the end, in the Prometheus
+        text format, e.g. for node_exporter's textfile collector.
+    :param prometheus_port: Serve the metrics on this port while running.
+    :param slowest: Number of slowest keys to keep track of.
+    """
+
+    def __init__(self, timings=None, trace_slow=None, metrics_json=None,
+                 prometheus=None, prometheus_port=None, slowest=10):
+        self.started = time()
+        self.indexed = 0
+        self.skipped = 0
+        self.errors = OrderedDict()
+        self.timings = TimingLog(timings) if timings else None
+        self.counters = Counter()
+        self.stages = OrderedDict()
+        self.latency = Histogram()
+        self.slowest = []
+        self.samples = {}
+        self.metrics_json = metrics_json
+        self.prometheus = prometheus
+        self._slowest_count = slowest
+        self._begun = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+        self.trace_slow = trace_slow
+        if trace_slow:
+            sampler = threading.Thread(target=self._sample, name='trace-sampler')
+            sampler.daemon = True
+            sampler.start()
+
+        if prometheus_port:
+            self._serve(prometheus_port)
+
+    @property
+    def processed(self):
+        return self.indexed + len(self.errors)
+
+    def begin(self, key, at=None):
+        """Start the clock on ``key``, or note that it started ``at`` a time()."""
+        with self._lock:
+            self._begun[key] = time() if at is None else at
+
+    def _finished(self, key):
+        begun = self._begun.pop(key, None)
+        if begun is None:
+            return
+        seconds = time() - begun
+        self.latency.observe(seconds)
+        if len(self.slowest) < self._slowest_count:
+            heapq.heappush(self.slowest, (seconds, key))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, key))
+        if self.timings is not None:
+            self.timings.write(key, seconds)
+
+    def success(self, key):
+        with self._lock:
+            self.indexed += 1
+            self._finished(key)
+
+    def skip(self, key):
+        with self._lock:
+            self.skipped += 1
+
+    def failure(self, key, err):
+        with self._lock:
+            self.errors[key] = err
+            self._finished(key)
+        logging.error("Failed on %s: %s", key, err)
+
+    def record(self, key, err=None):
+        if err is None:
+            self.success(key)
+        else:
+            self.failure(key, err)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def stage(self, name, key=None):
+        """Time the body as part of stage ``name``, working on ``key``."""
+        started = perf_counter()
+        if self.trace_slow:
+            # Let the sampler know what this thread is up to
+            ident = threading.get_ident()
+            previous = self._active.get(ident)
+            self._active[ident] = (name, key, started)
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started
+            if self.trace_slow:
+                if previous is None:
+                    self._active.pop(ident, None)
+                else:
+                    self._active[ident] = previous
+            with self._lock:
+                timer = self.stages.get(name)
+                if timer is None:
+                    timer = self.stages[name] = StageTimer()
+                timer.add(1, seconds, seconds)
+
+    def timed(self, name, iterable):
+        """Pass ``iterable`` through, timing how long each item takes to come."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _sample(self):
+        interval = min(max(self.trace_slow / 4.0, 0.01), 1.0)
+        while True:
+            sleep(interval)
+            now = perf_counter()
+            frames = None
+            for ident, (name, key, started) in list(self._active.items()):
+                if now - started < self.trace_slow:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                label = key if key is not None else 'stage:{}'.format(name)
+                stacks = self.samples.get(label)
+                if stacks is None:
+                    if len(self.samples) >= MAX_SAMPLED_KEYS:
+                        continue
+                    stacks = self.samples[label] = Counter()
+                stack = ''.join(traceback.format_stack(frame))
+                if stack in stacks or len(stacks) < MAX_STACKS_PER_KEY:
+                    stacks[stack] += 1
+
+    def snapshot(self):
+        """Everything collected so far, as plain data that can be pickled or merged."""
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+            traced = {key for _, key in slowest}
+            return {
+                'indexed': self.indexed,
+                'skipped': self.skipped,
+                'errors': OrderedDict((key, str(err)) for key, err in self.errors.items()),
+                'counters': dict(self.counters),
+                'stages': OrderedDict(
+                    (name, [timer.calls, timer.seconds, timer.longest])
+                    for name, timer in self.stages.items()),
+                'latency': [list(self.latency.counts), self.latency.sum],
+                'slowest': slowest,
+                'samples': {
+                    key: stacks.most_common() for key, stacks in self.samples.items()
+                    if key in traced or key.startswith('stage:')
+                },
+            }
+
+    def merge(self, snapshot):
+        """Add in a ``snapshot()`` taken in another process."""
+        with self._lock:
+            self.indexed += snapshot['indexed']
+            self.skipped += snapshot['skipped']
+            self.errors.update(snapshot['errors'])
+            self.counters.update(snapshot['counters'])
+            for name, (calls, seconds, longest) in snapshot['stages'].items():
+                timer = self.stages.get(name)
+                if timer is None:
+                    timer = self.stages[name] = StageTimer()
+                timer.add(calls, seconds, longest)
+            self.latency.merge(*snapshot['latency'])
+            for seconds, key in snapshot['slowest']:
+                if len(self.slowest) < self._slowest_count:
+                    heapq.heappush(self.slowest, (seconds, key))
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, (seconds, key))
+            for key, stacks in snapshot['samples'].items():
+                self.samples.setdefault(key, Counter()).update(dict(stacks))
+
+    def summary(self):
+        """A JSON friendly summary of the run."""
+        snapshot = self.snapshot()
+        elapsed = time() - self.started
+        processed = snapshot['indexed'] + len(snapshot['errors'])
+        return OrderedDict([
+            ('elapsed_seconds', round(elapsed, 3)),
+            ('processed', processed),
+            ('indexed', snapshot['indexed']),
+            ('failed', len(snapshot['errors'])),
+            ('unchanged', snapshot['skipped']),
+            ('keys_per_second', round(processed / elapsed, 3) if elapsed > 0 else 0.0),
+            ('counters', snapshot['counters']),
+            ('stages', OrderedDict(
+                (name, OrderedDict([
+                    ('calls', calls),
+                    ('seconds', round(seconds, 6)),
+                    ('mean_ms', round(seconds / calls * 1000, 3) if calls else None),
+                    ('max_ms', round(longest * 1000, 3)),
+                ]))
+                for name, (calls, seconds, longest) in snapshot['stages'].items())),
+            ('latency', OrderedDict([
+                ('count', self.latency.count),
+                ('sum_seconds', round(self.latency.sum, 6)),
+                ('p50_seconds', self.latency.quantile(0.5)),
+                ('p90_seconds', self.latency.quantile(0.9)),
+                ('p99_seconds', self.latency.quantile(0.99)),
+                ('buckets', OrderedDict(
+                    [(str(bound), count) for bound, count in zip(self.latency.bounds, self.latency.counts)]
+                    + [('+Inf', self.latency.counts[-1])])),
+            ])),
+            ('slowest', [
+                OrderedDict([
+                    ('key', key),
+                    ('seconds', round(seconds, 6)),
+                    ('samples', [{'count': n, 'stack': stack}
+                                 for stack, n in snapshot['samples'].get(key, [])]),
+                ])
+                for seconds, key in snapshot['slowest']
+            ]),
+            ('slow_stages', OrderedDict(
+                (key[len('stage:'):], [{'count': n, 'stack': stack} for stack, n in stacks])
+                for key, stacks in snapshot['samples'].items() if key.startswith('stage:'))),
+            ('errors', snapshot['errors']),
+        ])
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP slim_index_files_total Keys processed by the indexer, by result.',
+            '# TYPE slim_index_files_total counter',
+            'slim_index_files_total{{result="indexed"}} {}'.format(snapshot['indexed']),
+            'slim_index_files_total{{result="failed"}} {}'.format(len(snapshot['errors'])),
+            'slim_index_files_total{{result="unchanged"}} {}'.format(snapshot['skipped']),
+            '# HELP slim_index_stage_seconds_total Time spent in each stage of indexing.',
+            '# TYPE slim_index_stage_seconds_total counter',
+        ]
+        for name, (calls, seconds, _) in snapshot['stages'].items():
+            lines.append('slim_index_stage_seconds_total{{stage="{}"}} {:.6f}'.format(name, seconds))
+        lines += [
+            '# HELP slim_index_stage_calls_total Times each stage of indexing ran.',
+            '# TYPE slim_index_stage_calls_total counter',
+        ]
+        for name, (calls, seconds, _) in snapshot['stages'].items():
+            lines.append('slim_index_stage_calls_total{{stage="{}"}} {}'.format(name, calls))
+        lines += [
+            '# HELP slim_index_events_total Other things counted while indexing.',
+            '# TYPE slim_index_events_total counter',
+        ]
+        for name, count in sorted(snapshot['counters'].items()):
+            lines.append('slim_index_events_total{{event="{}"}} {}'.format(name, count))
+        lines += [
+            '# HELP slim_index_file_latency_seconds Time from starting on a key to indexing it.',
+            '# TYPE slim_index_file_latency_seconds histogram',
+        ]
+        counts, total = snapshot['latency']
+        cumulative = 0
+        for bound, count in zip(self.latency.bounds, counts):
+            cumulative += count
+            lines.append('slim_index_file_latency_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+        cumulative += counts[-1]
+        lines += [
+            'slim_index_file_latency_seconds_bucket{{le="+Inf"}} {}'.format(cumulative),
+            'slim_index_file_latency_seconds_sum {:.6f}'.format(total),
+            'slim_index_file_latency_seconds_count {}'.format(cumulative),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def _serve(self, port):
+        stats = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.prometheus_text().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('', port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+        thread.daemon = True
+        thread.start()
+        logging.info("Serving metrics on port %d", port)
+
+    def report(self):
+        elapsed = time() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        logging.info(
+            "Processed %d keys in %.1fs (%.2f keys/s): %d indexed, %d failed, "
+            "%d unchanged", self.processed, elapsed, rate, self.indexed,
+            len(self.errors), self.skipped
+        )
+        for name, timer in self.stages.items():
+            logging.info(
+                "  %-10s %8d calls %10.2fs total %9.2fms mean %9.2fms max",
+                name, timer.calls, timer.seconds,
+                timer.seconds / timer.calls * 1000 if timer.calls else 0.0,
+                timer.longest * 1000
+            )
+        if self.counters:
+            logging.info("  %s", ', '.join(
+                '{} {}'.format(name, count) for name, count in sorted(self.counters.items())))
+        if self.latency.count:
+            logging.info(
+                "  Latency per key: p50 %.3fs, p90 %.3fs, p99 %.3fs",
+                self.latency.quantile(0.5), self.latency.quantile(0.9),
+                self.latency.quantile(0.99)
+            )
+        for key, err in self.errors.items():
+            logging.info("  %s: %s", key, err)
+
+        if self.metrics_json:
+            _write_atomically(self.metrics_json, json.dumps(self.summary(), indent=2))
+        if self.prometheus:
+            _write_atomically(self.prometheus, self.prometheus_text())
+        if self.timings is not None:
+            self.timings.close()
+            self.timings = None
+
+
+def _write_atomically(path, text):
+    # Scrapers should never see a half written file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
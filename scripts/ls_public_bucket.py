@@ -3,7 +3,6 @@
 from xml.etree import ElementTree
 from pathlib import Path
 import os
-from osgeo import osr
 import dateutil
 from dateutil import parser
 from datetime import timedelta
@@ -18,7 +17,17 @@ from datacube.index.hl import Doc2Dataset
 from datacube.utils import changes
 from ruamel.yaml import YAML
 
-from multiprocessing import Process, current_process, Queue, Manager, cpu_count
+from footprint import points_to_coords
+from index_manifest import IndexManifest, archive_missing_datasets, filter_changed
+from index_stats import IndexStats
+from mtl_parser import parse_mtl
+from s3_inventory import read_inventory
+from s3_listing import get_matching_s3_objects
+
+import queue
+import signal
+import threading
+from multiprocessing import Process, current_process, Queue, cpu_count
 from time import sleep, time
 from queue import Empty
 
@@ -26,8 +35,6 @@ GUARDIAN = "GUARDIAN_QUEUE_EMPTY"
 AWS_PDS_TXT_SUFFIX = "MTL.txt"
 
 
-MTL_PAIRS_RE = re.compile(r'(\w+)\s=\s(.*)')
-
 bands_ls8 = [('1', 'coastal_aerosol'),
              ('2', 'blue'),
              ('3', 'green'),
@@ -50,31 +57,6 @@ bands_ls7 = [('1', 'blue'),
              ('QUALITY', 'quality')]
 
 
-def _parse_value(s):
-    s = s.strip('"')
-    for parser in [int, float]:
-        try:
-            return parser(s)
-        except ValueError:
-            pass
-    return s
-
-
-def _parse_group(lines):
-    tree = {}
-    for line in lines:
-        match = MTL_PAIRS_RE.findall(line)
-        if match:
-            key, value = match[0]
-            if key == 'GROUP':
-                tree[value] = _parse_group(lines)
-            elif key == 'END_GROUP':
-                break
-            else:
-                tree[key] = _parse_value(value)
-    return tree
-
-
 def get_geo_ref_points(info):
     return {
         'ul': {'x': info['CORNER_UL_PROJECTION_X_PRODUCT'], 'y': info['CORNER_UL_PROJECTION_Y_PRODUCT']},
@@ -84,16 +66,6 @@ def get_geo_ref_points(info):
     }
 
 
-def get_coords(geo_ref_points, spatial_ref):
-    t = osr.CoordinateTransformation(spatial_ref, spatial_ref.CloneGeogCS())
-
-    def transform(p):
-        lon, lat, z = t.TransformPoint(p['x'], p['y'])
-        return {'lon': lon, 'lat': lat}
-
-    return {key: transform(p) for key, p in geo_ref_points.items()}
-
-
 def satellite_ref(sat):
     """
     To load the band_names for referencing either LANDSAT8 or LANDSAT7 bands
@@ -126,10 +98,8 @@ def make_metadata_doc(mtl_data, bucket_name, object_key):
     sensing_time = acquisition_date + ' ' + scene_center_time
     cs_code = 32600 + mtl_data['PROJECTION_PARAMETERS']['UTM_ZONE']
     label = mtl_metadata_info['LANDSAT_SCENE_ID']
-    spatial_ref = osr.SpatialReference()
-    spatial_ref.ImportFromEPSG(cs_code)
     geo_ref_points = get_geo_ref_points(mtl_product_info)
-    coordinates = get_coords(geo_ref_points, spatial_ref)
+    coordinates = points_to_coords(geo_ref_points, 'EPSG:%s' % cs_code)
     bands = satellite_ref(satellite)
     doc = {
         'id': str(uuid.uuid5(uuid.NAMESPACE_URL, get_s3_url(bucket_name, object_key))),
@@ -188,6 +158,8 @@ def archive_document(doc, uri, index, sources_policy):
     index.datasets.archive(get_ids(dataset))
     logging.info("Archiving %s and all sources of %s", dataset.id, dataset.id)
 
+    return dataset, err
+
 
 def add_dataset(doc, uri, index, sources_policy):
     logging.info("Indexing %s", uri)
@@ -206,68 +178,252 @@ def add_dataset(doc, uri, index, sources_policy):
 
     return dataset, err
 
-def worker(config, bucket_name, prefix, suffix, start_date, end_date, func, unsafe, sources_policy, queue):
-    dc=datacube.Datacube(config=config)
-    index = dc.index
-    s3 = boto3.resource("s3")
-    safety = 'safe' if not unsafe else 'unsafe'
+def parse_document(raw, key, bucket_name, suffix, safety):
+    if suffix == AWS_PDS_TXT_SUFFIX:
+        # Attempt to process text document
+        txt_doc = parse_mtl(raw)['L1_METADATA_FILE']
+        return make_metadata_doc(txt_doc, bucket_name, key)
+    yaml = YAML(typ=safety, pure=False)
+    yaml.default_flow_style = False
+    return yaml.load(raw)
+
+
+def in_date_range(cdt, start_date, end_date):
+    # Use the fact lexicographical ordering matches the chronological ordering
+    return (start_date is None or cdt >= start_date) and (end_date is None or cdt < end_date)
+
 
+def _put(bounded, item, consumers_alive):
+    """
+    Put ``item`` on the bounded queue, waiting while it is full as long as
+    ``consumers_alive()`` says something is still taking from it. Returns
+    False if nothing is.
+    """
     while True:
         try:
-            key = queue.get(timeout=60)
-            if key == GUARDIAN:
-                break
-            logging.info("Processing %s %s", key, current_process())
-            obj = s3.Object(bucket_name, key).get(ResponseCacheControl='no-cache')
-            raw = obj['Body'].read()
-            if suffix == AWS_PDS_TXT_SUFFIX:
-                # Attempt to process text document
-                raw_string = raw.decode('utf8')
-                txt_doc = _parse_group(iter(raw_string.split("\n")))['L1_METADATA_FILE']
-                data = make_metadata_doc(txt_doc, bucket_name, key)
-            else:
-                yaml = YAML(typ=safety, pure=False)
-                yaml.default_flow_style = False
-                data = yaml.load(raw)
-            uri = get_s3_url(bucket_name, key)
-            cdt = data['creation_dt']
-            # Use the fact lexicographical ordering matches the chronological ordering
-            if cdt >= start_date and cdt < end_date:
-                logging.info("calling %s", func)
-                func(data, uri, index, sources_policy)
-            queue.task_done()
-        except Empty:
+            bounded.put(item, timeout=1)
+            return True
+        except queue.Full:
+            if not consumers_alive():
+                return False
+
+
+def fetch_worker(s3, bucket_name, batches, documents, stats, workers_alive):
+    """
+    Fetch the documents of each batch of keys from S3 and pass them on to the
+    index workers. Blocks while the index workers are behind, and stops if
+    they have all gone.
+    """
+    while True:
+        batch = batches.get()
+        if batch == GUARDIAN:
             break
-        except EOFError:
+        fetched = []
+        for key, listed in batch:
+            uri = get_s3_url(bucket_name, key)
+            started = time()
+            try:
+                with stats.stage('fetch', uri):
+                    obj = s3.get_object(Bucket=bucket_name, Key=key, ResponseCacheControl='no-cache')
+                    fetched.append((key, listed, obj['Body'].read(), started))
+            except Exception as e:
+                stats.begin(uri, at=started)
+                stats.failure(uri, e)
+        stats.count('fetched', len(fetched))
+        if fetched and not _put(documents, fetched, workers_alive):
+            logging.error("Every index worker has stopped, no more documents will be fetched")
             break
 
 
-def iterate_datasets(bucket_name, config, prefix, suffix, start_date, end_date, func, unsafe, sources_policy):
-    manager = Manager()
-    queue = manager.Queue()
+def worker(config, bucket_name, suffix, start_date, end_date, func, unsafe, sources_policy, documents, results,
+           report_manifest=False, timings_path=None, trace_slow=None):
+    """
+    Parse and index batches of documents until the GUARDIAN comes through,
+    then put a snapshot of this worker's IndexStats on ``results``. The
+    latency of each document is counted from when it started to be fetched.
 
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    logging.info("Bucket : %s prefix: %s ", bucket_name, str(prefix))
-    # safety = 'safe' if not unsafe else 'unsafe'
-    worker_count = cpu_count() * 2
+    With ``report_manifest``, what each batch indexed or archived is put on
+    ``results`` too, for the main process to record in the manifest. Only it
+    writes to the manifest, so the workers never wait on each other's locks.
+    """
+    # Ctrl-C is for the main process, which stops listing and lets us drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stats = IndexStats(timings=timings_path, trace_slow=trace_slow)
+    with stats.stage('connect'):
+        dc = datacube.Datacube(config=config)
+    index = dc.index
+    safety = 'safe' if not unsafe else 'unsafe'
 
-    processess = []
-    for i in range(worker_count):
-        proc = Process(target=worker, args=(config, bucket_name, prefix, suffix, start_date, end_date, func, unsafe, sources_policy, queue,))
-        processess.append(proc)
-        proc.start()
+    try:
+        while True:
+            batch = documents.get()
+            if batch == GUARDIAN:
+                break
+            indexed, archived = [], []
+            for key, listed, raw, started in batch:
+                logging.info("Processing %s %s", key, current_process())
+                uri = get_s3_url(bucket_name, key)
+                stats.begin(uri, at=started)
+                try:
+                    with stats.stage('parse', uri):
+                        data = parse_document(raw, key, bucket_name, suffix, safety)
+                except Exception as e:
+                    stats.failure(uri, e)
+                    continue
+                stats.count('parsed')
+
+                try:
+                    in_range = in_date_range(data['creation_dt'], start_date, end_date)
+                except Exception as e:
+                    stats.failure(uri, e)
+                    continue
+                if not in_range:
+                    stats.count('out_of_range')
+                    continue
+
+                logging.info("calling %s", func)
+                try:
+                    with stats.stage('index', uri):
+                        dataset, err = func(data, uri, index, sources_policy)
+                except Exception as e:
+                    dataset, err = None, e
+                stats.record(uri, err)
+                if report_manifest and err is None and dataset is not None:
+                    if func is archive_document:
+                        archived.append(uri)
+                    else:
+                        indexed.append((uri, str(dataset.id), listed))
+            if indexed:
+                results.put(('indexed', indexed))
+            if archived:
+                results.put(('archived', archived))
+    finally:
+        if stats.timings is not None:
+            stats.timings.close()
+        dc.close()
+        results.put(('stats', stats.snapshot()))
+
+
+def _collect_results(results, processes, stats, manifest=None):
+    """
+    Record what the index workers report in ``manifest`` as it comes in, and
+    merge in each worker's stats when it finishes, or give up on those that
+    died without them.
+    """
+    remaining = len(processes)
+    while remaining:
+        try:
+            kind, payload = results.get(timeout=1)
+        except Empty:
+            if not any(proc.is_alive() for proc in processes) and results.empty():
+                logging.error("%d index workers exited without reporting", remaining)
+                break
+            continue
+        if kind == 'stats':
+            stats.merge(payload)
+            remaining -= 1
+            continue
+        try:
+            if kind == 'indexed':
+                for uri, dataset_id, listed in payload:
+                    manifest.record(uri, dataset_id, listed)
+            else:
+                manifest.forget(payload)
+        except Exception as e:
+            logging.error("Couldn't update the manifest for %d documents: %s", len(payload), e)
 
-    for obj in bucket.objects.filter(Prefix = str(prefix)):
-        if (obj.key.endswith(suffix)):
-            queue.put(obj.key)
 
-    for i in range(worker_count):
-        queue.put(GUARDIAN)
+def iterate_datasets(bucket_name, config, prefix, suffix, start_date, end_date, func, unsafe, sources_policy,
+                     manifest_path=None, archive_missing=False, list_workers=1, inventory=None,
+                     fetch_workers=8, index_workers=None, batch_size=10, queue_size=None, timings_path=None,
+                     stats=None):
+    """
+    Run the listing, fetch and index stages as a pipeline:
 
-    for proc in processess:
-        proc.join()
+    * the main thread lists the keys and groups them into batches
+    * ``fetch_workers`` threads download the documents of each batch
+    * ``index_workers`` processes parse and index them, each with its own
+      connection to the database
 
+    Stages are joined by bounded queues, so a slow stage holds up the ones
+    before it rather than letting work pile up in memory. The index workers'
+    stats are merged into ``stats`` when they finish.
+    """
+    logging.info("Bucket : %s prefix: %s ", bucket_name, str(prefix))
+    index_workers = index_workers or cpu_count()
+    queue_size = queue_size or index_workers * 2
+    stats = stats or IndexStats()
+    # Only this process writes to the manifest. Unchanged documents are
+    # only skipped when adding, archiving has to see them all
+    manifest = IndexManifest(manifest_path) if manifest_path else None
+    skip_unchanged = manifest if func is not archive_document else None
+
+    documents = Queue(maxsize=queue_size)
+    results = Queue()
+    processes = []
+    for i in range(index_workers):
+        proc = Process(target=worker, args=(config, bucket_name, suffix, start_date, end_date, func, unsafe,
+                                            sources_policy, documents, results, manifest is not None,
+                                            timings_path, stats.trace_slow,))
+        processes.append(proc)
+        proc.start()
+    collector = threading.Thread(target=_collect_results, args=(results, processes, stats, manifest))
+    collector.start()
+
+    def workers_alive():
+        return any(proc.is_alive() for proc in processes)
+
+    def fetchers_alive():
+        return any(thread.is_alive() for thread in fetchers)
+
+    s3 = boto3.client('s3')
+    batches = queue.Queue(maxsize=fetch_workers * 2)
+    fetchers = []
+    for i in range(fetch_workers):
+        thread = threading.Thread(target=fetch_worker,
+                                  args=(s3, bucket_name, batches, documents, stats, workers_alive))
+        fetchers.append(thread)
+        thread.start()
+
+    if inventory:
+        listed = read_inventory(inventory, bucket=bucket_name, prefix=prefix, suffix=suffix)
+    else:
+        listed = get_matching_s3_objects(bucket_name, prefix=prefix, suffix=suffix, workers=list_workers)
+
+    completed = False
+    try:
+        batch = []
+        for obj in stats.timed('list', filter_changed(listed, skip_unchanged, bucket_name, on_skip=stats.skip)):
+            stats.count('listed')
+            batch.append((obj['Key'], obj))
+            if len(batch) >= batch_size:
+                if not _put(batches, batch, fetchers_alive):
+                    raise RuntimeError("Every index worker has stopped")
+                batch = []
+        if batch and not _put(batches, batch, fetchers_alive):
+            raise RuntimeError("Every index worker has stopped")
+        completed = True
+    except KeyboardInterrupt:
+        logging.warning("Interrupted, finishing the documents already listed")
+    finally:
+        # Let every stage drain what it has, then shut it down
+        for thread in fetchers:
+            _put(batches, GUARDIAN, fetchers_alive)
+        for thread in fetchers:
+            thread.join()
+        for proc in processes:
+            _put(documents, GUARDIAN, workers_alive)
+        collector.join()
+        for proc in processes:
+            proc.join()
+        stats.report()
+
+    if manifest is not None:
+        # Objects that were never listed can't be told apart from removed ones
+        if archive_missing and completed and func is not archive_document:
+            with datacube.Datacube(config=config) as dc:
+                archive_missing_datasets(manifest, dc.index, bucket_name, prefix)
+        manifest.close()
 
 
 @click.command(help= "Enter Bucket name. Optional to enter configuration file to access a different database")
@@ -281,10 +437,47 @@ def iterate_datasets(bucket_name, config, prefix, suffix, start_date, end_date,
 @click.option('--archive', is_flag=True, help="If true, datasets found in the specified bucket and prefix will be archived")
 @click.option('--unsafe', is_flag=True, help="If true, YAML will be parsed unsafely. Only use on trusted datasets. Only valid if suffix is yaml")
 @click.option('--sources_policy', default="verify", help="verify, ensure, skip")
-def main(bucket_name, config, prefix, suffix, start_date, end_date, archive, unsafe, sources_policy):
+@click.option('--manifest', '-m', type=click.Path(dir_okay=False),
+              help="SQLite file recording what has been indexed, so that unchanged documents are skipped on later runs")
+@click.option('--archive_missing', is_flag=True,
+              help="If true, datasets in the manifest whose documents have been removed from the bucket are archived")
+@click.option('--list_workers', default=1, type=click.IntRange(min=1),
+              help="Number of threads listing sub-prefixes of the bucket concurrently")
+@click.option('--inventory', '-i',
+              help="Read the keys from an S3 Inventory manifest.json, CSV or Parquet file, or a list of keys, "
+                   "instead of listing the bucket")
+@click.option('--fetch_workers', default=8, type=click.IntRange(min=1),
+              help="Number of threads fetching documents from S3")
+@click.option('--index_workers', '-w', type=click.IntRange(min=1),
+              help="Number of processes parsing and indexing documents, each with its own database connection. "
+                   "Defaults to the number of CPUs")
+@click.option('--batch_size', '-b', default=10, type=click.IntRange(min=1),
+              help="Number of documents handed from one stage to the next at a time")
+@click.option('--queue_size', type=click.IntRange(min=1),
+              help="Number of fetched batches that may wait for an index worker. Defaults to twice the index workers")
+@click.option('--timings', type=click.Path(dir_okay=False),
+              help="Append the seconds each document took from fetching to indexing to this CSV file")
+@click.option('--metrics', type=click.Path(dir_okay=False),
+              help="Write a JSON summary of where the time went to this file")
+@click.option('--prometheus', type=click.Path(dir_okay=False),
+              help="Write the metrics to this file in the Prometheus text format")
+@click.option('--prometheus_port', type=click.IntRange(min=1),
+              help="Serve the metrics for Prometheus on this port while running. "
+                   "The index workers' figures are added when they finish")
+@click.option('--trace_slow', type=click.FloatRange(min=0.001),
+              help="Sample the stack of any stage that takes longer than this many seconds, "
+                   "and include the slowest documents' stacks in the metrics")
+def main(bucket_name, config, prefix, suffix, start_date, end_date, archive, unsafe, sources_policy, manifest,
+         archive_missing, list_workers, inventory, fetch_workers, index_workers, batch_size, queue_size, timings,
+         metrics, prometheus, prometheus_port, trace_slow):
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
     action = archive_document if archive else add_dataset
-    iterate_datasets(bucket_name, config, prefix, suffix, start_date, end_date, action, unsafe, sources_policy)
+    iterate_datasets(bucket_name, config, prefix, suffix, start_date, end_date, action, unsafe, sources_policy,
+                     manifest_path=manifest, archive_missing=archive_missing, list_workers=list_workers,
+                     inventory=inventory, fetch_workers=fetch_workers, index_workers=index_workers,
+                     batch_size=batch_size, queue_size=queue_size, timings_path=timings,
+                     stats=IndexStats(trace_slow=trace_slow, metrics_json=metrics, prometheus=prometheus,
+                                      prometheus_port=prometheus_port))
    
 
 if __name__ == "__main__":
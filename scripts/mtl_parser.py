@@ -0,0 +1,100 @@
+"""
+Parsers for the ``MTL.txt`` metadata files that come with Landsat scenes.
+
+``parse_mtl`` tokenizes the raw bytes of a file in a single pass, without
+decoding the whole body or splitting it into lines first. ``_parse_group`` is
+the original line by line parser, kept as the reference it has to agree with.
+"""
+import re
+
+MTL_PAIRS_RE = re.compile(r'(\w+)\s=\s(.*)')
+
+# Same pairs as MTL_PAIRS_RE, but over the whole body at once, so the
+# whitespace around the "=" mustn't match the end of the line. A key starts a
+# word, which saves trying every position within one. The common
+# shapes of value are told apart by the regex itself: text that can't be a
+# number (it starts with a letter other than the n of nan or the i of inf, or
+# is a date or time), then integers and floats, then anything else.
+_MTL_TOKEN_RE = re.compile(rb'''
+    \b(\w+)[\t\x0b\x0c\r\x1c-\x1f\x20]=[\t\x0b\x0c\r\x1c-\x1f\x20]
+    (?:
+        "?((?:[A-HJ-MO-Za-hj-mo-z]|\d+[-:])[^"\n]*)"?$
+      | "?([+-]?\d+)"?$
+      | "?([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"?$
+      | (.*)
+    )''', re.MULTILINE | re.VERBOSE)
+
+# Values that int() and float() are sure to take, and the same answer as they
+# would give for the decoded string
+_INT_RE = re.compile(rb'\s*[+-]?\d+\s*')
+_FLOAT_RE = re.compile(rb'\s*[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\s*')
+
+# Anything float() might still take, such as nan, inf, 1_000 or non-ASCII
+# digits and whitespace, is left to _parse_value to decide
+_MAYBE_NUMBER_RE = re.compile(rb'\A\s*[+-]?[nNiI]|[^\t\x0b\x0c\r\x20-\x7e]|_')
+
+
+def _parse_value(s):
+    s = s.strip('"')
+    for parser in [int, float]:
+        try:
+            return parser(s)
+        except ValueError:
+            pass
+    return s
+
+
+def _parse_group(lines):
+    tree = {}
+    for line in lines:
+        match = MTL_PAIRS_RE.findall(line)
+        if match:
+            key, value = match[0]
+            if key == 'GROUP':
+                tree[value] = _parse_group(lines)
+            elif key == 'END_GROUP':
+                break
+            else:
+                tree[key] = _parse_value(value)
+    return tree
+
+
+def _parse_bytes_value(raw):
+    s = raw.strip(b'"')
+    if _INT_RE.fullmatch(s):
+        return int(s)
+    if _FLOAT_RE.fullmatch(s):
+        return float(s)
+    if not s or _MAYBE_NUMBER_RE.search(s):
+        return _parse_value(s.decode('utf8'))
+    return s.decode('utf8')
+
+
+def parse_mtl(body):
+    """
+    Parse the bytes of an MTL file into nested dicts, one per GROUP, giving
+    the same result as ``_parse_group`` on the decoded lines. Keys are
+    expected to be ASCII, as they are in every MTL file.
+    """
+    tree = {}
+    groups = [tree]
+    for match in _MTL_TOKEN_RE.finditer(body):
+        key, text, integer, real, other = match.groups()
+        if key == b'GROUP':
+            # Group names are used as they are, quotes and all
+            group = {}
+            groups[-1][match.group(0)[len(key) + 3:].decode('utf8')] = group
+            groups.append(group)
+        elif key == b'END_GROUP':
+            if len(groups) == 1:
+                break
+            groups.pop()
+        elif text is not None:
+            groups[-1][key.decode('ascii')] = text.decode('utf8')
+        elif integer is not None:
+            groups[-1][key.decode('ascii')] = int(integer)
+        elif real is not None:
+            groups[-1][key.decode('ascii')] = float(real)
+        else:
+            groups[-1][key.decode('ascii')] = _parse_bytes_value(other)
+    return tree
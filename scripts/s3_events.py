@@ -0,0 +1,347 @@
+"""
+S3 event notifications, read from a queue, for indexing only what changed.
+
+Buckets publish ``ObjectCreated`` and ``ObjectRemoved`` notifications to SQS,
+directly, through SNS or through EventBridge. ``consume`` receives them in
+batches, keeps only the latest event for each object and hands that to the
+indexer. Messages are only deleted once everything in them has been handled,
+so anything that fails is delivered again, and eventually to the queue's
+dead letter queue.
+
+A directory of JSON files (``FileQueue``) stands in for SQS when testing.
+Write notifications into one with
+
+    python3 s3_events.py DIRECTORY BUCKET KEY... [--removed]
+"""
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import Counter, namedtuple
+from time import sleep, time
+from urllib.parse import quote_plus, unquote_plus, urlparse
+
+import boto3
+import click
+
+# Most messages SQS hands out per request, and the longest it long polls for
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT = 20
+
+Message = namedtuple('Message', ['id', 'body'])
+
+
+class S3Event(namedtuple('S3Event', ['name', 'bucket', 'key', 'size', 'etag', 'sequencer'])):
+    """One object created or removed, as told by an S3 notification."""
+    __slots__ = ()
+
+    @property
+    def uri(self):
+        return "s3://{}/{}".format(self.bucket, self.key)
+
+    @property
+    def removed(self):
+        return self.name.startswith('ObjectRemoved')
+
+    @property
+    def object(self):
+        """
+        The object as ``list_objects_v2`` would give it, for the manifest, but
+        without ``LastModified``, which notifications don't have. The event's
+        time is a little later, so the manifest compares the ETag and size.
+        """
+        return {
+            'Key': self.key,
+            'Size': self.size,
+            'ETag': '"{}"'.format(self.etag) if self.etag else None,
+        }
+
+    def supersedes(self, other):
+        """
+        True if this event happened after ``other``, for the same object.
+        Sequencers are hex strings, compared once padded to the same length.
+        Without them, the one received last wins.
+        """
+        if not self.sequencer or not other.sequencer:
+            return True
+        width = max(len(self.sequencer), len(other.sequencer))
+        return self.sequencer.rjust(width, '0') >= other.sequencer.rjust(width, '0')
+
+
+def _from_record(record):
+    s3 = record['s3']
+    obj = s3['object']
+    return S3Event(
+        name=record['eventName'],
+        bucket=s3['bucket']['name'],
+        # Keys are URL encoded in notifications, spaces as "+"
+        key=unquote_plus(obj['key']),
+        size=obj.get('size'),
+        etag=obj.get('eTag'),
+        sequencer=obj.get('sequencer'),
+    )
+
+
+def _from_eventbridge(body):
+    detail = body['detail']
+    obj = detail['object']
+    removed = body['detail-type'] == 'Object Deleted'
+    return S3Event(
+        name='ObjectRemoved:Delete' if removed else 'ObjectCreated:' + detail.get('reason', 'PutObject'),
+        bucket=detail['bucket']['name'],
+        key=obj['key'],
+        size=obj.get('size'),
+        etag=obj.get('etag'),
+        sequencer=obj.get('sequencer'),
+    )
+
+
+def parse_notification(body):
+    """
+    Return the ``S3Event``s in the body of a queue message, which is an S3
+    notification, an SNS notification wrapping one, or an EventBridge event.
+    Test events and other kinds of event give nothing. Raises ValueError if
+    the body can't be read at all.
+    """
+    try:
+        body = json.loads(body)
+        if body.get('Type') == 'Notification' and 'Message' in body:
+            body = json.loads(body['Message'])
+        if body.get('source') == 'aws.s3' and 'detail' in body:
+            if body['detail-type'] in ('Object Created', 'Object Deleted'):
+                return [_from_eventbridge(body)]
+            return []
+        return [
+            _from_record(record) for record in body.get('Records', [])
+            if record.get('eventSource') == 'aws:s3'
+            and record.get('eventName', '').startswith(('ObjectCreated', 'ObjectRemoved'))
+        ]
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError("Not an S3 notification: {}".format(e))
+
+
+def make_notification(bucket, key, event='ObjectCreated:Put', size=None, etag=None, sequencer=None):
+    """Body of an S3 notification for one object, as S3 would send it."""
+    obj = {'key': quote_plus(key, safe='/'), 'sequencer': sequencer or '{:016X}'.format(int(time() * 1e6))}
+    if not event.startswith('ObjectRemoved'):
+        obj.update({'size': size or 0, 'eTag': etag or uuid.uuid4().hex})
+    return json.dumps({'Records': [{
+        'eventVersion': '2.1',
+        'eventSource': 'aws:s3',
+        'eventName': event,
+        's3': {'bucket': {'name': bucket}, 'object': obj},
+    }]})
+
+
+class SQSQueue(object):
+    """
+    An SQS queue. Messages that aren't deleted come back once their visibility
+    timeout runs out, so that should be longer than a batch takes to index.
+    """
+
+    def __init__(self, url, client=None):
+        self.url = url
+        self.sqs = client or boto3.client('sqs')
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES, wait=0):
+        response = self.sqs.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=min(max_messages, SQS_MAX_MESSAGES),
+            WaitTimeSeconds=min(int(wait), SQS_MAX_WAIT),
+        )
+        return [Message(msg['ReceiptHandle'], msg['Body']) for msg in response.get('Messages', [])]
+
+    def delete(self, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), SQS_MAX_MESSAGES):
+            entries = [
+                {'Id': str(i), 'ReceiptHandle': receipt}
+                for i, receipt in enumerate(ids[start:start + SQS_MAX_MESSAGES])
+            ]
+            response = self.sqs.delete_message_batch(QueueUrl=self.url, Entries=entries)
+            for failure in response.get('Failed', []):
+                logging.warning("Couldn't delete message: %s", failure.get('Message'))
+
+    def release(self, ids):
+        # Left to come back when their visibility timeout runs out
+        pass
+
+
+class FileQueue(object):
+    """
+    A directory of ``.json`` messages standing in for SQS. A message is taken
+    by renaming it, so more than one consumer can share the directory.
+    Released messages go back on the queue until they have been received
+    ``max_receives`` times, then into ``dead/``, like a redrive policy.
+    """
+
+    def __init__(self, directory, max_receives=3, poll_interval=0.5):
+        self.directory = directory
+        self.max_receives = max_receives
+        self.poll_interval = poll_interval
+        self._receives = Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, body):
+        name = '{:.6f}-{}'.format(time(), uuid.uuid4().hex)
+        staging = os.path.join(self.directory, name + '.tmp')
+        with open(staging, 'w') as f:
+            f.write(body)
+        os.rename(staging, os.path.join(self.directory, name + '.json'))
+
+    def _take(self, max_messages):
+        messages = []
+        for name in sorted(os.listdir(self.directory)):
+            if len(messages) >= max_messages:
+                break
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            taken = path + '.inflight'
+            try:
+                os.rename(path, taken)
+                with open(taken) as f:
+                    messages.append(Message(taken, f.read()))
+            except FileNotFoundError:
+                # Another consumer got there first
+                continue
+            self._receives[taken] += 1
+        return messages
+
+    def receive(self, max_messages=SQS_MAX_MESSAGES, wait=0):
+        deadline = time() + wait
+        while True:
+            messages = self._take(max_messages)
+            if messages or time() >= deadline:
+                return messages
+            sleep(self.poll_interval)
+
+    def delete(self, ids):
+        for taken in ids:
+            self._receives.pop(taken, None)
+            os.remove(taken)
+
+    def release(self, ids):
+        for taken in ids:
+            if self._receives[taken] >= self.max_receives:
+                dead = os.path.join(self.directory, 'dead')
+                os.makedirs(dead, exist_ok=True)
+                os.rename(taken, os.path.join(dead, os.path.basename(taken)[:-len('.inflight')]))
+                self._receives.pop(taken)
+                logging.error("Gave up on %s after %d attempts", taken, self.max_receives)
+            else:
+                os.rename(taken, taken[:-len('.inflight')])
+
+
+def open_queue(url):
+    """
+    An ``SQSQueue`` for an ``https://sqs...`` queue URL, otherwise a
+    ``FileQueue`` for a ``file://`` URL or a local directory.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('http', 'https'):
+        return SQSQueue(url)
+    if parsed.scheme == 'file':
+        return FileQueue(parsed.path)
+    return FileQueue(url)
+
+
+def _receive_batch(queue, batch_size, batch_window, wait, stop, stats):
+    """
+    Receive messages until ``batch_size`` objects have events, the first
+    message has waited ``batch_window`` seconds, or the queue runs dry.
+    Returns the messages and the latest event for each object.
+    """
+    messages = []
+    latest = {}
+    deadline = None
+    while len(latest) < batch_size and not stop.is_set():
+        if deadline is None:
+            timeout = wait
+        else:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+        received = queue.receive(max_messages=batch_size - len(latest), wait=timeout)
+        if not received:
+            break
+        if deadline is None:
+            deadline = time() + batch_window
+
+        for message in received:
+            try:
+                events = parse_notification(message.body)
+            except ValueError as e:
+                # It will never make sense, so there's no point keeping it
+                logging.warning("Dropping message: %s", e)
+                queue.delete([message.id])
+                stats.count('bad_messages')
+                continue
+            messages.append((message, events))
+            stats.count('messages')
+            stats.count('events', len(events))
+            for event in events:
+                if event.uri in latest:
+                    stats.count('duplicate_events')
+                    if not event.supersedes(latest[event.uri]):
+                        continue
+                latest[event.uri] = event
+    return messages, latest
+
+
+def consume(queue, handle, stats, batch_size=100, batch_window=5.0, wait=SQS_MAX_WAIT, once=False, stop=None):
+    """
+    Receive S3 notifications from ``queue`` and call ``handle(events)`` with
+    the latest event for each object, up to ``batch_size`` objects at a time.
+    ``handle`` returns the uris it failed on. Messages with none of those are
+    deleted, the rest are released to be delivered again.
+
+    :param queue: An ``SQSQueue`` or ``FileQueue``.
+    :param handle: Called with a list of ``S3Event``s, one per object.
+    :param stats: ``IndexStats`` to count messages and events in.
+    :param batch_size: Most objects to handle at once.
+    :param batch_window: Seconds to wait for a batch to fill once its first
+        message has arrived.
+    :param wait: Seconds to long poll for when the queue is empty.
+    :param once: Return when the queue is empty, instead of waiting for more.
+    :param stop: ``threading.Event`` that stops consuming after the batch
+        in hand, e.g. when set from a signal handler.
+    """
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        messages, latest = _receive_batch(queue, batch_size, batch_window, wait, stop, stats)
+        if not messages:
+            if once:
+                break
+            continue
+
+        try:
+            failed = set(handle(list(latest.values())) or ())
+        except Exception as e:
+            logging.exception("Failed to handle a batch of %d events: %s", len(latest), e)
+            failed = set(latest)
+        done = [message.id for message, events in messages
+                if not any(event.uri in failed for event in events)]
+        retry = [message.id for message, events in messages
+                 if any(event.uri in failed for event in events)]
+        queue.delete(done)
+        if retry:
+            logging.warning("Leaving %d messages on the queue to try again", len(retry))
+            queue.release(retry)
+
+
+@click.command(help="Write S3 notifications for KEYS into a directory standing in for an SQS queue")
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.argument('bucket')
+@click.argument('keys', nargs=-1, required=True)
+@click.option('--removed', is_flag=True, help="Send ObjectRemoved events instead of ObjectCreated")
+def main(directory, bucket, keys, removed):
+    queue = FileQueue(directory)
+    event = 'ObjectRemoved:Delete' if removed else 'ObjectCreated:Put'
+    for key in keys:
+        queue.send(make_notification(bucket, key, event=event))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Read the keys to index from an S3 Inventory report, or any other list of
+objects, instead of listing the bucket.
+
+Supported sources, local or on S3:
+
+* an S3 Inventory ``manifest.json``, whose CSV or Parquet data files are read
+  in turn
+* an S3 Inventory CSV data file, optionally gzipped, with no header row
+* a CSV file with a header row that includes a ``Key`` column, and optionally
+  ``Bucket``, ``Size``, ``ETag`` and ``LastModifiedDate``
+* a Parquet file with S3 Inventory column names (needs pyarrow)
+* a text file with one key per line
+
+Everything is streamed, so a report with millions of rows doesn't have to fit
+in memory. Objects come out shaped like ``list_objects_v2`` entries.
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus, urlparse
+
+import boto3
+
+DEFAULT_SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag'
+
+# S3 Inventory Parquet columns to the names used in CSV reports
+PARQUET_COLUMNS = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+}
+
+
+def _open(path):
+    """Open a local path or s3:// url for binary reading, un-gzipping it on the way."""
+    gzipped = path.endswith('.gz')
+    parsed = urlparse(path)
+    if parsed.scheme == 's3':
+        body = boto3.client('s3').get_object(
+            Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))['Body']
+        stream = io.BufferedReader(body._raw_stream)
+        return gzip.GzipFile(fileobj=stream) if gzipped else stream
+
+    local_path = parsed.path if parsed.scheme == 'file' else path
+    return gzip.open(local_path) if gzipped else open(local_path, 'rb')
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return value
+
+
+def _is_true(value):
+    return str(value).lower() == 'true'
+
+
+def _is_false(value):
+    return str(value).lower() == 'false'
+
+
+def _to_object(row, url_encoded):
+    """Turn an inventory row into a dict like a list_objects_v2 entry."""
+    key = row['Key']
+    if url_encoded:
+        key = unquote_plus(key)
+    obj = {'Key': key}
+    if row.get('Bucket'):
+        obj['Bucket'] = row['Bucket']
+    if row.get('Size') not in (None, ''):
+        obj['Size'] = int(row['Size'])
+    if row.get('ETag'):
+        # Listings quote their ETags, inventories don't
+        obj['ETag'] = '"{}"'.format(row['ETag'].strip('"'))
+    if row.get('LastModifiedDate'):
+        obj['LastModified'] = _parse_date(row['LastModifiedDate'])
+    return obj
+
+
+def _csv_rows(path, schema=None):
+    """
+    Rows of a CSV file as dicts. Files with no ``Key`` in their first row are
+    taken to be S3 Inventory data files, laid out as ``schema``.
+    """
+    with io.TextIOWrapper(_open(path), encoding='utf8', newline='') as f:
+        reader = csv.reader(f)
+        first = next(reader, None)
+        if first is None:
+            return
+        if schema is None and 'Key' in first:
+            fields, url_encoded = first, False
+        else:
+            fields = [field.strip() for field in (schema or DEFAULT_SCHEMA).split(',')]
+            url_encoded = True
+            yield dict(zip(fields, first)), url_encoded
+        for values in reader:
+            yield dict(zip(fields, values)), url_encoded
+
+
+def _parquet_rows(path):
+    try:
+        import pyarrow.parquet as pq
+        from pyarrow import fs
+    except ImportError:
+        raise RuntimeError("pyarrow is needed to read Parquet inventories")
+
+    # Parquet needs to seek, which pyarrow's own filesystems do with range reads
+    if urlparse(path).scheme:
+        filesystem, path = fs.FileSystem.from_uri(path)
+    else:
+        filesystem = fs.LocalFileSystem()
+
+    with filesystem.open_input_file(path) as f:
+        parquet = pq.ParquetFile(f)
+        columns = [name for name in parquet.schema_arrow.names if name in PARQUET_COLUMNS]
+        for batch in parquet.iter_batches(columns=columns):
+            data = batch.to_pydict()
+            for i in range(batch.num_rows):
+                yield {PARQUET_COLUMNS[name]: data[name][i] for name in columns}, False
+
+
+def _text_rows(path):
+    with io.TextIOWrapper(_open(path), encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield {'Key': line}, False
+
+
+def _manifest_rows(path):
+    """Rows of every data file listed in an S3 Inventory manifest.json."""
+    with _open(path) as f:
+        manifest = json.load(f)
+
+    file_format = manifest.get('fileFormat', 'CSV').upper()
+    schema = manifest.get('fileSchema')
+    destination = manifest.get('destinationBucket', '').split(':::')[-1]
+    parsed = urlparse(path)
+    local_dir = None
+    if parsed.scheme != 's3':
+        local_dir = os.path.dirname(parsed.path if parsed.scheme == 'file' else path)
+
+    for data_file in manifest['files']:
+        data_path = 's3://{}/{}'.format(destination, data_file['key'])
+        if local_dir is not None:
+            # Use a local copy next to the manifest if there is one
+            local_path = os.path.join(local_dir, os.path.basename(data_file['key']))
+            if os.path.exists(local_path):
+                data_path = local_path
+        logging.info("Reading inventory file %s", data_path)
+
+        if file_format == 'CSV':
+            rows = _csv_rows(data_path, schema=schema)
+        elif file_format == 'PARQUET':
+            rows = _parquet_rows(data_path)
+        else:
+            raise ValueError("Unsupported inventory format {}".format(file_format))
+        for row in rows:
+            yield row
+
+
+def _rows(path, schema=None):
+    name = path.lower()
+    if name.endswith('.json'):
+        return _manifest_rows(path)
+    if name.endswith('.parquet'):
+        return _parquet_rows(path)
+    if name.endswith('.txt') or name.endswith('.txt.gz'):
+        return _text_rows(path)
+    return _csv_rows(path, schema=schema)
+
+
+def read_inventory(path, bucket=None, prefix='', suffix='', schema=None):
+    """
+    Generate the objects in an inventory or manifest file.
+
+    :param path: Local path or s3:// url of the inventory.
+    :param bucket: Skip rows for any other bucket, when rows say which bucket.
+    :param prefix: Only generate keys that start with this prefix (optional).
+    :param suffix: Only generate keys that end with this suffix (optional).
+    :param schema: Column names of a header-less CSV, as in a manifest.json.
+    """
+    prefix = prefix or ''
+    suffix = suffix or ''
+    found = 0
+
+    for row, url_encoded in _rows(path, schema=schema):
+        if _is_true(row.get('IsDeleteMarker')) or _is_false(row.get('IsLatest')):
+            continue
+        obj = _to_object(row, url_encoded)
+        if bucket and obj.get('Bucket', bucket) != bucket:
+            continue
+        if obj['Key'].startswith(prefix) and obj['Key'].endswith(suffix):
+            found += 1
+            yield obj
+
+    if not found:
+        logging.warning("No keys found in {} under {} with the suffix {}".format(
+            path, prefix, suffix
+        ))
@@ -0,0 +1,191 @@
+"""
+Listing of S3 prefixes, either page by page or sharded across threads.
+
+The sharded lister finds sub-prefixes with ``Delimiter='/'`` and lists them
+concurrently. A flat prefix with too many keys for one page is split further
+on the next character of the key. Keys are streamed to the caller as soon as
+a page comes back, so work can start before the listing has finished.
+"""
+import logging
+import threading
+from queue import Empty, Full, Queue
+
+import boto3
+
+DONE = "LISTING_DONE"
+
+# Characters a flat prefix is split on, in the order S3 sorts them. Keys whose
+# next character is outside ASCII are picked up by one last "tail" shard.
+FANOUT_CHARS = [chr(c) for c in range(128)]
+
+
+def get_matching_s3_keys(bucket, prefix='', suffix='', workers=1, client=None):
+    """
+    Generate the keys in an S3 bucket.
+
+    :param bucket: Name of the S3 bucket.
+    :param prefix: Only fetch keys that start with this prefix (optional).
+    :param suffix: Only fetch keys that end with this suffix (optional).
+    :param workers: Number of threads listing sub-prefixes concurrently.
+    :param client: boto3 S3 client to use, e.g. one pointed at a local stand-in.
+    """
+    for obj in get_matching_s3_objects(bucket, prefix=prefix, suffix=suffix,
+                                       workers=workers, client=client):
+        yield obj['Key']
+
+
+def get_matching_s3_objects(bucket, prefix='', suffix='', workers=1, client=None):
+    """
+    Generate the objects in an S3 bucket, as returned by list_objects_v2.
+    Takes the same arguments as ``get_matching_s3_keys``. With more than one
+    worker the objects come back in no particular order.
+    """
+    s3 = client or boto3.client('s3')
+    prefix = prefix or ''
+    suffix = suffix or ''
+
+    if workers > 1:
+        objects = _list_sharded(s3, bucket, prefix, workers)
+    else:
+        objects = _list_serially(s3, bucket, prefix)
+
+    found = 0
+    for obj in objects:
+        if obj['Key'].endswith(suffix):
+            found += 1
+            yield obj
+
+    if not found:
+        logging.warning("No keys found at {}/{} with the suffix {}".format(
+            bucket, prefix, suffix
+        ))
+
+
+def _list_serially(s3, bucket, prefix):
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        resp = s3.list_objects_v2(**kwargs)
+        # A page can legitimately be empty, so keep going while S3 says so
+        for obj in resp.get('Contents', []):
+            yield obj
+        if not resp.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+
+class _ShardedListing(object):
+    """
+    Shards are ``(prefix, start_after, depth, tail)``. Each one is listed by a
+    worker thread, which puts pages of objects on ``results`` and any shards it
+    discovers back on the work queue.
+    """
+
+    def __init__(self, s3, bucket, workers, max_depth, queue_size):
+        self.s3 = s3
+        self.bucket = bucket
+        self.workers = workers
+        self.max_depth = max_depth
+        self.shards = Queue()
+        self.results = Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self._outstanding = 0
+        self._lock = threading.Lock()
+
+    def submit(self, prefix, start_after=None, depth=0, tail=False):
+        with self._lock:
+            self._outstanding += 1
+        self.shards.put((prefix, start_after, depth, tail))
+
+    def emit(self, item):
+        # Don't block forever if the consumer has gone away
+        while not self.stopped.is_set():
+            try:
+                self.results.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def work(self):
+        while not self.stopped.is_set():
+            try:
+                shard = self.shards.get(timeout=1)
+            except Empty:
+                continue
+            if shard is None:
+                break
+            try:
+                self.list_shard(*shard)
+            except Exception as e:
+                self.emit(e)
+            finally:
+                with self._lock:
+                    self._outstanding -= 1
+                    finished = self._outstanding == 0
+                if finished:
+                    self.emit(DONE)
+
+    def list_shard(self, prefix, start_after, depth, tail):
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix, 'Delimiter': '/'}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+
+        first_page = True
+        while not self.stopped.is_set():
+            resp = self.s3.list_objects_v2(**kwargs)
+            contents = resp.get('Contents', [])
+            common_prefixes = resp.get('CommonPrefixes', [])
+            if contents:
+                self.emit(contents)
+            for common_prefix in common_prefixes:
+                self.submit(common_prefix['Prefix'], depth=depth + 1)
+
+            if not resp.get('IsTruncated'):
+                return
+
+            # A flat prefix with more keys than fit on a page: hand the rest
+            # of it out as one shard per next character instead of paging
+            if first_page and not common_prefixes and contents and not tail \
+                    and depth < self.max_depth:
+                last_key = contents[-1]['Key']
+                if len(last_key) > len(prefix):
+                    self.split(prefix, last_key, depth)
+                    return
+
+            first_page = False
+            kwargs['ContinuationToken'] = resp['NextContinuationToken']
+
+    def split(self, prefix, last_key, depth):
+        next_char = last_key[len(prefix)]
+        self.submit(prefix + next_char, start_after=last_key, depth=depth + 1)
+        for char in FANOUT_CHARS:
+            if char > next_char:
+                self.submit(prefix + char, depth=depth + 1)
+        tail_start = prefix + max(next_char, '\x7f') + '\U0010ffff'
+        self.submit(prefix, start_after=tail_start, depth=depth + 1, tail=True)
+
+    def stop(self):
+        self.stopped.set()
+        for i in range(self.workers):
+            self.shards.put(None)
+
+
+def _list_sharded(s3, bucket, prefix, workers, max_depth=4, queue_size=64):
+    listing = _ShardedListing(s3, bucket, workers, max_depth, queue_size)
+    listing.submit(prefix)
+
+    threads = [threading.Thread(target=listing.work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            item = listing.results.get()
+            if item == DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            for obj in item:
+                yield obj
+    finally:
+        listing.stop()
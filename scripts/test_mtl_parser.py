@@ -0,0 +1,173 @@
+"""
+Checks that ``parse_mtl`` gives the same result as the original line by line
+parser, ``_parse_group``, on the sample MTL and on the odd shapes of file it
+has to cope with.
+
+    python3 -m pytest scripts/test_mtl_parser.py
+"""
+import math
+
+import pytest
+
+from benchmark_data import sample_mtl
+from mtl_parser import _parse_group, parse_mtl
+
+
+def original_parser(body):
+    return _parse_group(iter(body.decode('utf8').split("\n")))
+
+
+def assert_same(fast, original, path='MTL'):
+    """Compare two parsed trees, with NaN equal to NaN and int not equal to float."""
+    assert type(fast) is type(original), "{}: {!r} != {!r}".format(path, fast, original)
+    if isinstance(original, dict):
+        assert list(fast) == list(original), path
+        for key in original:
+            assert_same(fast[key], original[key], '{}/{}'.format(path, key))
+    elif isinstance(original, list):
+        assert len(fast) == len(original), path
+        for i, (a, b) in enumerate(zip(fast, original)):
+            assert_same(a, b, '{}[{}]'.format(path, i))
+    elif isinstance(original, float) and math.isnan(original):
+        assert math.isnan(fast), path
+    else:
+        assert fast == original, "{}: {!r} != {!r}".format(path, fast, original)
+
+
+def mtl(*lines):
+    return '\n'.join(lines).encode('utf8')
+
+
+NESTED = mtl(
+    'GROUP = L1_METADATA_FILE',
+    '  GROUP = OUTER',
+    '    A = 1',
+    '    GROUP = INNER',
+    '      B = "two"',
+    '      GROUP = INNERMOST',
+    '        C = 3.5',
+    '      END_GROUP = INNERMOST',
+    '    END_GROUP = INNER',
+    '    D = 4',
+    '  END_GROUP = OUTER',
+    '  E = "after"',
+    'END_GROUP = L1_METADATA_FILE',
+    'END',
+)
+
+QUOTED_EQUALS = mtl(
+    'GROUP = L1_METADATA_FILE',
+    '  ORIGIN = "Image courtesy of the U.S. Geological Survey"',
+    '  FILTER = "CLOUD_COVER = 10"',
+    '  EXPRESSION = "a = b = c"',
+    '  LEADING = "= starts with it"',
+    '  UNQUOTED = x = y',
+    'END_GROUP = L1_METADATA_FILE',
+    'END',
+)
+
+BLANK_LINES = mtl(
+    '',
+    'GROUP = L1_METADATA_FILE',
+    '',
+    '  GROUP = PRODUCT_METADATA',
+    '    WRS_PATH = 89',
+    '',
+    '',
+    '    SENSOR_ID = "OLI_TIRS"',
+    '  END_GROUP = PRODUCT_METADATA',
+    '   ',
+    'END_GROUP = L1_METADATA_FILE',
+    'END',
+    '',
+    '',
+)
+
+NUMBERS = mtl(
+    'GROUP = L1_METADATA_FILE',
+    '  INTEGER = 89',
+    '  NEGATIVE = -12',
+    '  PLUS = +7',
+    '  QUOTED_INTEGER = "01"',
+    '  REAL = 150.17155',
+    '  EXPONENT = 1.2345E-04',
+    '  NEGATIVE_EXPONENT = -3.5e+02',
+    '  LEADING_POINT = .5',
+    '  TRAILING_POINT = 5.',
+    '  QUOTED_REAL = "2.5"',
+    '  NAN = NaN',
+    '  LOWER_NAN = nan',
+    '  QUOTED_NAN = "NaN"',
+    '  INFINITY = -Infinity',
+    '  INF = inf',
+    '  UNDERSCORED = 1_000',
+    '  DATE = 2017-03-04',
+    '  TIME = "23:53:30.4370430Z"',
+    '  WORD = NONE',
+    '  EMPTY = ""',
+    'END_GROUP = L1_METADATA_FILE',
+    'END',
+)
+
+
+@pytest.mark.parametrize('scene', [0, 1, 250])
+def test_sample(scene):
+    body = sample_mtl(scene)
+    parsed = parse_mtl(body)
+    assert_same(parsed, original_parser(body))
+    assert parsed['L1_METADATA_FILE']['PRODUCT_METADATA']['WRS_PATH'] == 89
+
+
+@pytest.mark.parametrize('body', [NESTED, QUOTED_EQUALS, BLANK_LINES, NUMBERS],
+                         ids=['nested', 'quoted_equals', 'blank_lines', 'numbers'])
+def test_edge_cases(body):
+    assert_same(parse_mtl(body), original_parser(body))
+
+
+def test_nested():
+    outer = parse_mtl(NESTED)['L1_METADATA_FILE']['OUTER']
+    assert outer['INNER']['INNERMOST'] == {'C': 3.5}
+    assert outer['D'] == 4
+
+
+def test_quoted_equals():
+    parsed = parse_mtl(QUOTED_EQUALS)['L1_METADATA_FILE']
+    assert parsed['FILTER'] == 'CLOUD_COVER = 10'
+    assert parsed['EXPRESSION'] == 'a = b = c'
+
+
+def test_numbers():
+    parsed = parse_mtl(NUMBERS)['L1_METADATA_FILE']
+    assert parsed['INTEGER'] == 89 and isinstance(parsed['INTEGER'], int)
+    assert parsed['QUOTED_INTEGER'] == 1
+    assert parsed['EXPONENT'] == pytest.approx(1.2345e-04)
+    assert math.isnan(parsed['NAN']) and math.isnan(parsed['QUOTED_NAN'])
+    assert parsed['INFINITY'] == -math.inf
+    assert parsed['DATE'] == '2017-03-04'
+
+
+@pytest.mark.parametrize('body', [sample_mtl(), NESTED, QUOTED_EQUALS, BLANK_LINES, NUMBERS],
+                         ids=['sample', 'nested', 'quoted_equals', 'blank_lines', 'numbers'])
+def test_crlf(body):
+    crlf = body.replace(b'\n', b'\r\n')
+    assert_same(parse_mtl(crlf), original_parser(crlf))
+
+
+@pytest.mark.parametrize('cut', [b'END\n', b'END_GROUP = L1_METADATA_FILE\n'])
+def test_missing_end(cut):
+    body = sample_mtl()
+    truncated = body[:body.rindex(cut)]
+    assert_same(parse_mtl(truncated), original_parser(truncated))
+    # Ends part way through a group
+    truncated = body[:body.index(b'END_GROUP = PRODUCT_METADATA')]
+    assert_same(parse_mtl(truncated), original_parser(truncated))
+
+
+def test_metadata_doc():
+    pytest.importorskip('datacube')
+    from ls_public_bucket import make_metadata_doc
+
+    for body in (sample_mtl(), sample_mtl().replace(b'\n', b'\n\n')):
+        fast = make_metadata_doc(parse_mtl(body)['L1_METADATA_FILE'], 'bucket', 'key/MTL.txt')
+        original = make_metadata_doc(original_parser(body)['L1_METADATA_FILE'], 'bucket', 'key/MTL.txt')
+        assert_same(fast, original)
@@ -0,0 +1,267 @@
+"""
+Read the bounds and CRS of a GeoTIFF from one or two range requests, instead of
+opening it through GDAL. Only the first IFD and the GeoTIFF tags are decoded,
+which is all that indexing needs.
+"""
+import logging
+import struct
+import threading
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+import boto3
+import rasterio
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+
+DEFAULT_PREFETCH = 16 * 1024
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+
+# GeoKeys
+GT_RASTER_TYPE = 1025
+GEOGRAPHIC_TYPE = 2048
+PROJECTED_CS_TYPE = 3072
+USER_DEFINED = 32767
+RASTER_PIXEL_IS_POINT = 2
+
+# TIFF field type: (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8),
+}
+
+WANTED_TAGS = {IMAGE_WIDTH, IMAGE_LENGTH, MODEL_PIXEL_SCALE, MODEL_TIEPOINT,
+               MODEL_TRANSFORMATION, GEO_KEY_DIRECTORY}
+
+TiffHeader = namedtuple('TiffHeader', ['width', 'height', 'bounds', 'crs'])
+
+
+class HeaderError(Exception):
+    """The header could not be decoded without GDAL."""
+
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def _s3_client():
+    global _s3
+    with _s3_lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3')
+    return _s3
+
+
+def read_range(url, start, length):
+    """
+    Read ``length`` bytes from ``url`` starting at ``start``. Supports
+    ``s3://``, ``http(s)://``, ``file://`` and plain local paths. Fewer bytes
+    come back if the file is shorter.
+    """
+    parsed = urlparse(url)
+    byte_range = 'bytes={}-{}'.format(start, start + length - 1)
+
+    if parsed.scheme == 's3':
+        resp = _s3_client().get_object(
+            Bucket=parsed.netloc, Key=parsed.path.lstrip('/'), Range=byte_range)
+        return resp['Body'].read()
+
+    if parsed.scheme in ('http', 'https'):
+        with urlopen(Request(url, headers={'Range': byte_range})) as resp:
+            data = resp.read()
+        # A server that ignores Range sends the whole file
+        if resp.status == 200:
+            data = data[start:start + length]
+        return data
+
+    path = parsed.path if parsed.scheme == 'file' else url
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+
+class _Reader(object):
+    """
+    Unpacks values from the prefetched buffer, going back to the file with a
+    range request for anything that lies outside of it.
+    """
+
+    def __init__(self, url, buf):
+        self.url = url
+        self.buf = buf
+        self.chunks = [(0, buf)]
+
+        if buf[:2] == b'II':
+            self.order = '<'
+        elif buf[:2] == b'MM':
+            self.order = '>'
+        else:
+            raise HeaderError("Not a TIFF file")
+
+        magic, = self.unpack('H', 2)
+        if magic == 42:
+            self.bigtiff = False
+            self.first_ifd, = self.unpack('I', 4)
+        elif magic == 43:
+            self.bigtiff = True
+            self.first_ifd, = self.unpack('Q', 8)
+        else:
+            raise HeaderError("Unknown TIFF version {}".format(magic))
+
+    def fetch(self, spans):
+        """Read everything in ``spans`` that we don't have yet in one go."""
+        spans = [(offset, size) for offset, size in spans if not self.has(offset, size)]
+        if spans:
+            start = min(offset for offset, _ in spans)
+            end = max(offset + size for offset, size in spans)
+            self.chunks.append((start, read_range(self.url, start, end - start)))
+
+    def has(self, offset, size):
+        return any(
+            start <= offset and offset + size <= start + len(data)
+            for start, data in self.chunks
+        )
+
+    def bytes(self, offset, size):
+        for start, data in self.chunks:
+            if start <= offset and offset + size <= start + len(data):
+                return data[offset - start:offset - start + size]
+        raise HeaderError("Header is larger than the bytes read")
+
+    def unpack(self, fmt, offset, count=1):
+        size = struct.calcsize('<' + fmt) * count
+        return struct.unpack(self.order + fmt * count, self.bytes(offset, size))
+
+    def read_ifd(self):
+        """
+        Return ``{tag: (type, count, value offset)}`` for the tags we need. The
+        values themselves are read later, once we know where they all are.
+        """
+        if self.bigtiff:
+            n_fmt, n_size, entry_size, field_fmt, field_size = 'Q', 8, 20, 'Q', 8
+        else:
+            n_fmt, n_size, entry_size, field_fmt, field_size = 'H', 2, 12, 'I', 4
+
+        offset = self.first_ifd
+        if not self.has(offset, n_size):
+            # Plain GeoTIFFs can keep their IFD at the end of the file
+            self.fetch([(offset, len(self.buf))])
+        n_entries, = self.unpack(n_fmt, offset)
+        offset += n_size
+
+        # A big IFD may run past the end of what we have
+        self.fetch([(offset, n_entries * entry_size)])
+
+        entries = {}
+        for i in range(n_entries):
+            entry = offset + i * entry_size
+            tag, field_type = self.unpack('HH', entry)
+            if tag not in WANTED_TAGS:
+                continue
+            if field_type not in FIELD_TYPES:
+                raise HeaderError("Unknown field type {} for tag {}".format(field_type, tag))
+            count, = self.unpack(field_fmt, entry + 4)
+            value_offset = entry + 4 + field_size
+            # Values that don't fit in the entry are stored elsewhere
+            if FIELD_TYPES[field_type][1] * count > field_size:
+                value_offset, = self.unpack(field_fmt, value_offset)
+            entries[tag] = (field_type, count, value_offset)
+        return entries
+
+    def values(self, entry):
+        field_type, count, offset = entry
+        fmt, size = FIELD_TYPES[field_type]
+        if field_type in (5, 10):
+            raw = self.unpack(fmt, offset, count)
+            return tuple(n / d for n, d in zip(raw[::2], raw[1::2]))
+        return self.unpack(fmt, offset, count)
+
+
+def _epsg_from_geokeys(keys):
+    directory = {}
+    n_keys = keys[3]
+    for i in range(n_keys):
+        key_id, location, count, value = keys[4 + i * 4:8 + i * 4]
+        # We only need keys stored inline as SHORT
+        if location == 0:
+            directory[key_id] = value
+
+    epsg = directory.get(PROJECTED_CS_TYPE) or directory.get(GEOGRAPHIC_TYPE)
+    if epsg is None or epsg == USER_DEFINED:
+        raise HeaderError("No EPSG code in the GeoKeys")
+    return epsg, directory.get(GT_RASTER_TYPE)
+
+
+@lru_cache(maxsize=None)
+def crs_from_epsg(epsg):
+    return CRS.from_epsg(epsg)
+
+
+def read_header(url, prefetch=DEFAULT_PREFETCH):
+    """
+    Decode the size, bounds and CRS of the GeoTIFF at ``url``, raising
+    HeaderError if it can't be done from the TIFF tags alone.
+    """
+    reader = _Reader(url, read_range(url, 0, prefetch))
+    entries = reader.read_ifd()
+
+    if GEO_KEY_DIRECTORY not in entries:
+        raise HeaderError("Not a GeoTIFF")
+    if IMAGE_WIDTH not in entries or IMAGE_LENGTH not in entries:
+        raise HeaderError("Missing image size")
+
+    # Get every value that lives outside the buffer with one more request
+    reader.fetch([
+        (offset, FIELD_TYPES[field_type][1] * count)
+        for field_type, count, offset in entries.values()
+    ])
+
+    width, = reader.values(entries[IMAGE_WIDTH])
+    height, = reader.values(entries[IMAGE_LENGTH])
+    epsg, raster_type = _epsg_from_geokeys(reader.values(entries[GEO_KEY_DIRECTORY]))
+
+    if MODEL_TIEPOINT in entries and MODEL_PIXEL_SCALE in entries:
+        i, j, _, x, y, _ = reader.values(entries[MODEL_TIEPOINT])[:6]
+        scale_x, scale_y = reader.values(entries[MODEL_PIXEL_SCALE])[:2]
+    elif MODEL_TRANSFORMATION in entries:
+        matrix = reader.values(entries[MODEL_TRANSFORMATION])
+        if matrix[1] != 0 or matrix[4] != 0:
+            raise HeaderError("Rotated rasters are not supported")
+        i, j, x, y = 0, 0, matrix[3], matrix[7]
+        scale_x, scale_y = matrix[0], -matrix[5]
+    else:
+        raise HeaderError("No georeferencing tags")
+
+    left = x - i * scale_x
+    top = y + j * scale_y
+    if raster_type == RASTER_PIXEL_IS_POINT:
+        # Same half pixel shift GDAL makes
+        left -= scale_x / 2
+        top += scale_y / 2
+
+    bounds = BoundingBox(left, top - height * scale_y, left + width * scale_x, top)
+    return TiffHeader(width, height, bounds, crs_from_epsg(epsg))
+
+
+def open_header(url, prefetch=DEFAULT_PREFETCH):
+    """
+    Like ``read_header``, but falls back to opening the file with rasterio
+    when the header can't be decoded on its own.
+    """
+    try:
+        return read_header(url, prefetch=prefetch)
+    except (HeaderError, struct.error) as e:
+        logging.debug("Falling back to rasterio for %s: %s", url, e)
+
+    with rasterio.open(url) as raster:
+        return TiffHeader(raster.width, raster.height, raster.bounds, raster.crs)